@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+#
+# archive.py - History of decided IRRs
+#
+# Every approved or rejected answer is appended to a JSONL segment named for
+# the month it was decided in, under archive/. Once the month is over, the
+# segment is compressed to <month>.jsonl.gz as a run of independent gzip
+# members of about 64 KiB each. `gzip -dc` still reads the whole file, but
+# one record can be read back by decompressing only the member it is in.
+#
+# archive/index.json maps each answer id to where its record lives, and IRR
+# numbers and user ids to answer ids. To look something up by hand:
+#
+#   ./archive.py show --irr 123
+#   ./archive.py show --id 1a2b3c4d
+#   ./archive.py show --user 490748473314902016
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import argparse
+import asyncio
+import logging
+import time
+import gzip
+import json
+import os
+
+from utils import (
+    fsync_dir,
+    Config,
+)
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import (
+        NotRequired,
+        TypedDict,
+        Optional,
+        Literal,
+        Any,
+    )
+
+    class _Record(TypedDict):
+        answer: dict[str, Any]
+        result: Literal['approved', 'rejected']
+        decided: int                        # epoch seconds
+        irr_num: NotRequired[int]           # approved only
+        thread_id: NotRequired[int]         # approved only
+        reason: NotRequired[str]            # rejected only
+
+    # Where a record lives: the segment file, the offset and length of the
+    # block holding it (a gzip member, or the bare line in an open segment),
+    # and the record's offset and length inside the uncompressed block.
+    _Location = tuple[str, int, int, int, int]
+
+
+__all__ = (
+    'Archive',
+)
+
+log = logging.getLogger(__name__)
+
+
+def segment_name(epoch: float) -> str:
+    return time.strftime('%Y-%m', time.gmtime(epoch)) + '.jsonl'
+
+
+class Archive:
+    """Append-only, month-segmented history of decided IRRs.
+
+    :meth:`submit` only queues the record; a single worker task writes it
+    and updates the index, so approving or rejecting never waits on disk.
+    """
+
+    def __init__(self, directory: str = 'archive', block_size: int = 1 << 16) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.block_size = block_size
+        self.index: Config[Any] = Config(
+            os.path.join(directory, 'index.json'), journal=True)
+        self.queue: asyncio.Queue[_Record] = asyncio.Queue()
+        self.current: Optional[str] = None
+        self.worker: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Writes out whatever is still queued, then closes the index."""
+        if self.worker is not None:
+            await self.queue.join()
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+        await self.index.close()
+
+    def submit(self, record: _Record) -> None:
+        self.queue.put_nowait(record)
+
+    async def _run(self) -> None:
+        await self._rotate_stale()
+        while True:
+            record = await self.queue.get()
+            try:
+                await self._append(record)
+            except Exception:
+                log.exception(f'Could not archive {record["answer"].get("id")}')
+            finally:
+                self.queue.task_done()
+
+    def _path(self, segment: str) -> str:
+        return os.path.join(self.directory, segment)
+
+    async def _rotate_stale(self) -> None:
+        # Compress any open segment left over from an earlier month, e.g.
+        # the bot was down at the turn of the month or crashed mid-rotation.
+        this_month = segment_name(time.time())
+        for segment in sorted(os.listdir(self.directory)):
+            if not segment.endswith('.jsonl'):
+                continue
+            if segment < this_month:
+                await self._rotate(segment)
+            else:
+                self.current = segment
+
+    async def _append(self, record: _Record) -> None:
+        segment = segment_name(record['decided'])
+        if self.current is not None and segment != self.current:
+            if segment < self.current:
+                segment = self.current  # clock skew at the turn of a month
+            else:
+                await self._rotate(self.current)
+        self.current = segment
+
+        line = json.dumps(record, ensure_ascii=True,
+                          separators=(',', ':')).encode('ascii') + b'\n'
+        loop = asyncio.get_running_loop()
+        offset = await loop.run_in_executor(None, self._write, segment, line)
+        await self._add_to_index(record, (segment, offset, len(line), 0, len(line)))
+
+    def _write(self, segment: str, line: bytes) -> int:
+        with open(self._path(segment), 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+        return offset
+
+    async def _add_to_index(self, record: _Record, location: _Location) -> None:
+        answer = record['answer']
+        await self.index.put(f'id:{answer["id"]}', location, wait=False)
+        if 'irr_num' in record:
+            await self.index.put(f'irr:{record["irr_num"]}', answer['id'], wait=False)
+        if answer['id'] not in self.index.get(f'user:{answer["user_id"]}', []):
+            await self.index.append(f'user:{answer["user_id"]}', answer['id'], wait=False)
+
+    async def _rotate(self, segment: str) -> None:
+        """Compresses a finished segment and repoints the index at it.
+
+        The .gz is complete before the index changes, and the .jsonl is only
+        removed after, so a record can be read at every step. A crash in
+        between leaves the .jsonl behind, and the rotation is redone.
+        """
+        loop = asyncio.get_running_loop()
+        moved = await loop.run_in_executor(None, self._compress, segment)
+        for answer_id, location in moved:
+            await self.index.put(f'id:{answer_id}', location, wait=False)
+        await self.index.save()
+        await loop.run_in_executor(None, os.remove, self._path(segment))
+        if self.current == segment:
+            self.current = None
+        log.info(f'Archived {len(moved)} IRRs to {segment}.gz')
+
+    def _compress(self, segment: str) -> list[tuple[str, _Location]]:
+        target = segment + '.gz'
+        moved: list[tuple[str, _Location]] = []
+        block: list[bytes] = []
+        pending: list[tuple[str, int, int]] = []  # answer id, inner offset, length
+        size = 0
+
+        with open(self._path(segment), 'rb') as source, \
+                open(self._path(target) + '.tmp', 'wb') as out:
+            def flush() -> None:
+                nonlocal size
+                member = gzip.compress(b''.join(block))
+                offset = out.tell()
+                out.write(member)
+                for answer_id, inner, length in pending:
+                    moved.append((answer_id, (target, offset, len(member), inner, length)))
+                block.clear()
+                pending.clear()
+                size = 0
+
+            for line in source:
+                try:
+                    answer_id = json.loads(line)['answer']['id']
+                except ValueError:
+                    break  # torn write at the tail
+                pending.append((answer_id, size, len(line)))
+                block.append(line)
+                size += len(line)
+                if size >= self.block_size:
+                    flush()
+            if block:
+                flush()
+            # On disk before the index points at it and the .jsonl goes
+            out.flush()
+            os.fsync(out.fileno())
+
+        os.replace(self._path(target) + '.tmp', self._path(target))
+        fsync_dir(self._path(target))
+        return moved
+
+    def _read(self, location: _Location) -> _Record:
+        segment, offset, length, inner, size = location
+        with open(self._path(segment), 'rb') as f:
+            f.seek(offset)
+            block = f.read(length)
+        if segment.endswith('.gz'):
+            block = gzip.decompress(block)
+        return json.loads(block[inner:inner + size])
+
+    def _scan(self) -> list[_Record]:
+        records: list[_Record] = []
+        names = set(os.listdir(self.directory))
+        for segment in sorted(names):
+            if segment.endswith('.jsonl.gz'):
+                opener: Any = gzip.open
+            elif segment.endswith('.jsonl') and segment + '.gz' not in names:
+                opener = open
+            else:
+                continue
+            try:
+                with opener(self._path(segment), 'rb') as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            break
+            except FileNotFoundError:
+                continue  # rotated since listdir()
+        return records
+
+    async def scan(self) -> list[_Record]:
+        """Every archived record, oldest first. Reads the whole archive."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._scan)
+
+    async def get(self, answer_id: str) -> Optional[_Record]:
+        """The archived record for an answer id."""
+        loop = asyncio.get_running_loop()
+        for _ in range(2):
+            location = self.index.get(f'id:{answer_id}')
+            if location is None:
+                return None
+            try:
+                return await loop.run_in_executor(None, self._read, tuple(location))
+            except FileNotFoundError:
+                continue  # rotated while we were reading, look it up again
+        return None
+
+    async def by_irr(self, irr_num: int) -> Optional[_Record]:
+        answer_id = self.index.get(f'irr:{irr_num}')
+        return None if answer_id is None else await self.get(answer_id)
+
+    async def by_user(self, user_id: int) -> list[_Record]:
+        records = await asyncio.gather(
+            *(self.get(id) for id in self.index.get(f'user:{user_id}', [])))
+        return [record for record in records if record is not None]
+
+
+async def show(args: argparse.Namespace) -> None:
+    archive = Archive(args.directory)
+    if args.irr is not None:
+        records = [await archive.by_irr(args.irr)]
+    elif args.id is not None:
+        records = [await archive.get(args.id)]
+    else:
+        records = await archive.by_user(args.user)
+    await archive.index.close()
+    for record in records:
+        if record is not None:
+            print(json.dumps(record, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Look up archived IRRs.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('show', help='Print archived records.')
+    cmd.add_argument('--directory', default='archive')
+    which = cmd.add_mutually_exclusive_group(required=True)
+    which.add_argument('--irr', type=int, help='IRR number')
+    which.add_argument('--id', help='answer id')
+    which.add_argument('--user', type=int, help='user id of the submitter')
+    args = parser.parse_args()
+    asyncio.run(show(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,28 +4,86 @@ from discord import app_commands
 import discord
 
 from utils import (
+    StartupProfile,
+    Config,
     Color,
 )
+from cache import Resolver
+from metrics import metrics
+from watchdog import (
+    custom_id,
+    watchdog,
+)
 
 import aiohttp
 
+from collections import Counter
+import hashlib
 import logging
+import types
+import time
+import json
 
 from typing import (
     TYPE_CHECKING,
 )
 if TYPE_CHECKING:
     from typing import (
+        NotRequired,
+        TypedDict,
+        Coroutine,
+        Callable,
         Optional,
+        Literal,
+        Any,
     )
     from typing_extensions import (
         Self,
     )
 
+    class _Gateway(TypedDict):
+        profile: Literal['full', 'lean']
+        member_cache_size: NotRequired[int]
+
 
 log = logging.getLogger(__name__)
 
 
+def _code(code: types.CodeType) -> list[Any]:
+    consts = [
+        _code(const) if isinstance(const, types.CodeType)
+        else sorted(map(repr, const)) if isinstance(const, frozenset)
+        else repr(const)
+        for const in code.co_consts
+    ]
+    return [code.co_code.hex(), code.co_names, consts]
+
+
+def check_fingerprint(check: Any) -> Any:
+    """What a check does: its code and the values it closes over.
+
+    Checks mostly come from factories like can_run_command(), so every
+    predicate one makes has the same __qualname__. Two made from different
+    code, or with different arguments, still differ here.
+    """
+    code = getattr(check, '__code__', None)
+    if code is None:
+        return f'{type(check).__module__}.{type(check).__qualname__}'
+    cells = []
+    for cell in check.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:  # not assigned yet
+            value = None
+        if callable(value) and hasattr(value, '__code__'):
+            cells.append(check_fingerprint(value))
+        elif value is None or isinstance(value, (bool, int, float, str, tuple)):
+            cells.append(repr(value))
+        else:
+            cells.append(type(value).__qualname__)
+    return [check.__qualname__, _code(code), cells]
+
+
 class Bot(commands.Bot):
     user: discord.User
     session: aiohttp.ClientSession
@@ -34,12 +92,45 @@ class Bot(commands.Bot):
     def __init__(
         self,
         owner_ids: list[int],
+        gateway: Optional[_Gateway] = None,
+        startup: Optional[StartupProfile] = None,
+        guild_ids: Optional[list[int]] = None,
     ) -> None:
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
+        self.session: aiohttp.ClientSession = aiohttp.ClientSession(
+            trace_configs=[metrics.trace_config()])
         self.cog_names: tuple[str, ...] = (
             'cogs.admin',
             'cogs.questionnaire',
+            'cogs.irr',
         )
+        gateway = gateway or {'profile': 'full'}
+        self.gateway_profile: str = gateway.get('profile', 'full')
+        self.gateway_events: Counter[str] = Counter()
+        self.gateway_since: float = time.monotonic()
+        # For health.py: whether the websocket is up, and since when
+        self.gateway_connected: bool = False
+        self.gateway_changed: float = time.monotonic()
+        self.setup_done: bool = False
+        self.resolver: Resolver = Resolver(
+            member_cache_size=gateway.get('member_cache_size', 1000))
+        # Only set for main.py --profile-startup
+        self.startup: Optional[StartupProfile] = startup
+        self.connect_started: float = 0.0
+        # Guilds to sync guild-only app commands to, see sync_commands()
+        self.guild_ids: list[int] = guild_ids or []
+        self.command_hashes: Config[str] = Config('command_sync.json')
+
+        if self.gateway_profile == 'lean':
+            # Component interactions and the guild/channel cache are all the
+            # bot needs. Members are fetched on demand, see Resolver.member().
+            options = dict(
+                intents=discord.Intents(guilds=True),
+                member_cache_flags=discord.MemberCacheFlags.none(),
+                chunk_guilds_at_startup=False,
+            )
+        else:
+            options = dict(intents=discord.Intents.all())
+
         super().__init__(
             command_prefix=self.get_prefixes,
             activity=discord.Activity(
@@ -47,12 +138,13 @@ class Bot(commands.Bot):
             status=discord.Status.online,
             help_command=None,
             strip_after_prefix=True,
-            intents=discord.Intents.all(),
             case_insensitive=True,
             owner_ids=set(owner_ids),
-            sync_commands=True,
+            http_trace=metrics.trace_config(),
+            **options,
         )
         self.tree.on_error = self.on_app_command_error
+        metrics.gateway_latency.set_function(lambda: self.latency)
 
     def get_prefixes(self, bot: commands.Bot, message: discord.Message) -> list[str]:
         return ['!']
@@ -60,14 +152,123 @@ class Bot(commands.Bot):
     async def load(self, re: bool = False) -> None:
         func = self.reload_extension if re else self.load_extension
         for cog_name in self.cog_names:
+            start = time.perf_counter()
             await func(cog_name)
+            if self.startup is not None and not re:
+                self.startup.add(f'cogs:{cog_name}', time.perf_counter() - start, detail=True)
         log.info('Cogs (re)loaded')
 
+    async def login(self, token: str) -> None:
+        # setup_hook() runs inside login(), its phases are counted separately
+        start = time.perf_counter()
+        await super().login(token)
+        if self.startup is not None:
+            inside = sum(self.startup.phases.get(name, 0.0) for name in ('cogs', 'command sync'))
+            self.startup.add('login', time.perf_counter() - start - inside)
+        self.connect_started = time.perf_counter()
+
     async def setup_hook(self) -> None:
+        start = time.perf_counter()
         await self.load()
+        if self.startup is not None:
+            self.startup.add('cogs', time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await self.sync_commands()
+        if self.startup is not None:
+            self.startup.add('command sync', time.perf_counter() - start)
         self.app_info = self.application or await self.application_info()
         self.owner: discord.User = self.app_info.owner
         log.info(f'Logged in as {self.user} (ID: {self.user.id})')
+        self.setup_done = True
+
+    def command_hash(self, guild: Optional[discord.abc.Snowflake] = None) -> str:
+        """Hash of the app commands as Discord sees them, plus their checks.
+
+        Without a guild this covers the global commands.
+        """
+        payload: list[Any] = []
+        for command in sorted(self.tree.get_commands(guild=guild), key=lambda c: c.name):
+            try:
+                data = command.to_dict(self.tree)  # type: ignore
+            except TypeError:
+                data = command.to_dict()  # discord.py < 2.4
+            # Checks run locally, but a changed check still deserves a sync
+            data['checks'] = {
+                cmd.qualified_name: [check_fingerprint(check)
+                                     for check in getattr(cmd, 'checks', ())]
+                for cmd in (command, *getattr(command, 'walk_commands', tuple)())
+            }
+            payload.append(data)
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    async def sync_commands(self, force: bool = False) -> dict[str, bool]:
+        """Syncs the app commands that changed since they were last synced.
+
+        Global commands are synced globally, and each guild in guild_ids
+        gets its guild-only commands. Globals are not copied into the
+        guilds as well, or members would see every command twice. The hash
+        of what was last synced to each scope is kept in command_sync.json,
+        so a plain restart costs no sync at all. Returns whether each scope,
+        'global' or a guild id, was synced.
+        """
+        synced: dict[str, bool] = {}
+        scopes = [('global', None), *((str(id), discord.Object(id=id)) for id in self.guild_ids)]
+        for scope, guild in scopes:
+            start = time.perf_counter()
+            digest = self.command_hash(guild)
+            if not force and self.command_hashes.get(scope) == digest:
+                log.info(f'Commands for {scope} unchanged ({digest[:12]}), '
+                         f'skipped sync in {(time.perf_counter() - start) * 1000:.1f}ms')
+                synced[scope] = False
+                continue
+            commands = await self.tree.sync(guild=guild)
+            await self.command_hashes.put(scope, digest)
+            log.info(f'Synced {len(commands)} commands to {scope} '
+                     f'({digest[:12]}{", forced" if force else ""}) '
+                     f'in {(time.perf_counter() - start) * 1000:.1f}ms')
+            synced[scope] = True
+        return synced
+
+    # Every listener and event handler is run through here by discord.py
+    async def _run_event(
+        self,
+        coro: Callable[..., Coroutine[Any, Any, Any]],
+        event_name: str,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        interaction = args[0] if args and isinstance(args[0], discord.Interaction) else None
+        async with watchdog.track(
+                getattr(coro, '__qualname__', event_name),
+                custom_id(interaction) if interaction is not None else None):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def on_ready(self) -> None:
+        if self.startup is None:
+            return
+        self.startup.add('gateway READY', time.perf_counter() - self.connect_started)
+        print(self.startup.report())
+        self.startup = None
+        await self.close()
+
+    def set_connected(self, connected: bool) -> None:
+        if connected != self.gateway_connected:
+            self.gateway_connected = connected
+            self.gateway_changed = time.monotonic()
+
+    async def on_connect(self) -> None:
+        self.set_connected(True)
+
+    async def on_resumed(self) -> None:
+        self.set_connected(True)
+
+    async def on_disconnect(self) -> None:
+        self.set_connected(False)
+
+    async def on_socket_event_type(self, event_type: str) -> None:
+        self.gateway_events[event_type] += 1
 
     async def on_command_error(self, ctx: commands.Context[Self], error: Exception) -> None:
         if isinstance(error, commands.CheckFailure):
@@ -0,0 +1,180 @@
+# cache.py - Caches for things the bot looks up over and over
+#
+# AsyncCache is a size-bounded LRU cache whose entries expire after a TTL.
+# Concurrent misses for the same key share a single lookup. Resolver puts
+# one of these in front of each of the Discord lookups the cogs make.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import discord
+
+from collections import OrderedDict
+import asyncio
+import time
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import (
+        Awaitable,
+        Callable,
+        Optional,
+        Hashable,
+        Generic,
+        TypeVar,
+        Any,
+    )
+
+    _V = TypeVar('_V')
+else:
+    Generic = (object,)
+    _V = 0
+
+
+__all__ = (
+    'AsyncCache',
+    'Resolver',
+)
+
+
+class AsyncCache(Generic[_V]):
+    """LRU cache with a TTL and single-flight loading.
+
+    :meth:`get` returns the cached value for ``key`` or awaits ``load()`` to
+    get it. While a load is running, other callers asking for the same key
+    wait for it instead of starting their own.
+
+    A ``None`` from ``load()`` is kept for ``negative_ttl`` seconds instead
+    (``ttl`` if not given), and not at all if that is 0.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1000, ttl: float = 300.0,
+                 negative_ttl: Optional[float] = None) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._data: OrderedDict[Hashable, tuple[float, _V]] = OrderedDict()
+        self._loading: dict[Hashable, asyncio.Future[_V]] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.shared: int = 0  # misses that piggybacked on another's load
+        self.evictions: int = 0
+
+    def __class_getitem__(cls, item: Any) -> Any:
+        return cls
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def peek(self, key: Hashable) -> Optional[_V]:
+        """The cached value, or None. Doesn't touch the counters."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: Hashable, value: _V) -> None:
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable[_V]]) -> _V:
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self.hits += 1
+                self._data.move_to_end(key)
+                return entry[1]
+            del self._data[key]
+
+        if key in self._loading:
+            self.shared += 1
+            return await asyncio.shield(self._loading[key])
+
+        self.misses += 1
+        future: asyncio.Future[_V] = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # nobody else may be waiting
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._loading[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'evictions': self.evictions,
+        }
+
+
+class Resolver:
+    """Cached lookups of members, emoji and forum tags."""
+
+    def __init__(self, member_cache_size: int = 1000, member_ttl: float = 600.0) -> None:
+        self.members: AsyncCache[Optional[discord.Member]] = AsyncCache(
+            'members', maxsize=member_cache_size, ttl=member_ttl)
+        self.emojis: AsyncCache[discord.Emoji] = AsyncCache(
+            'emojis', maxsize=64, ttl=3600.0)
+        # A missing tag is looked up in the channel's own cache, which is
+        # free, and could be created any minute; so misses aren't kept
+        self.tags: AsyncCache[Optional[discord.ForumTag]] = AsyncCache(
+            'forum_tags', maxsize=64, ttl=3600.0, negative_ttl=0.0)
+
+    @property
+    def caches(self) -> tuple[AsyncCache[Any], ...]:
+        return (self.members, self.emojis, self.tags)
+
+    async def member(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        """The member from the gateway cache, falling back to the API.
+
+        Users who left the guild are cached as None.
+        """
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+
+        async def load() -> Optional[discord.Member]:
+            try:
+                return await guild.fetch_member(user_id)
+            except discord.NotFound:
+                return None
+        return await self.members.get((guild.id, user_id), load)
+
+    async def nickname(self, guild: discord.Guild, user_id: int) -> Optional[str]:
+        member = await self.member(guild, user_id)
+        return member.display_name if member is not None else None
+
+    async def emoji(self, guild: discord.Guild, emoji_id: int) -> discord.Emoji:
+        return await self.emojis.get(
+            (guild.id, emoji_id), lambda: guild.fetch_emoji(emoji_id))
+
+    async def forum_tag(self, forum: discord.ForumChannel, tag_id: int) -> Optional[discord.ForumTag]:
+        async def load() -> Optional[discord.ForumTag]:
+            return forum.get_tag(tag_id)
+        return await self.tags.get((forum.id, tag_id), load)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {cache.name: cache.stats() for cache in self.caches}
@@ -9,40 +9,81 @@ from __future__ import annotations
 import discord
 from discord.ext import commands
 from discord import app_commands
-from main import config
+from settings import settings
+from watchdog import watchdog
+
+import logging
+import time
 
 from utils import (
     text_admin_only,
+    rss_bytes,
 )
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from bot import Bot
 
+log = logging.getLogger(__name__)
+
+config = settings.config
+
+
+# For the commands' error handlers, here and in cogs/irr.py. /sync and
+# /reload defer before doing any work, so by the time they fail the
+# response has been used.
+async def command_error(inter: discord.Interaction, command: str,
+                        error: app_commands.AppCommandError) -> None:
+    if isinstance(error, app_commands.CheckFailure):
+        message = f'You do not have permission to run the `/{command}` command.'
+    else:
+        log.error(f'/{command} failed', exc_info=error)
+        original = getattr(error, 'original', error)
+        message = f'`/{command}` failed: {type(original).__name__}: {original}'
+    if inter.response.is_done():
+        await inter.followup.send(message, ephemeral=True)
+    else:
+        await inter.response.send_message(message, ephemeral=True)
+
+
+# Check if the user has the admin_role. cogs/irr.py uses this one too.
+def can_run_command():
+    def predicate(inter : discord.Interaction):
+        role = discord.utils.find(
+            lambda r: r.name == config['admin_role'], inter.guild.roles
+        )
+        if role in inter.user.roles:
+            return True
+    return app_commands.check(predicate)
+
 
 class Admin(commands.Cog):
 
     def __init__(self, bot: commands.Bot) -> None:
         self.bot: Bot = bot
 
-    # Check if the user has the admin_role
-    def can_run_command():
-        def predicate(inter : discord.Interaction):
-            role = discord.utils.find(
-                lambda r: r.name == config['admin_role'], inter.guild.roles
-            )
-            if role in inter.user.roles:
-                return True
-        return app_commands.check(predicate)
-
+    # Config files are also reloaded automatically when they change, see
+    # settings.Watcher. Reloading the cogs drops every questionnaire in
+    # progress, so only do that for code changes.
     @app_commands.command(
         name        = 'reload',
-        description = 'Reloads the RRC bot.',
+        description = 'Reloads the config files, and optionally the cogs.',
     )
+    @app_commands.describe(cogs='Also reload the code (drops questionnaires in progress)')
     @can_run_command()
-    async def reload(self, inter: discord.Interaction) -> None:
-        await self.bot.load(re=True)
-        await ctx.send(embed=self.bot.embed('Successfully reloaded.'))
+    async def reload(self, inter: discord.Interaction, cogs: bool = False) -> None:
+        await inter.response.defer(ephemeral=True)
+        results = await settings.refresh()
+        if cogs:
+            await self.bot.load(re=True)
+        embed = self.bot.embed(
+            title='Reloaded',
+            description='\n'.join(
+                f'`{name}`: ' + ('OK' if error is None else f'**not reloaded**, {error}')
+                for name, error in results.items())
+                + ('\nCogs reloaded.' if cogs else ''),
+        )
+        await inter.followup.send(embed=embed, ephemeral=True)
 
 
     @app_commands.command(
@@ -53,7 +94,7 @@ class Admin(commands.Cog):
     @can_run_command()
     async def sendbutton(self, inter: discord.Interaction) -> None:
         view = discord.ui.View(timeout=0.01)
-        emoji = await inter.guild.fetch_emoji(config['protest_emoji_id'])
+        emoji = await self.bot.resolver.emoji(inter.guild, config['protest_emoji_id'])
         view.add_item(discord.ui.Button(
             label='File a Protest (IRR)',
             style=discord.ButtonStyle.blurple,
@@ -64,6 +105,22 @@ class Admin(commands.Cog):
         await inter.response.send_message(embed=embed, view=view)
 
 
+    # Startup only syncs commands when they changed. This is for when
+    # Discord's copy got out of step anyway.
+    @app_commands.command(
+        name        = 'sync',
+        description = 'Pushes the bot\'s slash commands to Discord.',
+    )
+    @can_run_command()
+    async def sync(self, inter: discord.Interaction) -> None:
+        await inter.response.defer(ephemeral=True)
+        start = time.perf_counter()
+        synced = await self.bot.sync_commands(force=True)
+        await inter.followup.send(embed=self.bot.embed(
+            f'Synced {", ".join(f"`{scope}`" for scope in synced)} commands in '
+            f'{(time.perf_counter() - start) * 1000:.0f}ms.'), ephemeral=True)
+
+
     # Prints out a list of all tags for the configured forum.
     # Use these to set up the tag logic
     @app_commands.command(
@@ -82,28 +139,62 @@ class Admin(commands.Cog):
         )
         await inter.response.send_message(embed=embed)
 
-    # TODO refactor
+    # Gateway profile, memory use and how many events Discord has sent us.
+    # Run it under both gateway profiles to compare them.
+    @app_commands.command(
+        name        = "gateway",
+        description = "Show gateway traffic, memory use and event loop lag.",
+    )
+    @can_run_command()
+    async def gateway(self, inter: discord.Interaction) -> None:
+        minutes = max((time.monotonic() - self.bot.gateway_since) / 60, 1 / 60)
+        events = self.bot.gateway_events
+        lag, max_lag = watchdog.lag()
+        embed = self.bot.embed(
+            title='Gateway',
+            description=f'Profile: **{self.bot.gateway_profile}**\n'
+                        f'RSS: **{rss_bytes() / 2**20:.1f} MiB**\n'
+                        f'Loop lag: **{lag * 1000:.1f}ms** '
+                        f'(max **{max_lag * 1000:.1f}ms** in the last minute)\n'
+                        f'Cached users: **{len(self.bot.users)}**\n'
+                        f'Events: **{sum(events.values())}** '
+                        f'({sum(events.values()) / minutes:.1f}/min)',
+        )
+        embed.add_field(
+            name='Busiest events',
+            value='\n'.join(f'`{name}`: {count} ({count / minutes:.1f}/min)'
+                            for name, count in events.most_common(10)) or 'None yet.',
+            inline=False,
+        )
+        embed.add_field(
+            name='Resolver caches',
+            value='\n'.join(
+                f'`{name}`: {stats["size"]} cached, {stats["hits"]} hits, '
+                f'{stats["misses"]} misses, {stats["shared"]} shared'
+                for name, stats in self.bot.resolver.stats().items()),
+            inline=False,
+        )
+        await inter.response.send_message(embed=embed, ephemeral=True)
 
     @sendbutton.error
     async def sendbutton_error(self, inter: discord.Interaction, error):
-        await inter.response.send_message(
-            "You do not have permission to run the `/sendbutton` command.",
-            ephemeral=True
-        )
+        await command_error(inter, 'sendbutton', error)
 
     @forumtags.error
     async def forumtags_error(self, inter: discord.Interaction, error):
-        await inter.response.send_message(
-            "You do not have permission to run the `/forumtags` command.",
-            ephemeral=True
-        )
+        await command_error(inter, 'forumtags', error)
+
+    @gateway.error
+    async def gateway_error(self, inter: discord.Interaction, error):
+        await command_error(inter, 'gateway', error)
+
+    @sync.error
+    async def sync_error(self, inter: discord.Interaction, error):
+        await command_error(inter, 'sync', error)
 
     @reload.error
     async def reload_cmd_error(self, inter: discord.Interaction, error):
-        await inter.response.send_message(
-            "You do not have permission to run the `/reload` command.",
-            ephemeral=True
-        )
+        await command_error(inter, 'reload', error)
 
 async def setup(bot: Bot) -> None:
     await bot.add_cog(Admin(bot))
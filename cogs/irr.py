@@ -0,0 +1,572 @@
+# irr.py - Steward commands for looking back through IRRs
+#
+# /irr search finds earlier IRRs by driver, track, series, submitter or
+# status, and /irr stats summarizes the decisions made so far. Neither
+# touches answers.json or the archive: an inverted index and a set of
+# running aggregates are kept up to date from the irr_submitted, irr_edited
+# and irr_decided events that cogs/questionnaire.py dispatches.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import discord
+from discord.ext import commands
+from discord import app_commands
+from settings import settings
+
+from collections import defaultdict
+import asyncio
+import bisect
+import heapq
+import logging
+import time
+import re
+
+from cogs.admin import (
+    can_run_command,
+    command_error,
+)
+from utils import Config
+from storage import (
+    question_answer,
+    open_store,
+)
+
+# Optional and Literal are needed at runtime, discord.py reads the command
+# signatures to build the slash command options.
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+    Literal,
+)
+if TYPE_CHECKING:
+    from bot import Bot
+    from archive import _Record
+    from cogs.questionnaire import _Answer
+    from storage import SQLiteConfig
+
+    from typing import (
+        NotRequired,
+        TypedDict,
+        Any,
+    )
+
+    Status = Literal['pending', 'approved', 'rejected']
+
+    # One IRR as the index sees it, stored in irr_index.json
+    class _Doc(TypedDict):
+        id: str
+        user_id: int
+        epoch: int
+        series: str
+        track: str
+        driver: str
+        status: Status
+        irr_num: NotRequired[int]
+        thread_id: NotRequired[int]
+
+    class _Quantile(TypedDict):
+        p: float
+        count: int
+        heights: list[float]
+        positions: list[int]
+
+    # Everything /irr stats shows, stored in irr_stats.json.
+    # [approved, rejected] pairs are keyed by series or sim name.
+    class _Stats(TypedDict):
+        series: dict[str, list[int]]
+        sims: dict[str, list[int]]
+        drivers: dict[str, list[Any]]   # folded name: [count, name as typed]
+        decision_count: int
+        decision_seconds: int
+        decision_median: _Quantile
+        decision_p90: _Quantile
+
+log = logging.getLogger(__name__)
+
+config = settings.config
+
+# Free-text fields and the question each comes from. Question numbers are
+# hard-coded the same way as storage.ANSWER_COLUMNS.
+TEXT_FIELDS = {
+    'series': question_answer(0),
+    'track': question_answer(1),
+    'driver': question_answer(3),
+}
+
+# Fields that are matched exactly rather than by word
+EXACT_FIELDS = ('user_id', 'status')
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    return WORD.findall((text or '').casefold())
+
+
+def make_doc(answer: Any, status: Status = 'pending') -> _Doc:
+    doc: _Doc = {
+        'id': answer['id'],
+        'user_id': answer['user_id'],
+        'epoch': answer['epoch'],
+        'status': status,
+        **{field: extract(answer) or '' for field, extract in TEXT_FIELDS.items()},
+    }  # type: ignore
+    return doc
+
+
+class SearchIndex:
+    """Inverted index over every IRR's searchable fields.
+
+    Maps (field, word) to the ids of the IRRs containing that word, so a
+    search costs one set lookup per word instead of a scan. A word in a
+    query also matches longer words starting with it ("spa" finds
+    "spa-francorchamps"), using a sorted word list per field.
+
+    Only the documents are persisted; the postings are rebuilt from them
+    by load() when the cog loads.
+    """
+
+    def __init__(self, store: Config[_Doc] | SQLiteConfig[_Doc]) -> None:
+        self.store = store
+        self.docs: dict[str, _Doc] = {}
+        self.postings: dict[str, defaultdict[Any, set[str]]] = {
+            field: defaultdict(set) for field in (*TEXT_FIELDS, *EXACT_FIELDS)}
+        # Sorted words per text field, rebuilt lazily after changes
+        self.words: dict[str, Optional[list[str]]] = {field: None for field in TEXT_FIELDS}
+
+    async def load(self) -> None:
+        for doc in (await self.store.scan()).values():
+            self._add(doc)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def _keys(self, doc: _Doc) -> list[tuple[str, Any]]:
+        keys = [(field, doc[field]) for field in EXACT_FIELDS]  # type: ignore
+        for field in TEXT_FIELDS:
+            keys.extend((field, word) for word in tokenize(doc[field]))  # type: ignore
+        return keys
+
+    def _add(self, doc: _Doc) -> None:
+        self.docs[doc['id']] = doc
+        for field, key in self._keys(doc):
+            if field in self.words and key not in self.postings[field]:
+                self.words[field] = None
+            self.postings[field][key].add(doc['id'])
+
+    def _discard(self, doc: _Doc) -> None:
+        del self.docs[doc['id']]
+        for field, key in self._keys(doc):
+            ids = self.postings[field].get(key)
+            if ids is None:
+                continue
+            ids.discard(doc['id'])
+            if not ids:
+                del self.postings[field][key]
+                if field in self.words:
+                    self.words[field] = None
+
+    async def update(self, answer: Any, **changes: Any) -> None:
+        """Indexes a new or edited answer. ``changes`` go on top."""
+        old = self.docs.get(answer['id'])
+        doc = make_doc(answer, status=old['status'] if old else 'pending')
+        for key in ('irr_num', 'thread_id'):
+            if old and key in old:
+                doc[key] = old[key]  # type: ignore
+        doc.update(changes)  # type: ignore
+        if old is not None:
+            self._discard(old)
+        self._add(doc)
+        await self.store.put(doc['id'], doc, wait=False)
+
+    def _lookup(self, field: str, prefix: str) -> set[str]:
+        words = self.words[field]
+        if words is None:
+            words = self.words[field] = sorted(self.postings[field])
+        ids: set[str] = set()
+        for i in range(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix):
+                break
+            ids |= self.postings[field][words[i]]
+        return ids
+
+    def search(
+        self,
+        limit: int = 10,
+        user_id: Optional[int] = None,
+        status: Optional[Status] = None,
+        **text: Optional[str],
+    ) -> tuple[int, list[_Doc]]:
+        """The number of matching IRRs, and the newest ``limit`` of them."""
+        matches: Optional[set[str]] = None
+        sets: list[set[str]] = []
+        for field, value in (('user_id', user_id), ('status', status)):
+            if value is not None:
+                sets.append(self.postings[field].get(value, set()))
+        for field, value in text.items():
+            sets.extend(self._lookup(field, word) for word in tokenize(value))
+
+        # Intersect smallest first, so it only gets cheaper
+        for ids in sorted(sets, key=len):
+            matches = set(ids) if matches is None else matches & ids
+            if not matches:
+                return 0, []
+        docs = self.docs.values() if matches is None else \
+            [self.docs[id] for id in matches]
+        return len(docs), heapq.nlargest(limit, docs, key=lambda doc: doc['epoch'])
+
+    def values(self, field: str) -> list[str]:
+        """Every distinct value of a text field, for autocomplete."""
+        return sorted({doc[field] for doc in self.docs.values()})  # type: ignore
+
+
+class P2Quantile:
+    """Streaming estimate of the p-quantile, using the P² algorithm.
+
+    Five markers track the minimum, p/2, p, (1+p)/2 and the maximum, and
+    are nudged along a parabola as observations arrive, so the state stays
+    the same size however many values go in. See Jain & Chlamtac, "The P²
+    algorithm for dynamic calculation of quantiles and histograms without
+    storing observations", CACM 28(10), 1985.
+    """
+
+    def __init__(self, p: float, state: Optional[_Quantile] = None) -> None:
+        self.p = p
+        self.count: int = 0
+        self.heights: list[float] = []
+        self.positions: list[int] = []
+        if state is not None:
+            self.count = state['count']
+            self.heights = list(state['heights'])
+            self.positions = list(state['positions'])
+
+    def state(self) -> _Quantile:
+        return {
+            'p': self.p,
+            'count': self.count,
+            'heights': list(self.heights),
+            'positions': list(self.positions),
+        }
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        q, n = self.heights, self.positions
+        if self.count <= 5:
+            bisect.insort(q, x)
+            if self.count == 5:
+                n[:] = [1, 2, 3, 4, 5]
+            return
+
+        if x < q[0]:
+            q[0] = x
+        elif x > q[4]:
+            q[4] = x
+        k = min(max(bisect.bisect_right(q, x) - 1, 0), 3)
+        for i in range(k + 1, 5):
+            n[i] += 1
+
+        p, total = self.p, self.count - 1
+        desired = (0, total * p / 2, total * p, total * (1 + p) / 2, total)
+        for i in (1, 2, 3):
+            d = desired[i] + 1 - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0 else -1
+                parabolic = q[i] + step / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] += step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                n[i] += step
+
+    def value(self) -> Optional[float]:
+        if not self.heights:
+            return None
+        if self.count < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+
+def fold(name: str) -> str:
+    return ' '.join(tokenize(name))
+
+
+def duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return 'n/a'
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f'{minutes}m'
+    if minutes < 24 * 60:
+        return f'{minutes // 60}h {minutes % 60}m'
+    return f'{minutes // (24 * 60)}d {minutes // 60 % 24}h'
+
+
+class Stats:
+    """Running totals of every decision, for /irr stats.
+
+    Each decision updates a handful of counters and two P² estimators,
+    so answering /irr stats never reads the history. The state is a few
+    kilobytes, saved to a JSON :class:`Config` with a commit window.
+
+    Protested drivers are counted with the Space-Saving algorithm in at
+    most ``drivers`` entries: a new name takes the place of the least
+    protested one, starting from its count. Counts can be too high by up
+    to that inherited amount, but any driver with more than
+    1/``drivers`` of all decisions is always in the table.
+    """
+
+    def __init__(self, store: Config[_Stats], drivers: int = 200) -> None:
+        self.store = store
+        self.capacity = drivers
+        state = store.get('stats')
+        self.series: dict[str, list[int]] = state['series'] if state else {}
+        self.sims: dict[str, list[int]] = state['sims'] if state else {}
+        self.drivers: dict[str, list[Any]] = dict(heapq.nlargest(
+            drivers, state['drivers'].items(), key=lambda item: item[1][0])) if state else {}
+        self.decision_count: int = state['decision_count'] if state else 0
+        self.decision_seconds: int = state['decision_seconds'] if state else 0
+        self.median = P2Quantile(0.5, state['decision_median'] if state else None)
+        self.p90 = P2Quantile(0.9, state['decision_p90'] if state else None)
+
+    def __len__(self) -> int:
+        return self.decision_count
+
+    def state(self) -> _Stats:
+        return {
+            'series': self.series,
+            'sims': self.sims,
+            'drivers': self.drivers,
+            'decision_count': self.decision_count,
+            'decision_seconds': self.decision_seconds,
+            'decision_median': self.median.state(),
+            'decision_p90': self.p90.state(),
+        }
+
+    async def add(self, record: _Record, sim: str) -> None:
+        column = 0 if record['result'] == 'approved' else 1
+        series = question_answer(0)(record['answer']) or 'Unknown'
+        self.series.setdefault(series, [0, 0])[column] += 1
+        self.sims.setdefault(sim, [0, 0])[column] += 1
+
+        driver = question_answer(3)(record['answer']) or ''
+        if fold(driver):
+            self.count_driver(fold(driver), driver)
+
+        seconds = max(record['decided'] - record['answer']['epoch'], 0)
+        self.decision_count += 1
+        self.decision_seconds += seconds
+        self.median.add(seconds)
+        self.p90.add(seconds)
+        await self.store.put('stats', self.state(), wait=False)
+
+    def count_driver(self, key: str, name: str) -> None:
+        entry = self.drivers.get(key)
+        if entry is None:
+            count = 0
+            if len(self.drivers) >= self.capacity:
+                least = min(self.drivers, key=lambda other: self.drivers[other][0])
+                count = self.drivers.pop(least)[0]
+            entry = self.drivers[key] = [count, name]
+        entry[0] += 1
+        entry[1] = name
+
+    @property
+    def approved(self) -> int:
+        return sum(approved for approved, _ in self.sims.values())
+
+    @property
+    def rejected(self) -> int:
+        return sum(rejected for _, rejected in self.sims.values())
+
+    def top_drivers(self, count: int = 10) -> list[tuple[str, int]]:
+        top = heapq.nlargest(count, self.drivers.values(), key=lambda entry: entry[0])
+        return [(name, total) for total, name in top]
+
+
+class IRR(commands.Cog):
+
+    irr = app_commands.Group(name='irr', description='Look back through IRRs.')
+
+    def __init__(self, bot: Bot) -> None:
+        self.bot: Bot = bot
+        self.index: SearchIndex = SearchIndex(
+            open_store('irr_index.json', config.get('storage')))
+        self.stats: Stats = Stats(Config('irr_stats.json', commit_window=5.0))
+        self.seeding: Optional[asyncio.Task[None]] = None
+        # Answer ids decided while seeding, so seed() doesn't count them again
+        self.decided_live: set[str] = set()
+
+    async def cog_load(self) -> None:
+        await self.index.load()
+        # Decided here, before any irr_decided event can be counted
+        index, stats = len(self.index) == 0, len(self.stats) == 0
+        if index or stats:
+            self.seeding = asyncio.create_task(self.seed(index=index, stats=stats))
+
+    async def cog_unload(self) -> None:
+        if self.seeding is not None:
+            self.seeding.cancel()
+        await self.index.store.close()
+        await self.stats.store.close()
+
+    # First run: index the pending answers and everything archived so far,
+    # and total up the archived decisions
+    async def seed(self, index: bool, stats: bool) -> None:
+        questionnaire: Any = self.bot.get_cog('Cog')
+        if questionnaire is None:
+            return
+        start = time.perf_counter()
+        try:
+            for record in await questionnaire.archive.scan():
+                if index:
+                    await self.index_decision(record)
+                if stats and record['answer']['id'] not in self.decided_live:
+                    await self.stats.add(record, sim=self.sim_name(record))
+            if index:
+                for answer in (await questionnaire.answers.scan()).values():
+                    await self.index.update(answer)
+        finally:
+            self.decided_live.clear()
+        log.info(f'Indexed {len(self.index)} IRRs and {len(self.stats)} decisions '
+                 f'in {time.perf_counter() - start:.1f}s')
+
+    def sim_name(self, record: _Record) -> str:
+        questionnaire: Any = self.bot.get_cog('Cog')
+        series = question_answer(0)(record['answer']) or ''
+        name = questionnaire.sim_index[series]['sim_name'] if questionnaire else '*'
+        return 'Other' if name == '*' else name
+
+    @commands.Cog.listener()
+    async def on_irr_submitted(self, answer: _Answer) -> None:
+        await self.index.update(answer)
+
+    @commands.Cog.listener()
+    async def on_irr_edited(self, answer: _Answer) -> None:
+        await self.index.update(answer)
+
+    @commands.Cog.listener()
+    async def on_irr_decided(self, record: _Record) -> None:
+        if self.seeding is not None and not self.seeding.done():
+            self.decided_live.add(record['answer']['id'])
+        await self.index_decision(record)
+        await self.stats.add(record, sim=self.sim_name(record))
+
+    async def index_decision(self, record: _Record) -> None:
+        changes: dict[str, Any] = {'status': record['result']}
+        for key in ('irr_num', 'thread_id'):
+            if key in record:
+                changes[key] = record[key]  # type: ignore
+        await self.index.update(record['answer'], **changes)
+
+    def describe(self, doc: _Doc) -> str:
+        title = f'IRR#{doc["irr_num"]}' if 'irr_num' in doc else doc['status'].title()
+        if 'thread_id' in doc:
+            title = f'[{title}](https://discord.com/channels/' \
+                    f'{config["guild_id"]}/{doc["thread_id"]})'
+        return f'**{title}** <t:{doc["epoch"]}:d> {doc["series"]} › ' \
+               f'{doc["track"]}\n' \
+               f'<@{doc["user_id"]}> protested **{doc["driver"] or "?"}**'
+
+    @irr.command(
+        name        = 'search',
+        description = 'Find earlier IRRs by driver, track, series or submitter.',
+    )
+    @app_commands.describe(
+        driver      = 'Protested driver (any part of the name)',
+        track       = 'Track name',
+        series      = 'Series name',
+        submitter   = 'Who filed the IRR',
+        status      = 'Only IRRs with this outcome',
+    )
+    @can_run_command()
+    async def search(
+        self,
+        inter: discord.Interaction,
+        driver: Optional[str] = None,
+        track: Optional[str] = None,
+        series: Optional[str] = None,
+        submitter: Optional[discord.User] = None,
+        status: Optional[Literal['pending', 'approved', 'rejected']] = None,
+    ) -> None:
+        count, docs = self.index.search(
+            limit=10,
+            user_id=submitter.id if submitter else None,
+            status=status,
+            driver=driver,
+            track=track,
+            series=series,
+        )
+        embed = self.bot.embed(
+            title='IRR Search',
+            description='\n\n'.join(self.describe(doc) for doc in docs)
+                        or 'No IRRs found.',
+        )
+        if count > len(docs):
+            embed.set_footer(text=f'Newest {len(docs)} of {count} matches.')
+        await inter.response.send_message(embed=embed, ephemeral=True)
+
+    @search.autocomplete('series')
+    async def series_autocomplete(
+        self,
+        inter: discord.Interaction,
+        current: str,
+    ) -> list[app_commands.Choice[str]]:
+        current = current.casefold()
+        return [
+            app_commands.Choice(name=value[:100], value=value[:100])
+            for value in self.index.values('series')
+            if current in value.casefold()
+        ][:25]
+
+    @irr.command(
+        name        = 'stats',
+        description = 'Show IRR counts, outcomes and decision times.',
+    )
+    @can_run_command()
+    async def stats_command(self, inter: discord.Interaction) -> None:
+        stats = self.stats
+        approved, rejected = stats.approved, stats.rejected
+        decided = max(approved + rejected, 1)
+        pending = len(self.index.postings['status'].get('pending', ()))
+        mean = stats.decision_seconds / stats.decision_count \
+            if stats.decision_count else None
+
+        def outcomes(counts: dict[str, list[int]]) -> str:
+            rows = sorted(counts.items(), key=lambda item: -sum(item[1]))[:10]
+            return '\n'.join(f'{name}: **{a + r}** ({a} approved, {r} rejected)'
+                             for name, (a, r) in rows) or 'None yet.'
+
+        embed = self.bot.embed(
+            title='IRR Stats',
+            description=f'Decided: **{approved + rejected}** '
+                        f'({approved / decided:.0%} approved, '
+                        f'{rejected / decided:.0%} rejected)\n'
+                        f'Pending: **{pending}**\n'
+                        f'Time to decision: median **{duration(stats.median.value())}**, '
+                        f'90% within **{duration(stats.p90.value())}**, '
+                        f'mean {duration(mean)}',
+        )
+        embed.add_field(name='By sim', value=outcomes(stats.sims), inline=False)
+        embed.add_field(name='By series', value=outcomes(stats.series), inline=False)
+        embed.add_field(
+            name='Most protested drivers',
+            value='\n'.join(f'{name}: **{count}**'
+                            for name, count in stats.top_drivers()) or 'None yet.',
+            inline=False,
+        )
+        await inter.response.send_message(embed=embed, ephemeral=True)
+
+    @search.error
+    async def search_error(self, inter: discord.Interaction, error):
+        await command_error(inter, 'irr search', error)
+
+    @stats_command.error
+    async def stats_error(self, inter: discord.Interaction, error):
+        await command_error(inter, 'irr stats', error)
+
+async def setup(bot: Bot) -> None:
+    await bot.add_cog(IRR(bot))
@@ -2,28 +2,53 @@ from __future__ import annotations
 import discord
 from discord.ext import commands
 
-from main import config
+from settings import (
+    ConfigError,
+    settings,
+)
 
 from enum import Enum
+import contextlib
+import functools
+import hashlib
+import asyncio
+import heapq
+import logging
 import time
 import json
 import os
 
+import aiohttp
+
 from utils import (
     text_admin_only,
+    Sequence,
     Config,
     Color,
 )
+from storage import (
+    SQLiteConfig,
+    open_store,
+)
+from archive import Archive
+from logger import log_context
+from metrics import metrics
+from watchdog import watched
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from bot import Bot
+    from archive import _Record
 
     from typing import (
         NotRequired,
         TypedDict,
+        Awaitable,
+        Callable,
+        Optional,
         Literal,
         Self,
+        Any,
     )
 
     class _Question(TypedDict):
@@ -36,35 +61,110 @@ if TYPE_CHECKING:
         max_length: NotRequired[int]
         # type `text_short` and `text_long` REQUIRE this
         placeholder: NotRequired[str]
+        inline: bool
 
-    class _QuestionShort(TypedDict):
-        title: str
-        short: str
+    # A question as it was copied into answers before schema versions
+    class _QuestionShort(_Question):
         answer: str
-        type: Literal['multiple_choice', 'text_short', 'text_long', 'yes_no']
-        choices: NotRequired[list[str]]
 
-    # This class contains a raw IRR submission from answers.json
+    # This class contains a raw IRR submission from answers.json. The
+    # questions live in schemas.json, under the schema's content hash.
     class _Answer(TypedDict):
+        id: str
+        user_id: int
+        epoch: int
+        schema: str
+        answers: list[str]
+        # Only while it's being published, see PublishJob
+        publish: NotRequired[_Publish]
+
+    # How far ForumPublisher got with an approved answer
+    class _Publish(TypedDict):
+        message: Optional[list[int]]  # log message, [channel id, message id]
+        irr_num: Optional[int]
+        thread_id: Optional[int]
+        pinged: bool
+        failed: bool
+
+    # Old-format answers.json entries, upgraded on read
+    class _LegacyAnswer(TypedDict):
         id: str
         user_id: int
         epoch: int
         questions: list[_QuestionShort]
 
+    # A half-finished questionnaire from drafts.json, keyed by user id.
+    # Kept short, it's rewritten on every answer.
+    class _Draft(TypedDict):
+        s: str          # schema version
+        a: list[str]    # answers so far
+        e: int          # expiry, epoch seconds
+
     # This class is just to track the highest IRR number from irr.json
     class _IRR(TypedDict):
         irr_num: int
 
-    # From config/sim_tags.json
+    # From config/sim_tags.json. The entry with sim_name "*" is the
+    # fallback for series that don't belong to any sim, e.g. "Other".
     class _SimTags(TypedDict):
         sim_name: str
-        forum_tag: int
-        role_id: int
-
-with open('config/questions.json', 'r', encoding='utf-8') as file:
-    QUESTIONS: list[_Question] = json.load(file)
-with open('config/sim_tags.json', 'r', encoding='utf-8') as file:
-    SIM_TAGS: list[_SimTags] = json.load(file)
+        forum_tag: Optional[int]
+        role_id: Optional[int]
+
+    Route = Callable[[discord.Interaction[Bot], _Answer, str], Awaitable[None]]
+
+log = logging.getLogger(__name__)
+
+# questions:::<action>[-<answer id>[-<number>]], see Cog.build_routes(), and
+# questionnaire:::<action>-<session id>[-<question index>] for QuestionnaireView.
+# Cog.on_interaction sees every component in the guild, so it only splits off
+# the part before the first '-' and looks it up here; everyone else's
+# components cost one dict miss.
+QUESTIONS_ACTIONS = ('start', 'approve', 'reject', 'edit', 'index_up', 'index_down',
+                     'multiple_choice', 'yes', 'no', 'text')
+QUESTIONNAIRE_ACTIONS = ('start', 'resume', 'restart', 'multiple_choice', 'text', 'yes', 'no')
+# 'questions:::approve' -> ('questions', 'approve', 'questions:approve')
+ROUTES: dict[str, tuple[str, str, str]] = {
+    f'{prefix}:::{action}': (prefix, action, f'{prefix}:{action}')
+    for prefix, actions in (('questions', QUESTIONS_ACTIONS),
+                            ('questionnaire', QUESTIONNAIRE_ACTIONS))
+    for action in actions
+}
+
+config = settings.config
+
+
+def parse_custom_id(custom_id: str) -> Optional[tuple[str, str, str, str]]:
+    """Splits one of our custom ids into prefix, action, id and number.
+
+    Missing parts are ''. Anything that isn't ours gives None.
+    """
+    head, _, args = custom_id.partition('-')
+    route = ROUTES.get(head)
+    if route is None:
+        return None
+    id, _, number = args.partition('-')
+    return route[0], route[1], id, number
+
+
+def handler_name(interaction: discord.Interaction[Bot]) -> str:
+    """What an interaction is for, as a metrics label: /irr search, questions:approve"""
+    data: Any = interaction.data or {}
+    if interaction.type in (discord.InteractionType.application_command,
+                            discord.InteractionType.autocomplete):
+        names = [data.get('name', '?')]
+        options = data.get('options') or []
+        while options and options[0].get('type') in (1, 2):  # subcommand (group)
+            names.append(options[0]['name'])
+            options = options[0].get('options') or []
+        name = '/' + ' '.join(names)
+        if interaction.type == discord.InteractionType.autocomplete:
+            name += ' (autocomplete)'
+        return name
+    route = ROUTES.get(data.get('custom_id', '').partition('-')[0])
+    if route is not None:
+        return route[2]
+    return interaction.type.name
 
 # Handle IRR rejections with reasons
 class RejectionMessage(discord.ui.Modal):
@@ -87,10 +187,15 @@ class RejectionMessage(discord.ui.Modal):
         )
         self.add_item(self.message)
 
+    @watched
     async def on_submit(self, interaction: discord.Interaction[Bot]) -> None:
+        # Someone else may have decided it while this was open
+        answer = await self.cog.decidable(interaction, self.answer['id'])
+        if answer is None:
+            return
         await self.cog.reject_answer(
             interaction = interaction,
-            answer      = self.answer,
+            answer      = answer,
             message     = self.message.value
         )
 
@@ -102,31 +207,50 @@ class AnswerModal(discord.ui.Modal):
         cog: 'Cog',
         interaction: discord.Interaction[Bot],
         view: 'QuestionnaireView | LogView',
-        question: _Question,
-        default: str = '',
+        questions: list[_Question],
+        defaults: Optional[list[str]] = None,
     ) -> None:
         self.bot: Bot = bot
         self.cog: Cog = cog
         self.view: 'QuestionnaireView | LogView' = view
         self.interaction: discord.Interaction[Bot] = interaction
-        self.question: _Question = question
-        super().__init__(timeout=300.0, title=self.question['title'])
-
-        self.answer = discord.ui.TextInput(
-            label       = self.question['short'],  # type: ignore
-            # type: ignore
-            style       = discord.TextStyle.short
-                       if self.question['type'] == 'text_short'
-                     else discord.TextStyle.long,
-            placeholder = self.question['placeholder'],  # type: ignore
-            max_length  = self.question['max_length'],  # type: ignore
-            default     = default,
-            required    = True,
-        )
-        self.add_item(self.answer)
+        self.questions: list[_Question] = questions
+        # Discord limits modal titles to 45 characters
+        title = questions[0]['title'] if len(questions) == 1 else 'Incident Details'
+        super().__init__(timeout=300.0, title=title[:45])
+
+        # Up to five text inputs, answered in order
+        self.answers: list[discord.ui.TextInput[Self]] = []
+        for question, default in zip(questions, defaults or [''] * len(questions)):
+            answer = discord.ui.TextInput(
+                label       = question['short'],  # type: ignore
+                # type: ignore
+                style       = discord.TextStyle.short
+                           if question['type'] == 'text_short'
+                         else discord.TextStyle.long,
+                placeholder = question['placeholder'],  # type: ignore
+                max_length  = question['max_length'],  # type: ignore
+                default     = default,
+                required    = True,
+            )
+            self.answers.append(answer)
+            self.add_item(answer)
 
+    @watched
     async def on_submit(self, interaction: discord.Interaction[Bot]) -> None:
-        await self.view.answer_question(self.answer.value)
+        if isinstance(self.view, LogView):
+            # Don't bring back an answer that was decided while this was
+            # open, and don't undo edits made to its other questions
+            answer = await self.cog.decidable(interaction, self.view.answer['id'])
+            if answer is None:
+                return
+            self.view.answer = answer
+        elif self.cog.sessions.get(self.view.session.user_id, self.view.session.id) is None:
+            # Timed out, or replaced by a newer questionnaire whose draft
+            # this would overwrite
+            return await self.cog.session_expired(interaction)
+        for answer in self.answers:
+            await self.view.answer_question(answer.value)
         await self.view.update(interaction=interaction)
 
 
@@ -134,6 +258,320 @@ class AnswerResult(Enum):
     pending = 0
     approved = 1
     rejected = 2
+    publishing = 3
+    failed = 4  # publishing failed after the forum thread was created
+
+
+class SchemaRegistry:
+    """Interned questionnaire schemas, keyed by a hash of their content.
+
+    Answers store only the schema's hash, so the question texts and choice
+    lists are kept once in schemas.json rather than in every answer. Each
+    schema is loaded at most once and shared by every answer that uses it.
+    """
+
+    def __init__(self, store: Config[list[_Question]] | SQLiteConfig[list[_Question]]) -> None:
+        self.store = store
+        self._schemas: dict[str, list[_Question]] = {}
+
+    @staticmethod
+    def version(questions: list[_Question]) -> str:
+        data = json.dumps(questions, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+    async def intern(self, questions: list[_Question]) -> str:
+        """Registers ``questions`` if needed and returns their version."""
+        version = self.version(questions)
+        if version not in self._schemas:
+            if version not in self.store:
+                await self.store.put(version, questions)
+            self._schemas[version] = questions
+        return version
+
+    def __getitem__(self, version: str) -> list[_Question]:
+        if version not in self._schemas:
+            self._schemas[version] = self.store[version]
+        return self._schemas[version]
+
+
+class SimIndex:
+    """Maps each series choice to its entry in sim_tags.json.
+
+    Built once from the series question (question #0, as in approve_answer)
+    so approvals are a dict lookup. Every choice must map to a sim by its
+    first word, or there must be a "*" fallback entry.
+    """
+
+    def __init__(self, questions: list[_Question], sim_tags: list[_SimTags]) -> None:
+        by_name = {tag['sim_name']: tag for tag in sim_tags}
+        self.fallback: Optional[_SimTags] = by_name.pop('*', None)
+        self.sims: dict[str, _SimTags] = by_name
+        self.series: dict[str, _SimTags] = {}
+
+        missing: list[str] = []
+        for choice in questions[0].get('choices', []):
+            sim = self._match(choice)
+            if sim is None:
+                missing.append(choice)
+            else:
+                self.series[choice] = sim
+        if missing:
+            raise ValueError(
+                'config/sim_tags.json has no sim for series '
+                f'{", ".join(map(repr, missing))} and no "*" fallback')
+
+    def _match(self, series: str) -> Optional[_SimTags]:
+        sim = series.split(maxsplit=1)[0] if series.strip() else ''
+        return self.sims.get(sim, self.fallback)
+
+    def __getitem__(self, series: str) -> _SimTags:
+        # Answers stored under an older questions.json may name a series
+        # that's no longer a choice
+        sim = self.series.get(series) or self._match(series)
+        if sim is None:
+            return {'sim_name': '*', 'forum_tag': None, 'role_id': None}
+        return sim
+
+
+class Layout:
+    """The components for one screen, compiled once and built per render.
+
+    Each entry is a component class and its keyword arguments. ``{name}``
+    placeholders in a ``custom_id`` are filled from :meth:`build`'s
+    keyword arguments. Select options are shared and only the list around
+    them is copied.
+    """
+    __slots__ = ('items',)
+
+    def __init__(self, *items: tuple[type[discord.ui.Item[Any]], dict[str, Any]]) -> None:
+        self.items = items
+
+    def build(self, **ids: Any) -> list[discord.ui.Item[Any]]:
+        components: list[discord.ui.Item[Any]] = []
+        for cls, kwargs in self.items:
+            if ids and 'custom_id' in kwargs:
+                kwargs = {**kwargs, 'custom_id': kwargs['custom_id'].format(**ids)}
+            if 'options' in kwargs:
+                kwargs = {**kwargs, 'options': list(kwargs['options'])}
+            components.append(cls(**kwargs))
+        return components
+
+
+@functools.lru_cache(maxsize=None)
+def choice_options(choices: tuple[str, ...]) -> tuple[discord.SelectOption, ...]:
+    return tuple(discord.SelectOption(label=choice, value=choice) for choice in choices)
+
+
+def selected_options(choices: list[str], selected: str) -> list[discord.SelectOption]:
+    """The options for ``choices``, with ``selected`` marked as the default."""
+    options = list(choice_options(tuple(choices)))
+    if selected in choices:
+        options[choices.index(selected)] = discord.SelectOption(
+            label=selected, value=selected, default=True)
+    return options
+
+
+# QuestionnaireView custom ids carry the session id, filled in at render.
+# yes/no buttons also carry the question index.
+def question_layout(question: _Question, index: int) -> Layout:
+    if question['type'] == 'multiple_choice':
+        return Layout((discord.ui.Select, dict(
+            placeholder=f'{question["title"]} [CLICK]',
+            options=choice_options(tuple(question['choices'])),  # type: ignore
+            custom_id='questionnaire:::multiple_choice-{sid}',
+        )))
+    elif question['type'] in ('text_short', 'text_long'):
+        return Layout((discord.ui.Button, dict(
+            label='Answer Question',
+            style=discord.ButtonStyle.red,
+            custom_id='questionnaire:::text-{sid}',
+        )))
+    elif question['type'] == 'yes_no':
+        return Layout(
+            (discord.ui.Select, dict(
+                placeholder=question['title'],
+                options=(discord.SelectOption(label='-', value='-'),),
+                disabled=True,
+                row=0,
+            )),
+            (discord.ui.Button, dict(
+                label='Yes', style=discord.ButtonStyle.green,
+                custom_id=f'questionnaire:::yes-{{sid}}-{index}', row=1)),
+            (discord.ui.Button, dict(
+                label='No', style=discord.ButtonStyle.red,
+                custom_id=f'questionnaire:::no-{{sid}}-{index}', row=1)),
+        )
+    return Layout()
+
+
+class Page:
+    """One screen of the questionnaire.
+
+    A page is either a single question or, in paged mode, a run of up to
+    five text questions (answered in one modal) or up to five yes/no
+    questions (one row of buttons each).
+    """
+    __slots__ = ('kind', 'first', 'questions', 'layout')
+
+    def __init__(self, kind: str, first: int, questions: list[_Question]) -> None:
+        self.kind: str = kind
+        self.first: int = first
+        self.questions: list[_Question] = questions
+        self.layout: Layout = self._layout()
+
+    @property
+    def indices(self) -> range:
+        return range(self.first, self.first + len(self.questions))
+
+    def _layout(self) -> Layout:
+        if self.kind == 'text':
+            return Layout((discord.ui.Button, dict(
+                label='Answer Question' if len(self.questions) == 1 else 'Answer Questions',
+                style=discord.ButtonStyle.red,
+                custom_id='questionnaire:::text-{sid}',
+            )))
+        if self.kind == 'yes_no' and len(self.questions) > 1:
+            items: list[tuple[type[discord.ui.Item[Any]], dict[str, Any]]] = []
+            for row, (index, question) in enumerate(zip(self.indices, self.questions)):
+                items += [
+                    (discord.ui.Button, dict(
+                        label=question['short'], style=discord.ButtonStyle.grey,
+                        disabled=True, row=row)),
+                    (discord.ui.Button, dict(
+                        label='Yes', style=discord.ButtonStyle.green,
+                        custom_id=f'questionnaire:::yes-{{sid}}-{index}', row=row)),
+                    (discord.ui.Button, dict(
+                        label='No', style=discord.ButtonStyle.red,
+                        custom_id=f'questionnaire:::no-{{sid}}-{index}', row=row)),
+                ]
+            return Layout(*items)
+        return question_layout(self.questions[0], self.first)
+
+
+def compile_pages(questions: list[_Question], paged: bool = False) -> list[Page]:
+    """Splits the questionnaire into pages, one per question unless paged."""
+    pages: list[Page] = []
+    for index, question in enumerate(questions):
+        kind = 'text' if question['type'] in ('text_short', 'text_long') else question['type']
+        last = pages[-1] if pages else None
+        if (paged and last is not None and last.kind == kind
+                and kind in ('text', 'yes_no') and len(last.questions) < 5):
+            pages[-1] = Page(kind, last.first, last.questions + [question])
+        else:
+            pages.append(Page(kind, index, [question]))
+    return pages
+
+
+START_LAYOUT = Layout((discord.ui.Button, dict(
+    label='Take me to the questions',
+    style=discord.ButtonStyle.blurple,
+    custom_id='questionnaire:::start-{sid}',
+)))
+
+RESUME_LAYOUT = Layout(
+    (discord.ui.Button, dict(
+        label='Resume where I left off',
+        style=discord.ButtonStyle.blurple,
+        custom_id='questionnaire:::resume-{sid}',
+    )),
+    (discord.ui.Button, dict(
+        label='Start over',
+        style=discord.ButtonStyle.grey,
+        custom_id='questionnaire:::restart-{sid}',
+    )),
+)
+
+TIMED_OUT_LAYOUT = Layout((discord.ui.Button, dict(
+    label='Message timed out',
+    style=discord.ButtonStyle.grey,
+    disabled=True,
+)))
+
+LOG_RESULT_LAYOUTS: dict[AnswerResult, Layout] = {
+    AnswerResult.approved: Layout((discord.ui.Button, dict(
+        style=discord.ButtonStyle.green, label='Approved', disabled=True))),
+    AnswerResult.rejected: Layout((discord.ui.Button, dict(
+        style=discord.ButtonStyle.red, label='Rejected', disabled=True))),
+    AnswerResult.publishing: Layout((discord.ui.Button, dict(
+        style=discord.ButtonStyle.grey, label='Publishing...', disabled=True))),
+    # Approving again resumes the failed PublishJob, see ForumPublisher.failed
+    AnswerResult.failed: Layout((discord.ui.Button, dict(
+        style=discord.ButtonStyle.red, label='Publishing failed, retry',
+        custom_id='questions:::approve-{id}'))),
+}
+
+
+def log_layout(editing: bool) -> Layout:
+    items: list[tuple[type[discord.ui.Item[Any]], dict[str, Any]]] = [
+        (discord.ui.Button, dict(
+            style=discord.ButtonStyle.green,
+            label='Approve',
+            custom_id='questions:::approve-{id}',
+            row=0,
+            disabled=editing,
+        )),
+        (discord.ui.Button, dict(
+            style=discord.ButtonStyle.red,
+            label='Reject',
+            custom_id='questions:::reject-{id}',
+            row=0,
+            disabled=editing,
+        )),
+        (discord.ui.Button, dict(
+            style=discord.ButtonStyle.blurple,
+            label='Edit' if not editing else 'Stop Editing',
+            custom_id=f'questions:::edit-{{id}}-{1 if editing else 0}',
+            row=0,
+        )),
+    ]
+    if editing:
+        items += [
+            (discord.ui.Button, dict(
+                style=discord.ButtonStyle.grey,
+                label=' ',
+                emoji='⬆️',
+                custom_id='questions:::index_up-{id}-{index}',
+                row=0,
+            )),
+            (discord.ui.Button, dict(
+                style=discord.ButtonStyle.grey,
+                label=' ',
+                emoji='⬇️',
+                custom_id='questions:::index_down-{id}-{index}',
+                row=0,
+            )),
+        ]
+    return Layout(*items)
+
+
+LOG_LAYOUT = log_layout(editing=False)
+LOG_EDITING_LAYOUT = log_layout(editing=True)
+
+# Second row while editing a question, by question type. Multiple choice
+# needs the question's own options, see LogView.update_components().
+LOG_QUESTION_LAYOUTS: dict[str, Layout] = {
+    'text_short': Layout((discord.ui.Button, dict(
+        label='Edit Question Answer',
+        style=discord.ButtonStyle.red,
+        custom_id='questions:::text-{id}-{index}',
+        row=1,
+    ))),
+    'yes_no': Layout(
+        (discord.ui.Button, dict(
+            label='Yes',
+            style=discord.ButtonStyle.green,
+            custom_id='questions:::yes-{id}-{index}',
+            row=1,
+        )),
+        (discord.ui.Button, dict(
+            label='No',
+            style=discord.ButtonStyle.red,
+            custom_id='questions:::no-{id}-{index}',
+            row=1,
+        )),
+    ),
+}
+LOG_QUESTION_LAYOUTS['text_long'] = LOG_QUESTION_LAYOUTS['text_short']
 
 
 class LogView(discord.ui.View):
@@ -150,6 +588,8 @@ class LogView(discord.ui.View):
         self.bot: Bot = bot
         self.cog: Cog = cog
         self.answer: _Answer = answer
+        # The questions as they were when this answer was submitted
+        self.questions: list[_Question] = cog.schemas[answer['schema']]
         self.result: AnswerResult = result
         self.question_index: int = question_index
         self.reject_message: str = reject_message
@@ -159,103 +599,48 @@ class LogView(discord.ui.View):
         return self.question_index != -1
 
     @property
-    def question(self) -> _QuestionShort:
+    def question(self) -> _Question:
         if not self.editing:
             raise
-        return self.answer['questions'][self.question_index]
+        return self.questions[self.question_index]
+
+    @property
+    def current_answer(self) -> str:
+        return self.answer['answers'][self.question_index]
 
     async def answer_question(self, answer: str) -> None:
-        self.question['answer'] = answer
+        self.answer['answers'][self.question_index] = answer
         await self.cog.answers.put(self.answer['id'], self.answer)
+        self.bot.dispatch('irr_edited', self.answer)
 
     def update_components(self) -> None:
         self.clear_items()
         if self.result != AnswerResult.pending:
-            if self.result == AnswerResult.approved:
-                self.add_item(discord.ui.Button(
-                    style=discord.ButtonStyle.green, label='Approved', disabled=True))
-            elif self.result == AnswerResult.rejected:
-                self.add_item(discord.ui.Button(
-                    style=discord.ButtonStyle.red, label='Rejected', disabled=True))
+            for item in LOG_RESULT_LAYOUTS[self.result].build(id=self.answer['id']):
+                self.add_item(item)
             return
 
-        components: list[discord.ui.Button[Self] | discord.ui.Select[Self]] = [
-            discord.ui.Button(
-                style=discord.ButtonStyle.green,
-                label='Approve',
-                custom_id=f'questions:::approve-{self.answer["id"]}',
-                row=0,
-                disabled=self.editing
-            ),
-            discord.ui.Button(
-                style=discord.ButtonStyle.red,
-                label='Reject',
-                custom_id=f'questions:::reject-{self.answer["id"]}',
-                row=0,
-                disabled=self.editing
-            ),
-            discord.ui.Button(
-                style=discord.ButtonStyle.blurple,
-                label='Edit' if not self.editing else 'Stop Editing',
-                custom_id=f'questions:::edit-{self.answer["id"]}-{1 if self.editing else 0}',
-                row=0
-            ),
-        ]
+        ids = {'id': self.answer['id'], 'index': self.question_index}
+        components: list[discord.ui.Item[Self]] = \
+            LOG_EDITING_LAYOUT.build(**ids) if self.editing else LOG_LAYOUT.build(**ids)
 
         if self.editing:
-            components.extend([
-                discord.ui.Button(
-                    style=discord.ButtonStyle.grey,
-                    label=' ',
-                    emoji='⬆️',
-                    custom_id=f'questions:::index_up-{self.answer["id"]}-{self.question_index}',
-                    row=0
-                ),
-                discord.ui.Button(
-                    style=discord.ButtonStyle.grey,
-                    label=' ',
-                    emoji='⬇️',
-                    custom_id=f'questions:::index_down-{self.answer["id"]}-{self.question_index}',
-                    row=0
-                ),
-            ])
-
-            if self.question['type'] == 'multiple_choice':
+            kind = self.question['type']
+            if kind == 'multiple_choice':
                 components.append(discord.ui.Select(
                     placeholder=f'{self.question["title"]} [CLICK]',
-                    options=[
-                        discord.SelectOption(
-                            label=choice,
-                            value=choice,
-                            default=choice == self.question['answer']
-                        )
-                        for choice in self.question['choices']  # type: ignore
-                    ],
+                    options=selected_options(
+                        self.question['choices'], self.current_answer),  # type: ignore
                     custom_id=f'questions:::multiple_choice-{self.answer["id"]}-{self.question_index}',
                     row=1,
                 ))
-            elif self.question['type'] in ('text_short', 'text_long'):
-                components.append(discord.ui.Button(
-                    label='Edit Question Answer',
-                    style=discord.ButtonStyle.red,
-                    custom_id=f'questions:::text-{self.answer["id"]}-{self.question_index}',
-                    row=1,
-                ))
-            elif self.question['type'] == 'yes_no':
-                components.append(discord.ui.Button(
-                    label='Yes',
-                    style=discord.ButtonStyle.green,
-                    custom_id=f'questions:::yes-{self.answer["id"]}-{self.question_index}',
-                    row=1,
-                    disabled=self.question['answer'].lower() == 'yes',
-                ))
-                components.append(discord.ui.Button(
-                    label='No',
-                    style=discord.ButtonStyle.red,
-                    custom_id=f'questions:::no-{self.answer["id"]}-{self.question_index}',
-                    row=1,
-                    disabled=self.question['answer'].lower() == 'no',
-                ))
+            elif kind in LOG_QUESTION_LAYOUTS:
+                components += LOG_QUESTION_LAYOUTS[kind].build(**ids)
+                if kind == 'yes_no':
+                    # The current answer can't be picked again
+                    for button in components[-2:]:
+                        button.disabled = button.label.lower() == \
+                            self.current_answer.lower()  # type: ignore
 
         for component in components:
             self.add_item(component)
@@ -264,11 +649,12 @@ class LogView(discord.ui.View):
     def embed(self) -> discord.Embed:
         embed = self.bot.embed(title='Questionnaire Answer')
         embed.description = f'**Answered By:** <@{self.answer["user_id"]}>\n**Questions:**'
-        for i, question in enumerate(self.answer['questions'], start=1):
+        for i, (question, answer) in enumerate(
+                zip(self.questions, self.answer['answers']), start=1):
             embed.add_field(
                 name=('👉 ' if self.editing and (i == self.question_index+1)
                       else '') + f'**{question["title"]}**',
-                value=f'> {question["answer"]}',
+                value=f'> {answer}',
                 inline=False,
             )
         if self.reject_message:
@@ -287,23 +673,231 @@ class LogView(discord.ui.View):
         self.update_components()
         await interaction.response.edit_message(embed=self.embed, view=self)
 
+    # For updates that happen after the interaction has been answered
+    async def edit_message(self, message: discord.Message) -> None:
+        self.update_components()
+        await message.edit(embed=self.embed, view=self)
 
-class QuestionnaireView(discord.ui.View):
-    message: discord.Message
+
+class Snapshot:
+    """Everything compiled from questions.json and sim_tags.json.
+
+    When either file changes, the cog builds a new Snapshot and swaps it in
+    whole. Sessions keep the one they started with, so a questionnaire in
+    progress never sees its questions change under it.
+    """
+    __slots__ = ('questions', 'sim_tags', 'paged', 'version', 'pages', 'page_of', 'sim_index')
 
+    def __init__(
+        self,
+        questions: list[_Question],
+        sim_tags: list[_SimTags],
+        paged: bool,
+        previous: Optional[Snapshot] = None,
+    ) -> None:
+        self.questions = questions
+        self.sim_tags = sim_tags
+        self.paged = paged
+        # Only recompile what the change touched
+        if previous is not None and previous.questions is questions:
+            self.version: str = previous.version
+        else:
+            self.version = SchemaRegistry.version(questions)
+        if previous is not None and previous.version == self.version \
+                and previous.paged == paged:
+            self.pages: list[Page] = previous.pages
+            self.page_of: list[int] = previous.page_of
+        else:
+            self.pages = compile_pages(questions, paged=paged)
+            # Question index -> index of the page it's on
+            self.page_of = [
+                number for number, page in enumerate(self.pages) for _ in page.indices]
+        if previous is not None and previous.version == self.version \
+                and previous.sim_tags is sim_tags:
+            self.sim_index: SimIndex = previous.sim_index
+        else:
+            self.sim_index = SimIndex(questions, sim_tags)
+
+
+# Interaction tokens stop working 15 minutes after the interaction. A
+# session has to time out before that, while its message can still be
+# marked as timed out; the margin covers the sweeper's edit.
+TOKEN_LIFETIME = 15 * 60.0 - 60.0
+
+
+class Session:
+    """One user's questionnaire in progress, see SessionStore."""
+    __slots__ = ('id', 'user_id', 'token', 'snapshot', 'answers', 'choices', 'started',
+                 'expires', 'deadline')
+
+    def __init__(self, user_id: int, token: str, snapshot: Snapshot) -> None:
+        self.id: str = os.urandom(4).hex()
+        self.user_id: int = user_id
+        # Interaction token, enough to edit the message when we time out
+        self.token: str = token
+        self.snapshot: Snapshot = snapshot
+        self.answers: list[str] = []
+        # yes/no answers on the current page, until all of them are in
+        self.choices: dict[int, str] = {}
+        self.started: bool = False
+        self.expires: float = 0.0
+        # When the token runs out, however active the session is
+        self.deadline: float = time.monotonic() + TOKEN_LIFETIME
+
+
+class SessionStore:
+    """Questionnaires in progress, keyed by user id.
+
+    Instead of a timeout task per view, one sweeper task sleeps until the
+    earliest deadline in a heap and hands every session that expired to
+    ``on_expire`` in a single batch. Touching a session pushes a new
+    deadline; stale heap entries are skipped when they come up.
+
+    A session expires ``ttl`` seconds after it was last touched, but never
+    later than its interaction token does (see :data:`TOKEN_LIFETIME`).
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        on_expire: Callable[[list[Session]], Awaitable[None]],
+    ) -> None:
+        self.ttl = ttl
+        self.on_expire = on_expire
+        self.sessions: dict[int, Session] = {}
+        self._deadlines: list[tuple[float, int, str]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._sweep())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def get(self, user_id: int, id: Optional[str] = None) -> Optional[Session]:
+        """The user's session, if it's still open (and has this id)."""
+        session = self.sessions.get(user_id)
+        if session is None or (id is not None and session.id != id):
+            return None
+        return session
+
+    def open(self, user_id: int, token: str, snapshot: Snapshot) -> Session:
+        """Starts a new session, replacing any the user already had."""
+        session = Session(user_id, token, snapshot)
+        self.sessions[user_id] = session
+        self.touch(session)
+        return session
+
+    def touch(self, session: Session) -> None:
+        if self.sessions.get(session.user_id) is not session:
+            return
+        session.expires = min(time.monotonic() + self.ttl, session.deadline)
+        heapq.heappush(self._deadlines, (session.expires, session.user_id, session.id))
+        # Capped by the token, a deadline can come before the one the
+        # sweeper is sleeping until
+        if self._deadlines[0][2] == session.id:
+            self._wakeup.set()
+
+    def close(self, session: Session) -> None:
+        if self.sessions.get(session.user_id) is session:
+            del self.sessions[session.user_id]
+
+    async def _sweep(self) -> None:
+        while True:
+            if not self._deadlines:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._deadlines[0][0] - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                continue
+
+            now = time.monotonic()
+            expired: list[Session] = []
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, user_id, id = heapq.heappop(self._deadlines)
+                session = self.sessions.get(user_id)
+                if session is not None and session.id == id and session.expires <= now:
+                    del self.sessions[user_id]
+                    expired.append(session)
+            if expired:
+                try:
+                    await self.on_expire(expired)
+                except Exception:
+                    log.exception('Failed to expire questionnaire sessions')
+
+
+class DraftStore:
+    """Checkpoints of unfinished questionnaires, so they survive a restart.
+
+    Drafts go to a plain JSON :class:`Config` with a commit window: saving
+    only marks the file dirty, and a burst of answers from every user in
+    the window costs one write, off the interaction's critical path.
+    """
+
+    def __init__(self, name: str, ttl: float, commit_window: float = 2.0) -> None:
+        self.ttl = ttl
+        self.store: Config[_Draft] = Config(name, commit_window=commit_window)
+
+    def get(self, user_id: int, schema: str) -> Optional[list[str]]:
+        """The user's answers so far, if they have a live draft."""
+        draft = self.store.get(user_id)
+        if draft is None or draft['e'] < time.time() or draft['s'] != schema:
+            return None
+        return list(draft['a'])
+
+    async def checkpoint(self, session: Session, schema: str) -> None:
+        await self.store.put(session.user_id, {
+            's': schema,
+            'a': list(session.answers),
+            'e': int(time.time() + self.ttl),
+        }, wait=False)
+
+    async def discard(self, user_id: int) -> None:
+        if user_id in self.store:
+            await self.store.remove(user_id, wait=False)
+
+    async def prune(self) -> None:
+        """Drops drafts that have expired."""
+        now = time.time()
+        for key, draft in list(self.store.all().items()):
+            if draft['e'] < now:
+                await self.store.remove(key, wait=False)
+
+    async def close(self) -> None:
+        await self.store.close()
+
+
+# Renders a Session. Like LogView, the view itself doesn't stick around:
+# clicks come back through Cog.on_interaction, which builds a new one.
+class QuestionnaireView(discord.ui.View):
     def __init__(
         self,
         bot: Bot,
         cog: 'Cog',
-        interaction: discord.Interaction[Bot],
+        session: Session,
     ) -> None:
-        super().__init__(timeout=300.0)
+        super().__init__(timeout=0.01)
         self.bot: Bot = bot
         self.cog: Cog = cog
-        self.interaction: discord.Interaction[Bot] = interaction
-        self.answers: list[str] = []
-        self.started: bool = False
-        # self.recently_answered: bool = False
+        self.session: Session = session
+
+    @property
+    def answers(self) -> list[str]:
+        return self.session.answers
+
+    @property
+    def started(self) -> bool:
+        return self.session.started
 
     @property
     def embed(self) -> discord.Embed:
@@ -312,20 +906,36 @@ class QuestionnaireView(discord.ui.View):
             embed.description = (
                 'Please answer the following questions.'
                 f'\nYou have already answered '\
-                f'`{self.answered}/{len(QUESTIONS)}` questions.'
+                f'`{self.answered}/{len(self.snapshot.questions)}` questions.'
             )
             if self.started:  # and not self.recently_answered:
-                embed.add_field(
-                    name=f'**Question #{self.answered + 1}**',
-                    value=self.question['title'],
-                    inline=False,
-                )
+                page = self.page
+                if len(page.questions) == 1:
+                    embed.add_field(
+                        name=f'**Question #{self.answered + 1}**',
+                        value=page.questions[0]['title'],
+                        inline=False,
+                    )
+                else:
+                    embed.add_field(
+                        name=f'**Questions #{page.first + 1}-{page.indices[-1] + 1}**',
+                        value='\n'.join(f'{i}. {question["title"]}' for i, question
+                                        in enumerate(page.questions, start=page.first + 1)),
+                        inline=False,
+                    )
             # elif self.recently_answered:
             #     embed.add_field(
             #         name=f'**Success!**',
             #         value='Your answer has been recorded.',
             #         inline=False,
             #     )
+            elif self.answers:
+                embed.add_field(
+                    name='**Resume IRR Submission**',
+                    value='You have an unfinished submission. Pick up where '\
+                          'you left off, or start over.',
+                    inline=False,
+                )
             else:
                 embed.add_field(
                     name='**Start IRR Submission**',
@@ -340,8 +950,12 @@ class QuestionnaireView(discord.ui.View):
         return embed
 
     @property
-    def question(self) -> _Question:
-        return QUESTIONS[len(self.answers)]
+    def snapshot(self) -> Snapshot:
+        return self.session.snapshot
+
+    @property
+    def page(self) -> Page:
+        return self.snapshot.pages[self.snapshot.page_of[self.answered]]
 
     @property
     def answered(self) -> int:
@@ -349,97 +963,55 @@ class QuestionnaireView(discord.ui.View):
 
     @property
     def done(self) -> bool:
-        return self.answered == len(QUESTIONS)
+        return self.answered == len(self.snapshot.questions)
 
     def update_components(self) -> None:
         self.clear_items()
         if self.done:
             return
 
-        components: list[discord.ui.Button[Self]
-                         | discord.ui.Select[Self]] = []
-
+        ## To put a Next Question between each q, add a layout with a
+        ## 'next' button and show it while recently_answered.
         if not self.started:
-            components.append(discord.ui.Button(
-                label='Take me to the questions',
-                style=discord.ButtonStyle.blurple,
-                custom_id='start',
-            ))
-
-        ## Uncomment this block to put a Next Question between each q
-        # elif self.recently_answered:
-        #     components.append(discord.ui.Button(
-        #         label='Next Question',
-        #         style=discord.ButtonStyle.blurple,
-        #         custom_id='next',
-        #     ))
-        elif self.question['type'] == 'multiple_choice':
-            components.append(discord.ui.Select(
-                placeholder=f'{self.question["title"]} [CLICK]',
-                options=[
-                    discord.SelectOption(label=choice, value=choice)
-                    for choice in self.question['choices']  # type: ignore
-                ],
-                custom_id='multiple_choice',
-            ))
-        elif self.question['type'] in ('text_short', 'text_long'):
-            components.append(discord.ui.Button(
-                label='Answer Question',
-                style=discord.ButtonStyle.red,
-                custom_id='text',
-            ))
-        elif self.question['type'] == 'yes_no':
-            components.append(discord.ui.Select(
-                placeholder=self.question['title'],
-                options=[discord.SelectOption(label='-', value='-')],
-                disabled=True,
-                row=0,
-            ))
-            components.append(discord.ui.Button(
-                label='Yes',
-                style=discord.ButtonStyle.green,
-                custom_id='yes',
-                row=1,
-            ))
-            components.append(discord.ui.Button(
-                label='No',
-                style=discord.ButtonStyle.red,
-                custom_id='no',
-                row=1,
-            ))
+            layout = RESUME_LAYOUT if self.answers else START_LAYOUT
+            components = layout.build(sid=self.session.id)
+        else:
+            components = self.page.layout.build(sid=self.session.id)
+            # Grey out the other button once a yes/no row is answered
+            for component in components:
+                parsed = parse_custom_id(component.custom_id or '')
+                if parsed is None or not parsed[3]:
+                    continue
+                choice = self.session.choices.get(int(parsed[3]))
+                if choice is not None and choice.lower() != parsed[1]:
+                    component.style = discord.ButtonStyle.grey  # type: ignore
 
         for component in components:
-            component.callback = self.callback
             self.add_item(component)
 
     async def submit(self) -> None:
         id: str = os.urandom(4).hex()
         answer: _Answer = {
             'id': id,
-            'user_id': self.interaction.user.id,
+            'user_id': self.session.user_id,
             'epoch': int(time.time()),
-            'questions': [  # type: ignore
-                {
-                    'title': question['title'],
-                    'short': question['short'],  # type: ignore
-                    'type': question['type'],
-                    'inline': question['inline'],
-                    # type: ignore
-                    **({'choices': question['choices']} if question['type'] == 'multiple_choice' else {}),
-                    **({
-                        'placeholder': question['placeholder'],  # type: ignore
-                        'max_length': question['max_length'],  # type: ignore
-                    } if question['type'] in ('text_short', 'text_long') else {}),  # type: ignore
-                    'answer': answer,
-                } for question, answer in zip(QUESTIONS, self.answers)
-            ]
+            'schema': self.snapshot.version,
+            'answers': list(self.answers),
         }
         await self.cog.answers.put(id, answer)
+        self.bot.dispatch('irr_submitted', answer)
         view = LogView(bot=self.bot, cog=self.cog, answer=answer)
         await view.run()
 
     async def update(self, interaction: discord.Interaction[Bot]) -> None:
         self.update_components()
+        if self.done:
+            self.cog.sessions.close(self.session)
+            await self.cog.drafts.discard(self.session.user_id)
+        else:
+            self.cog.sessions.touch(self.session)
+            if self.answers:
+                await self.cog.drafts.checkpoint(self.session, self.snapshot.version)
         await interaction.response.edit_message(embed=self.embed, view=self)
 
         if self.done:
@@ -449,49 +1021,244 @@ class QuestionnaireView(discord.ui.View):
         self.answers.append(answer)
         # self.recently_answered = True
 
-    async def callback(self, interaction: discord.Interaction[Bot]) -> None:
-        custom_id: str = interaction.data['custom_id']  # type: ignore
-
-        if custom_id == 'start':
-            self.started = True
-        # elif custom_id == 'next':
+    async def handle(
+        self,
+        interaction: discord.Interaction[Bot],
+        action: str,
+        index: Optional[int],
+    ) -> None:
+        if action in ('start', 'resume'):
+            self.session.started = True
+        elif action == 'restart':
+            self.session.answers.clear()
+            self.session.started = True
+            await self.cog.drafts.discard(self.session.user_id)
+        # elif action == 'next':
         #     self.recently_answered = False
-        elif custom_id == 'multiple_choice':
+        elif action == 'multiple_choice':
             # type: ignore
             await self.answer_question(interaction.data['values'][0])
-        elif custom_id == 'text':
+        elif action == 'text':
+            self.cog.sessions.touch(self.session)
             await interaction.response.send_modal(AnswerModal(
                 bot=self.bot,
                 cog=self.cog,
                 interaction=interaction,
                 view=self,
-                question=self.question,
+                questions=self.page.questions,
             ))
             return
-        elif custom_id in ('yes', 'no'):
-            await self.answer_question(custom_id.capitalize())
+        elif action in ('yes', 'no') and index is not None:
+            # The page is done once every yes/no row on it is
+            page = self.page
+            if index in page.indices:
+                self.session.choices[index] = action.capitalize()
+            if all(i in self.session.choices for i in page.indices):
+                for i in page.indices:
+                    await self.answer_question(self.session.choices.pop(i))
 
         await self.update(interaction=interaction)
 
-    async def run(self) -> None:
+    async def run(self, interaction: discord.Interaction[Bot]) -> None:
         self.update_components()
-        await self.interaction.response.send_message(
+        await interaction.response.send_message(
             embed=self.embed, view=self, ephemeral=True
         )
-        self.message = await self.interaction.original_response()
 
-    async def on_timeout(self) -> None:
-        view = discord.ui.View(timeout=0.01)
-        view.add_item(discord.ui.Button(label='Message timed out',
-                      style=discord.ButtonStyle.grey, disabled=True))
-        await self.message.edit(view=view)
+
+class PublishJob:
+    """An approved answer waiting to be posted in the forum.
+
+    Its progress is saved with the answer, under ``publish``, before it's
+    queued and after every step. So a job cut short by a restart or a
+    ``/reload`` is picked up by :meth:`Cog.cog_load` with the same IRR
+    number and thread.
+    """
+    __slots__ = ('answer', 'message', 'irr_num', 'thread', 'pinged')
+
+    def __init__(self, answer: _Answer, message: Optional[discord.Message | discord.PartialMessage]) -> None:
+        self.answer: _Answer = answer
+        self.message: Optional[discord.Message | discord.PartialMessage] = message
+        self.irr_num: Optional[int] = None
+        self.thread: Optional[discord.Thread | discord.PartialMessageable] = None
+        self.pinged: bool = False
+
+    def state(self, failed: bool = False) -> _Publish:
+        return {
+            'message': [self.message.channel.id, self.message.id]
+                       if self.message is not None else None,
+            'irr_num': self.irr_num,
+            'thread_id': self.thread.id if self.thread is not None else None,
+            'pinged': self.pinged,
+            'failed': failed,
+        }
+
+    @classmethod
+    def restore(cls, bot: Bot, answer: _Answer) -> Self:
+        # Partial objects need no cache, so this works before the bot is ready
+        state = answer['publish']
+        message = None
+        if state['message'] is not None:
+            channel_id, message_id = state['message']
+            message = bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+        job = cls(answer=answer, message=message)
+        job.irr_num = state['irr_num']
+        if state['thread_id'] is not None:
+            job.thread = bot.get_partial_messageable(state['thread_id'])
+        job.pinged = state['pinged']
+        return job
+
+
+class ForumPublisher:
+    """Bounded queue of approvals, worked off by a few background tasks.
+
+    Transient failures (rate limits, 5xx, timeouts) are retried with
+    exponential backoff. Answers being published are tracked in
+    :attr:`pending` so they can't be approved or rejected twice. Jobs that
+    still failed are kept in :attr:`failed`, so approving the answer again
+    picks up where they stopped instead of taking a second IRR number and
+    thread.
+    """
+
+    def __init__(
+        self,
+        cog: 'Cog',
+        workers: int = 2,
+        maxsize: int = 100,
+        attempts: int = 5,
+        backoff: float = 1.0,
+    ) -> None:
+        self.cog: Cog = cog
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.queue: asyncio.Queue[PublishJob] = asyncio.Queue(maxsize=maxsize)
+        self.pending: set[str] = set()
+        self.failed: dict[str, PublishJob] = {}
+        self.tasks: list[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker())
+                      for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, job: PublishJob) -> None:
+        await self.queue.put(job)
+
+    @staticmethod
+    def retryable(error: Exception) -> bool:
+        if isinstance(error, discord.HTTPException):
+            return error.status == 429 or error.status >= 500
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def _run(self, job: PublishJob) -> None:
+        for attempt in range(self.attempts):
+            try:
+                return await self.cog.publish_answer(job)
+            except Exception as e:
+                if not self.retryable(e) or attempt == self.attempts - 1:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log.warning(f'Publishing {job.answer["id"]} failed ({e}), '
+                            f'retrying in {delay:.0f}s')
+                await asyncio.sleep(delay)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            error: Optional[Exception] = None
+            try:
+                await self._run(job)
+            except Exception as e:
+                log.exception(f'Could not publish answer {job.answer["id"]}')
+                self.failed[job.answer['id']] = job
+                error = e
+            finally:
+                self.pending.discard(job.answer['id'])
+                self.queue.task_done()
+            try:
+                await self.cog.published(job, error)
+            except Exception:
+                log.exception(f'Could not update log message for {job.answer["id"]}')
 
 
 class Cog(commands.Cog):
     def __init__(self, bot: Bot) -> None:
         self.bot: Bot = bot
-        self.answers: Config[_Answer] = Config('answers.json')
-        self.irr: Config[_IRR] = Config('irr.json')
+        self.answers: Config[_Answer] | SQLiteConfig[_Answer] = \
+            open_store('answers.json', config.get('storage'))
+        self.irr: Config[_IRR] | SQLiteConfig[_IRR] = \
+            open_store('irr.json', config.get('storage'))
+        self.routes: dict[str, Route] = self.build_routes()
+        self.snapshot: Snapshot = Snapshot(
+            settings.questions, settings.sim_tags,
+            paged=config.get('questionnaire_mode') == 'paged')
+        self.schemas: SchemaRegistry = SchemaRegistry(
+            open_store('schemas.json', config.get('storage')))
+        self.publisher: ForumPublisher = ForumPublisher(self)
+        self.sessions: SessionStore = SessionStore(
+            ttl=300.0, on_expire=self.expire_sessions)
+        self.drafts: DraftStore = DraftStore(
+            'drafts.json', ttl=config.get('draft_ttl', 86400))
+        self.archive: Archive = Archive()
+        self.irr_numbers: Sequence = Sequence(
+            self.irr, 'irr_num', block=config.get('irr_block', 10))  # type: ignore
+        self.resuming: Optional[asyncio.Task[None]] = None
+
+    async def cog_load(self) -> None:
+        await self.schemas.intern(self.snapshot.questions)
+        settings.listeners.append(self.settings_changed)
+        self.publisher.start()
+        self.resuming = asyncio.create_task(
+            self.resume_publishing(self.saved_jobs(await self.answers.scan())))
+        self.sessions.start()
+        await self.drafts.prune()
+        self.archive.start()
+        metrics.pending_answers.set_function(lambda: len(self.answers))
+        metrics.sessions.set_function(lambda: len(self.sessions))
+
+    async def cog_unload(self) -> None:
+        metrics.pending_answers.set_function(None)
+        metrics.sessions.set_function(None)
+        settings.listeners.remove(self.settings_changed)
+        if self.resuming is not None:
+            self.resuming.cancel()
+        await self.publisher.stop()
+        await self.irr_numbers.close()
+        await self.sessions.stop()
+        await self.answers.close()
+        await self.irr.close()
+        await self.schemas.store.close()
+        await self.drafts.close()
+        await self.archive.stop()
+
+    # Called by settings.refresh() after a config file was reloaded
+    async def settings_changed(self, name: str) -> None:
+        if name not in ('questions.json', 'sim_tags.json', 'config.json'):
+            return
+        try:
+            snapshot = Snapshot(
+                settings.questions, settings.sim_tags,
+                paged=config.get('questionnaire_mode') == 'paged',
+                previous=self.snapshot,
+            )
+        except ValueError as e:
+            # settings.refresh() puts the old files back
+            raise ConfigError(f'Keeping the current questionnaire: {e}') from e
+        if snapshot.version != self.snapshot.version:
+            # Interned first, so its answers render as soon as they exist
+            await self.schemas.intern(snapshot.questions)
+            log.info(f'Questionnaire schema is now {snapshot.version}')
+        self.snapshot = snapshot
+
+    @property
+    def sim_index(self) -> SimIndex:
+        return self.snapshot.sim_index
 
     @property
     def guild(self) -> discord.Guild:
@@ -505,43 +1272,158 @@ class Cog(commands.Cog):
     def forum_channel(self) -> discord.ForumChannel:
         return self.guild.get_channel(config['forum_channel_id'])  # type: ignore
 
+    # Looks up a stored answer, converting old-format entries (which have a
+    # full copy of every question) to the compact format on the way.
+    async def get_answer(self, id: Optional[str]) -> Optional[_Answer]:
+        answer: Optional[_Answer | _LegacyAnswer] = self.answers.get(id)
+        if answer is None or 'schema' in answer:
+            return answer  # type: ignore
+
+        questions: list[_Question] = [
+            {key: value for key, value in question.items() if key != 'answer'}  # type: ignore
+            for question in answer['questions']
+        ]
+        upgraded: _Answer = {
+            'id': answer['id'],
+            'user_id': answer['user_id'],
+            'epoch': answer['epoch'],
+            'schema': await self.schemas.intern(questions),
+            'answers': [question['answer'] for question in answer['questions']],
+        }
+        await self.answers.put(upgraded['id'], upgraded, wait=False)
+        return upgraded
+
     async def start_questionnaire(
         self,
         interaction: discord.Interaction[Bot]
     ) -> None:
-        view = QuestionnaireView(
-            bot=self.bot, cog=self, interaction=interaction)
-        await view.run()
+        session = self.sessions.open(
+            interaction.user.id, interaction.token, self.snapshot)
+        draft = self.drafts.get(interaction.user.id, session.snapshot.version)
+        if draft is not None:
+            session.answers = draft
+        view = QuestionnaireView(bot=self.bot, cog=self, session=session)
+        await view.run(interaction=interaction)
+
+    async def questionnaire_click(
+        self,
+        interaction: discord.Interaction[Bot],
+        action: str,
+        id: str,
+        number: str,
+    ) -> None:
+        session = self.sessions.get(interaction.user.id, id)
+        if session is None:
+            return await self.session_expired(interaction)
+        view = QuestionnaireView(bot=self.bot, cog=self, session=session)
+        await view.handle(interaction=interaction, action=action,
+                          index=int(number) if number else None)
+
+    # For clicks and modals that belong to a session that's gone
+    async def session_expired(self, interaction: discord.Interaction[Bot]) -> None:
+        view = discord.ui.View(timeout=0.01)
+        for item in TIMED_OUT_LAYOUT.build():
+            view.add_item(item)
+        await interaction.response.edit_message(view=view)
+
+    # Called by the session sweeper with every session that just timed out
+    async def expire_sessions(self, sessions: list[Session]) -> None:
+        view = discord.ui.View(timeout=0.01)
+        for item in TIMED_OUT_LAYOUT.build():
+            view.add_item(item)
+
+        async def expire(session: Session) -> None:
+            webhook = discord.Webhook.partial(
+                self.bot.application_id, session.token, client=self.bot)  # type: ignore
+            await webhook.edit_message('@original', view=view)  # type: ignore
+
+        results = await asyncio.gather(
+            *(expire(session) for session in sessions), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning(f'Could not mark questionnaire as timed out: {result}')
+
+    # Publishing jobs saved with their answers, by an earlier run of the bot
+    # or of this cog. Failed ones wait for a retry as they would have; the
+    # rest are marked pending straight away and returned for
+    # resume_publishing().
+    def saved_jobs(self, answers: dict[str, _Answer]) -> list[PublishJob]:
+        jobs: list[PublishJob] = []
+        for answer in answers.values():
+            if 'publish' not in answer:
+                continue
+            job = PublishJob.restore(self.bot, answer)  # type: ignore
+            if answer['publish']['failed']:  # type: ignore
+                self.publisher.failed[answer['id']] = job
+            else:
+                self.publisher.pending.add(answer['id'])
+                jobs.append(job)
+        return jobs
 
-    # Find matching sim object, or None if there is no match
-    def get_sim(self, series: str) -> _SimTags:
-        (sim, rest) = series.split(maxsplit=1)
-        for sim_tag in SIM_TAGS:
-            if sim_tag['sim_name'] == sim:
-                return(sim_tag)
+    # The forum channel can only be found once the bot is ready
+    async def resume_publishing(self, jobs: list[PublishJob]) -> None:
+        if not jobs:
+            return
+        await self.bot.wait_until_ready()
+        log.info(f'Resuming {len(jobs)} interrupted forum posts')
+        for job in jobs:
+            await self.publisher.submit(job)
+
+    # Records how far a job got, see PublishJob
+    async def save_progress(self, job: PublishJob, failed: bool = False) -> None:
+        if job.answer['id'] not in self.answers:
+            return
+        job.answer = {**job.answer, 'publish': job.state(failed=failed)}
+        await self.answers.put(job.answer['id'], job.answer)
 
-    # Admin clicked the approval button. This removes the answer from
-    # answers.json, and posts the IRR in the forum.
+    # Admin clicked the approval button. The click is acknowledged right
+    # away, and the forum post is made in the background by ForumPublisher.
     async def approve_answer(self,
                 interaction: discord.Interaction[Bot],
                 answer: _Answer,
     ) -> None:
-        # Creates a mention for the user so we can click to DM them
-        user: str = str(self.guild.get_member(
-            answer['user_id']) or 'Unknown User')
+        self.publisher.pending.add(answer['id'])
+        job = self.publisher.failed.pop(answer['id'], None)
+        if job is None:
+            job = PublishJob(answer=answer, message=interaction.message)  # type: ignore
+        else:
+            # Retry a failed job, keeping its IRR number and thread
+            job.answer, job.message = answer, interaction.message  # type: ignore
+        view = LogView(bot=self.bot, cog=self, answer=answer,
+                       result=AnswerResult.publishing)
+        try:
+            await self.save_progress(job)
+            await view.edit(interaction=interaction)
+            await self.publisher.submit(job)
+        except Exception:
+            self.publisher.pending.discard(answer['id'])
+            if job.irr_num is not None:
+                self.publisher.failed[answer['id']] = job
+            # It never got queued, so don't resume it on the next start
+            try:
+                await self.save_progress(job, failed=True)
+            except Exception:
+                log.exception(f'Could not save publishing state of {answer["id"]}')
+            raise
+
+    # Posts the IRR in the forum. Each step records its result on the job,
+    # so a retry picks up where the last attempt failed instead of creating
+    # a second thread.
+    async def publish_answer(self, job: PublishJob) -> None:
+        answer = job.answer
 
         # Get the next IRR number
-        irr_num = self.irr['irr_num']
-        await self.irr.put('irr_num', irr_num + 1)
+        if job.irr_num is None:
+            job.irr_num = await self.irr_numbers.next()
+            await self.save_progress(job)
 
         # Build the title. XXX question numbers are hard-coded here.
         # Not ideal, but also a pretty obvious fix if it needs to change.
-        series  = answer['questions'][0]['answer']
-        track   = answer['questions'][1]['answer']
-        thread  = f'【IRR#{irr_num}】{series} › {track}'
-        title   = f'**From** <@{answer["user_id"]}>'
+        series  = answer['answers'][0]
+        track   = answer['answers'][1]
+        thread  = f'【IRR#{job.irr_num}】{series} › {track}'
         embed   = self.bot.embed()
-        sim_tags= self.get_sim(series)
+        sim_tags= self.sim_index[series]
 
         # Submitter, currently just shows the Discord username, but
         # TODO - Fetch the nickname from the CMS server. GitHub Issue #4.
@@ -552,35 +1434,71 @@ class Cog(commands.Cog):
         )
 
         # Set up the embed with all of the answers
-        for i, question in enumerate(answer['questions'], start=1):
+        questions = self.schemas[answer['schema']]
+        for question, value in zip(questions, answer['answers']):
             short = question['short']
             embed.add_field(
                 name=f'**{short}**',
-                value=question['answer'],
+                value=value,
                 inline=question['inline'],
             )
 
         # Create forum thread
-        fthread = await self.forum_channel.create_thread(
-            name=thread,
-            embed=embed,
-            applied_tags=[self.forum_channel.get_tag(config['open_tag_id']),
-                          self.forum_channel.get_tag(sim_tags['forum_tag'])]
-        )
+        if job.thread is None:
+            forum = self.forum_channel
+            tags: list[discord.ForumTag] = []
+            for tag_id in (config['open_tag_id'], sim_tags['forum_tag']):
+                tag = tag_id and await self.bot.resolver.forum_tag(forum, tag_id)
+                if tag:
+                    tags.append(tag)
+            fthread = await forum.create_thread(
+                name=thread,
+                embed=embed,
+                applied_tags=tags,
+            )
+            job.thread = fthread.thread
+            await self.save_progress(job)
 
         # Now figure out who we're supposed to tag
-        if (sim_tags is not None):
-            await fthread.thread.send(
+        if (sim_tags['role_id'] is not None) and not job.pinged:
+            await job.thread.send(
                 content = f'**Attention** <@&{sim_tags["role_id"]}>'
             )
+            job.pinged = True
+            await self.save_progress(job)
 
         # Remove it from answers.json last in case we have an error above
-        await self.answers.remove(answer['id'])
-
-        view = LogView(bot=self.bot, cog=self, answer=answer,
-                       result=AnswerResult.approved)
+        if answer['id'] in self.answers:
+            await self.answers.remove(answer['id'])
+
+    # Called by ForumPublisher once a job is done, successfully or not
+    async def published(self, job: PublishJob, error: Optional[Exception]) -> None:
+        if error is not None:
+            await self.save_progress(job, failed=True)
+        if error is None:
+            answer = {key: value for key, value in job.answer.items() if key != 'publish'}
+            self.decided({
+                'answer': answer,  # type: ignore
+                'result': 'approved',
+                'decided': int(time.time()),
+                'irr_num': job.irr_num,  # type: ignore
+                'thread_id': job.thread.id,  # type: ignore
+            })
+        if error is None:
+            result = AnswerResult.approved
+        elif job.thread is not None:
+            # Already in the forum, so it can only be finished now
+            result = AnswerResult.failed
+        else:
+            result = AnswerResult.pending
+        view = LogView(bot=self.bot, cog=self, answer=job.answer, result=result)
+        if job.message is not None:
+            await view.edit_message(job.message)
 
-        return await view.edit(interaction=interaction)
+    # Archives an approved or rejected answer, and tells the other cogs
+    def decided(self, record: _Record) -> None:
+        self.archive.submit(record)
+        self.bot.dispatch('irr_decided', record)
 
     async def reject_message_modal(
         self,
@@ -598,12 +1516,20 @@ class Cog(commands.Cog):
         answer: _Answer,
         message: str
     ) -> None:
+        # Its IRR number, if it got one, is skipped like after a crash
+        self.publisher.failed.pop(answer['id'], None)
         await self.answers.remove(answer['id'])
+        self.decided({
+            'answer': dict(answer),
+            'result': 'rejected',
+            'decided': int(time.time()),
+            'reason': message,
+        })
         view = LogView(bot=self.bot, cog=self, answer=answer,
                        result=AnswerResult.rejected, reject_message=message)
         await view.edit(interaction=interaction)
 
-        member = self.guild.get_member(answer['user_id'])
+        member = await self.bot.resolver.member(self.guild, answer['user_id'])
         if member is None:
             return
         embed = self.bot.embed(
@@ -659,84 +1585,140 @@ class Cog(commands.Cog):
     ) -> None:
         view = LogView(bot=self.bot, cog=self, answer=answer,
                        question_index=question_index)
-        question: _QuestionShort = answer['questions'][question_index]
         modal = AnswerModal(
             bot=self.bot,
             cog=self,
             interaction=interaction,
             view=view,
-            question=question,  # type: ignore
-            default=question['answer'],
+            questions=[view.questions[question_index]],
+            defaults=[answer['answers'][question_index]],
         )
         return await interaction.response.send_modal(modal)
 
+    # Every questions::: custom_id maps to one of these, called with the
+    # interaction, the stored answer and the trailing number ('' if absent),
+    # which only the routes that need it turn into an int.
+    def build_routes(self) -> dict[str, Route]:
+        def edit_with(value: Callable[[discord.Interaction[Bot]], str]) -> Route:
+            return lambda i, answer, index: self.edited_answer(
+                interaction=i, answer=answer,
+                question_index=int(index), new_answer=value(i))
+
+        def move(step: int) -> Route:
+            return lambda i, answer, index: self.set_index(
+                interaction=i, answer=answer,
+                index=(int(index or 0) + step) % len(answer['answers']))
+
+        return {
+            'approve': lambda i, answer, _: self.approve_answer(
+                interaction=i, answer=answer),
+            'reject': lambda i, answer, _: self.reject_message_modal(
+                interaction=i, answer=answer),
+            'edit': lambda i, answer, editing: self.edit_answer(
+                interaction=i, answer=answer, already_editing=editing == '1'),
+            'index_up': move(-1),
+            'index_down': move(1),
+            'multiple_choice': edit_with(
+                lambda i: i.data['values'][0]),  # type: ignore
+            'yes': edit_with(lambda i: 'Yes'),
+            'no': edit_with(lambda i: 'No'),
+            'text': lambda i, answer, index: self.edit_free_text(
+                interaction=i, answer=answer, question_index=int(index)),
+        }
+
     async def on_button_click(
         self,
         interaction: discord.Interaction[Bot],
-        keyword: str,
+        action: str,
+        id: str,
+        number: str,
     ) -> None:
-        try:
-            base, rest = keyword.split('-', 1)
-        except ValueError:
-            base, rest = keyword, ''
-
-        if base == 'start':
+        if action == 'start':
             return await self.start_questionnaire(interaction=interaction)
 
-        try:
-            id, rest_no_id = rest.split('-', 1)
-        except ValueError:
-            id, rest_no_id = rest, ''
+        route = self.routes.get(action)
+        if route is None:
+            return
+
+        answer = await self.decidable(interaction, id, approving=action == 'approve')
+        if answer is None:
+            return
+        await route(interaction, answer, number)
 
-        answer = self.answers.get(id)
+    # The stored answer, if it can still be approved, rejected or edited.
+    # Otherwise the user is told why not. Buttons check this when clicked
+    # and modals again when submitted. Once it's in the forum, it can only
+    # be approved.
+    async def decidable(
+        self,
+        interaction: discord.Interaction[Bot],
+        id: Optional[str],
+        approving: bool = False,
+    ) -> Optional[_Answer]:
+        answer = await self.get_answer(id)
         if answer is None:
-            return await interaction.response.send_message(
+            await interaction.response.send_message(
                 embed=self.bot.embed(
                     'I could not seem to find this asnwer..',
                     color=Color.error
                 ),
                 ephemeral=True
             )
+            return None
 
-        c = { "interaction":interaction, "answer":answer } # Common args
-
-        if base == 'approve':
-            return await self.approve_answer(**c)
-        elif base == 'reject':
-            return await self.reject_message_modal(**c)
-        elif base == 'edit':
-            return await self.edit_answer(**c, already_editing=rest_no_id == '1')
-        elif base in ('index_up', 'index_down'):
-            index: int = (int(rest_no_id) + (-1 if base ==
-                          'index_up' else 1)) % len(answer['questions'])
-            return await self.set_index(**c, index=index)
-        elif base in ('multiple_choice', 'yes', 'no'):
-            new_answer: str = base.capitalize() if base in (
-                'yes', 'no') else interaction.data['values'][0]  # type: ignore
-            return await self.edited_answer(**c,
-                question_index=int(rest_no_id),
-                new_answer=new_answer
+        if id in self.publisher.pending:
+            await interaction.response.send_message(
+                embed=self.bot.embed(
+                    'This IRR is already being published.',
+                    color=Color.error
+                ),
+                ephemeral=True
             )
-        elif base == 'text':
-            return await self.edit_free_text(**c, question_index=int(rest_no_id))
-        else:
-            raise  # should not happen
+            return None
+
+        failed = self.publisher.failed.get(id)  # type: ignore
+        if not approving and failed is not None and failed.thread is not None:
+            await interaction.response.send_message(
+                embed=self.bot.embed(
+                    'This IRR is already in the forum, retry publishing it instead.',
+                    color=Color.error
+                ),
+                ephemeral=True
+            )
+            return None
+
+        return answer
 
     @commands.Cog.listener()
     async def on_interaction(self, interaction: discord.Interaction[Bot]) -> None:
-        if interaction.type != discord.InteractionType.component:
-            return
-        custom_id: str = interaction.data['custom_id']  # type: ignore
-        try:
-            prefix, keyword = custom_id.split(':::', 1)
-        except ValueError:
-            return
-        if prefix != 'questions':
+        # Every interaction is timed to its first response, see metrics.py
+        route = None
+        if interaction.type == discord.InteractionType.component:
+            head, _, args = interaction.data['custom_id'].partition('-')  # type: ignore
+            route = ROUTES.get(head)
+        if route is None:
+            metrics.interactions.receive(interaction.id, handler_name(interaction))
             return
 
-        # type: ignore
-        await self.on_button_click(interaction=interaction, keyword=keyword)
-
+        prefix, action, handler = route
+        metrics.interactions.receive(interaction.id, handler)
+        id, _, number = args.partition('-')
+        with metrics.interactions.handler.time(handler=handler):
+            if prefix == 'questionnaire':
+                with log_context(interaction_id=interaction.id):
+                    return await self.questionnaire_click(
+                        interaction=interaction,
+                        action=action,
+                        id=id,
+                        number=number,
+                    )
+            with log_context(interaction_id=interaction.id, answer_id=id):
+                await self.on_button_click(
+                    interaction=interaction,
+                    action=action,
+                    id=id,
+                    number=number,
+                )
 
 async def setup(bot: Bot) -> None:
     await bot.add_cog(Cog(bot))
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+#
+# bench.py - Micro-benchmarks for the bot's hot paths
+#
+# Run from the repository root:
+#
+#   ./extras/bench.py storage
+#   ./extras/bench.py irr --ops 500
+#   ./extras/bench.py routing
+#   ./extras/bench.py render
+#   ./extras/bench.py questionnaire --latency 100
+#   ./extras/bench.py sessions --sessions 1000
+#   ./extras/bench.py search --pending 50000
+#   ./extras/bench.py logging
+#
+# Benchmarks that import the cogs need a config/config.json.
+#
+# Each benchmark prints a small table; nothing here talks to Discord.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from typing import (
+    Optional,
+    Any,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def fake_answer(i: int) -> dict:
+    return {
+        'id': f'{i:08x}',
+        'user_id': 100000000000000000 + i,
+        'epoch': 1700000000 + i,
+        'schema': '0123456789abcdef',
+        'answers': ['x' * 40] * 6 + ['Yes'] * 3,
+    }
+
+
+async def bench_storage(args: argparse.Namespace) -> None:
+    from utils import Config
+
+    print(f'{"mode":<10}{"pending":>10}{"per put (ms)":>16}')
+    for journal in (False, True):
+        for pending in (100, 1000, args.pending):
+            path = tempfile.mkdtemp()
+            cwd = os.getcwd()
+            os.chdir(path)
+            try:
+                store = Config('answers.json', journal=journal,
+                               compact_bytes=1 << 30)
+                store._db = {f'{i:08x}': fake_answer(i) for i in range(pending)}
+                await store.save()
+
+                start = time.perf_counter()
+                for i in range(args.ops):
+                    answer = store['00000000']
+                    answer['answers'][1] = str(i)
+                    await store.put(answer['id'], answer)
+                elapsed = time.perf_counter() - start
+                await store.close()
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(path)
+            mode = 'journal' if journal else 'json'
+            print(f'{mode:<10}{pending:>10}{elapsed / args.ops * 1000:>16.3f}')
+
+
+async def bench_irr(args: argparse.Namespace) -> None:
+    """Fires concurrent approvals at the IRR allocator and checks the result."""
+    from utils import Config, Sequence
+
+    path = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        store = Config('irr.json')
+        await store.put('irr_num', 1)
+        writes = 0
+        put = store.put
+
+        async def counting_put(*a, **kw):
+            nonlocal writes
+            writes += 1
+            await put(*a, **kw)
+        store.put = counting_put  # type: ignore
+
+        block = 10
+        numbers = Sequence(store, 'irr_num', block=block)
+        start = time.perf_counter()
+        got = await asyncio.gather(*(numbers.next() for _ in range(args.ops)))
+        elapsed = time.perf_counter() - start
+
+        assert len(set(got)) == len(got), 'duplicate IRR numbers'
+        assert sorted(got) == list(range(1, args.ops + 1)), 'gap in IRR numbers'
+
+        # Simulate a crash: a fresh allocator must start past every number
+        # handed out, skipping at most one block
+        restarted = await Sequence(Config('irr.json'), 'irr_num', block=block).next()
+        assert max(got) < restarted <= max(got) + block, restarted
+        await store.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+    print(f'{args.ops} concurrent allocations in {elapsed * 1000:.1f} ms, '
+          f'{writes} writes, unique and gapless; after restart: {restarted}')
+
+
+def legacy_route(custom_id: str) -> Optional[tuple[str, str, str]]:
+    """The string splitting on_interaction/on_button_click used to do."""
+    try:
+        prefix, keyword = custom_id.split(':::', 1)
+    except ValueError:
+        return None
+    if prefix != 'questions':
+        return None
+    try:
+        base, rest = keyword.split('-', 1)
+    except ValueError:
+        base, rest = keyword, ''
+    try:
+        id, rest_no_id = rest.split('-', 1)
+    except ValueError:
+        id, rest_no_id = rest, ''
+    for action in ('start', 'approve', 'reject', 'edit', 'index_up',
+                   'index_down', 'multiple_choice', 'yes', 'no', 'text'):
+        if base == action:
+            return base, id, rest_no_id
+    return None
+
+
+async def bench_routing(args: argparse.Namespace) -> None:
+    from cogs.questionnaire import ROUTES
+
+    routes = dict.fromkeys(('approve', 'reject', 'edit', 'index_up',
+                            'index_down', 'multiple_choice', 'yes', 'no', 'text'))
+    ids = [
+        'questions:::start',
+        'questions:::approve-1a2b3c4d',
+        'questions:::edit-1a2b3c4d-1',
+        'questions:::index_down-1a2b3c4d-3',
+        'questions:::text-1a2b3c4d-4',
+        'questions:::no-1a2b3c4d-7',
+        # QuestionnaireView; the legacy path never saw these, its buttons
+        # had view callbacks instead
+        'questionnaire:::start-5e55104d',
+        'questionnaire:::multiple_choice-5e55104d',
+        'questionnaire:::yes-5e55104d-6',
+        'questionnaire:::text-5e55104d',
+        'multiple_choice',  # someone else's component
+    ] * 1000
+
+    # What Cog.on_interaction does before it calls a handler
+    def compiled(custom_id: str) -> Any:
+        head, _, rest = custom_id.partition('-')
+        route = ROUTES.get(head)
+        if route is None:
+            return None
+        id, _, number = rest.partition('-')
+        if route[0] == 'questionnaire':
+            return route[1], id, number
+        return routes.get(route[1]), id, number
+
+    print(f'{"path":<10}{"ns per interaction":>20}')
+    for name, func in (('legacy', legacy_route), ('compiled', compiled)):
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            for custom_id in ids:
+                func(custom_id)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<10}{elapsed / (args.ops * len(ids)) * 1e9:>20.0f}')
+
+
+def allocations(func: Any, runs: int) -> tuple[float, float]:
+    """Average (peak bytes allocated, microseconds) per call of func()."""
+    func()  # warm up caches
+    tracemalloc.start()
+    total = 0
+    for _ in range(runs):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    elapsed = time.perf_counter() - start
+    return total / runs, elapsed / runs * 1e6
+
+
+async def bench_render(args: argparse.Namespace) -> None:
+    import discord
+    from cogs import questionnaire as q
+    from settings import settings
+
+    questions = settings.questions
+    answer = fake_answer(0)
+    answer['answers'][0] = questions[0]['choices'][1]
+    cog: Any = argparse.Namespace(schemas={answer['schema']: questions})
+    log_view = q.LogView(bot=None, cog=cog, answer=answer, question_index=0)  # type: ignore
+    snapshot = q.Snapshot(questions, settings.sim_tags, paged=False)
+    session = q.Session(user_id=1, token='', snapshot=snapshot)
+    session.started = True
+    questionnaire = q.QuestionnaireView(bot=None, cog=cog, session=session)  # type: ignore
+
+    choices = questions[0]['choices']
+    selected = choices[1]
+
+    def legacy_options() -> list[discord.SelectOption]:
+        return [discord.SelectOption(label=choice, value=choice, default=choice == selected)
+                for choice in choices]
+
+    def template_options() -> list[discord.SelectOption]:
+        return q.selected_options(choices, selected)
+
+    print(f'{"render":<28}{"bytes/click":>14}{"us/click":>12}')
+    for name, func in (
+        ('series options (legacy)', legacy_options),
+        ('series options (template)', template_options),
+        ('QuestionnaireView', questionnaire.update_components),
+        ('LogView (editing series)', log_view.update_components),
+    ):
+        peak, micros = allocations(func, args.ops)
+        print(f'{name:<28}{peak:>14.0f}{micros:>12.1f}')
+
+
+class StubResponse:
+    """Enough of discord.InteractionResponse to drive the views."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.modal: Any = None
+
+    async def send_message(self, *args: Any, **kwargs: Any) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def edit_message(self, *args: Any, **kwargs: Any) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def send_modal(self, modal: Any) -> None:
+        await asyncio.sleep(self.latency)
+        self.modal = modal
+
+
+class StubInteraction:
+    def __init__(self, latency: float, data: Optional[dict] = None) -> None:
+        self.user = argparse.Namespace(id=1)
+        self.token = 'token'
+        self.data = data or {}
+        self.response = StubResponse(latency)
+        self.latency = latency
+
+
+async def bench_questionnaire(args: argparse.Namespace) -> None:
+    """Fills in the questionnaire in each mode, counting interactions."""
+    from cogs import questionnaire as q
+    from settings import settings
+    settings.load_all()  # before moving to the temporary directory
+
+    latency = args.latency / 1000
+    print(f'{"mode":<8}{"pages":>7}{"interactions":>14}{"modals":>8}{"e2e (ms)":>10}')
+    path, cwd = tempfile.mkdtemp(), os.getcwd()
+    os.chdir(path)  # for drafts.json
+    for mode in ('single', 'paged'):
+        snapshot = q.Snapshot(settings.questions, settings.sim_tags, paged=mode == 'paged')
+
+        async def send(*args: Any, **kwargs: Any) -> None:
+            await asyncio.sleep(latency)
+
+        async def put(*args: Any, **kwargs: Any) -> None:
+            pass
+
+        async def expire(sessions: list) -> None:
+            pass
+
+        cog: Any = argparse.Namespace(
+            sessions=q.SessionStore(ttl=300.0, on_expire=expire),
+            drafts=q.DraftStore('drafts.json', ttl=3600),
+            schemas={snapshot.version: snapshot.questions},
+            answers=argparse.Namespace(put=put),
+            log_channel=argparse.Namespace(send=send),
+        )
+        bot: Any = argparse.Namespace(
+            dispatch=lambda *args: None,
+            embed=lambda *a, **kw: argparse.Namespace(
+                add_field=lambda **kw: None, description=None, color=None))
+
+        start = time.perf_counter()
+        interactions = modals = 0
+        session = cog.sessions.open(1, 'token', snapshot)
+        view = q.QuestionnaireView(bot=bot, cog=cog, session=session)  # type: ignore
+        await view.run(StubInteraction(latency))  # type: ignore
+        interactions += 1
+        while not view.done:
+            # The first control that still needs an answer
+            for item in view.children:
+                parsed = q.parse_custom_id(getattr(item, 'custom_id', None) or '')
+                if parsed and not (parsed[3] and int(parsed[3]) in session.choices):
+                    break
+            data: dict = {'custom_id': item.custom_id}
+            if hasattr(item, 'options'):
+                data['values'] = [item.options[0].value]
+            interaction = StubInteraction(latency, data)
+            # Each click gets a fresh view, the same as Cog.questionnaire_click
+            view = q.QuestionnaireView(bot=bot, cog=cog, session=session)  # type: ignore
+            await view.handle(interaction, parsed[1], int(parsed[3]) if parsed[3] else None)  # type: ignore
+            interactions += 1
+            modal = interaction.response.modal
+            if modal is not None:
+                for field in modal.answers:
+                    field._value = 'answer'
+                await modal.on_submit(StubInteraction(latency))
+                interactions += 1
+                modals += 1
+        elapsed = (time.perf_counter() - start) * 1000
+        assert len(view.answers) == len(snapshot.questions), view.answers
+        print(f'{mode:<8}{len(snapshot.pages):>7}{interactions:>14}{modals:>8}{elapsed:>10.0f}')
+        await cog.drafts.close()
+    os.chdir(cwd)
+    shutil.rmtree(path)
+
+
+async def bench_sessions(args: argparse.Namespace) -> None:
+    """Memory held by open questionnaires, and how expiry is batched."""
+    import discord
+    from cogs import questionnaire as q
+
+    n = args.sessions
+    print(f'{"open questionnaires":<28}{"bytes/session":>14}')
+
+    # What each open questionnaire used to hold on to: a View with its own
+    # timeout, plus the interaction it would edit when that fired.
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    views = []
+    for i in range(n):
+        view = discord.ui.View(timeout=300)
+        view.answers = []  # type: ignore
+        view.interaction = StubInteraction(0)  # type: ignore
+        views.append(view)
+    per_view = (tracemalloc.get_traced_memory()[0] - before) / n
+    tracemalloc.stop()
+    print(f'{"View(timeout=300)":<28}{per_view:>14.0f}')
+    for view in views:
+        view.stop()
+    del views
+    await asyncio.sleep(0)
+
+    expired: list[int] = []
+
+    async def on_expire(sessions: list) -> None:
+        expired.append(len(sessions))
+
+    from settings import settings
+    snapshot = q.Snapshot(settings.questions, settings.sim_tags, paged=True)
+    store = q.SessionStore(ttl=0.2, on_expire=on_expire)
+    store.start()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        store.open(i, 'x' * 200, snapshot)  # interaction tokens are ~200 characters
+    per_session = (tracemalloc.get_traced_memory()[0] - before) / n
+    tracemalloc.stop()
+    print(f'{"SessionStore":<28}{per_session:>14.0f}')
+
+    await asyncio.sleep(0.5)
+    await store.stop()
+    print(f'\n{sum(expired)} sessions expired in {len(expired)} batch(es), '
+          f'{len(store)} left open')
+
+
+async def bench_search(args: argparse.Namespace) -> None:
+    """/irr search over --pending indexed IRRs."""
+    import random
+    from cogs import irr
+
+    async def put(*args: Any, **kwargs: Any) -> None:
+        pass
+
+    rng = random.Random(0)
+    tracks = ['Spa-Francorchamps', 'Monza', 'Brands Hatch', 'Road Atlanta',
+              'Mount Panorama', 'Nurburgring Nordschleife', 'Imola', 'Suzuka']
+    drivers = [f'Driver{n} Surname{n % 97}' for n in range(2000)]
+    series = [f'Sim{n % 4} › Day{n % 7} › Series {n}' for n in range(12)]
+
+    index = irr.SearchIndex(argparse.Namespace(all=dict, put=put))  # type: ignore
+    start = time.perf_counter()
+    for i in range(args.pending):
+        answer = fake_answer(i)
+        answer['user_id'] = rng.randrange(500)
+        answer['answers'][0] = rng.choice(series)
+        answer['answers'][1] = rng.choice(tracks)
+        answer['answers'][3] = rng.choice(drivers)
+        await index.update(answer)
+    print(f'Indexed {args.pending} IRRs in {time.perf_counter() - start:.2f}s\n')
+
+    print(f'{"query":<34}{"matches":>9}{"ms/query":>10}')
+    for name, query in (
+        ('driver', dict(driver='driver42 surname42')),
+        ('driver prefix', dict(driver='driver4')),
+        ('track', dict(track='spa')),
+        ('track + series', dict(track='monza', series='series 3')),
+        ('submitter', dict(user_id=7)),
+        ('submitter + status', dict(user_id=7, status='pending')),
+    ):
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            count, _docs = index.search(**query)  # type: ignore
+        elapsed = time.perf_counter() - start
+        print(f'{name:<34}{count:>9}{elapsed / args.ops * 1000:>10.3f}')
+
+
+async def loop_lag(seconds: float, interval: float = 0.001) -> list[float]:
+    """How late each of a series of short sleeps woke up, in ms."""
+    lags: list[float] = []
+    end = time.perf_counter() + seconds
+    while (now := time.perf_counter()) < end:
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - now - interval) * 1000)
+    return lags
+
+
+async def bench_logging(args: argparse.Namespace) -> None:
+    """Event loop lag while logging at increasing rates, with and without the queue."""
+    import logging
+    import statistics
+    from logger import SetupLogging, log_context
+
+    def direct(file: str, json_lines: bool) -> Any:
+        # What SetupLogging used to do: format and write on the calling thread
+        setup = SetupLogging(file=file, json_lines=json_lines)
+        root = logging.getLogger()
+        handler = setup.handler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(message)s'))
+
+        class Direct:
+            def __enter__(self) -> None:
+                root.setLevel(logging.INFO)
+                root.addHandler(handler)
+
+            def __exit__(self, *args: Any) -> None:
+                root.removeHandler(handler)
+                handler.close()
+        return Direct()
+
+    log = logging.getLogger('bench')
+    path = tempfile.mkdtemp()
+    print(f'{"pipeline":<14}{"target/s":>9}{"logged/s":>9}'
+          f'{"p50 (ms)":>10}{"p99 (ms)":>10}{"max (ms)":>10}')
+    try:
+        for name, setup in (
+            ('direct', lambda: direct(os.path.join(path, 'direct.log'), False)),
+            ('queue', lambda: SetupLogging(file=os.path.join(path, 'queue.log'))),
+            ('queue+json', lambda: SetupLogging(
+                file=os.path.join(path, 'json.log'), json_lines=True)),
+        ):
+            for rate in (0, 1000, 10000, 50000):
+                async def produce() -> int:
+                    per_tick = rate // 1000
+                    end = time.perf_counter() + 1.0
+                    i = 0
+                    with log_context(interaction_id=1234567890, answer_id='0badcafe'):
+                        while time.perf_counter() < end:
+                            for _ in range(per_tick):
+                                log.info('Answer %s edited by %d', f'{i:08x}', i)
+                                i += 1
+                            await asyncio.sleep(0.001)
+                    return i
+
+                with setup():
+                    lags, logged = await asyncio.gather(loop_lag(1.0), produce())
+                lags.sort()
+                print(f'{name:<14}{rate:>9}{logged:>9}{statistics.median(lags):>10.3f}'
+                      f'{lags[int(len(lags) * 0.99)]:>10.3f}{lags[-1]:>10.3f}')
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'irr': bench_irr,
+    'routing': bench_routing,
+    'render': bench_render,
+    'questionnaire': bench_questionnaire,
+    'sessions': bench_sessions,
+    'search': bench_search,
+    'logging': bench_logging,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--ops', type=int, default=200,
+                        help='operations per measurement')
+    parser.add_argument('--pending', type=int, default=10000,
+                        help='largest number of pending answers')
+    parser.add_argument('--latency', type=float, default=100,
+                        help='simulated Discord round trip in ms')
+    parser.add_argument('--sessions', type=int, default=1000,
+                        help='concurrent questionnaires to open')
+    args = parser.parse_args()
+    asyncio.run(BENCHMARKS[args.benchmark](args))
+
+
+if __name__ == '__main__':
+    main()
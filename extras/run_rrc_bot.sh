@@ -23,6 +23,7 @@ REPO=rjt-pl/cms-rrc-bot
 BASE=~/cms-rrc-bot
 PID=$BASE/cms-rrc-bot.pid
 LOG=$BASE/cms-rrc-bot.log
+ERR=$BASE/cms-rrc-bot.err
 
 # Clone repo if $BASE doesn't exist yet
 if [ ! -d $BASE ]; then
@@ -69,6 +70,7 @@ if [ -f $PIDFILE ]; then
     fi
 fi
 
-# Run the bot
+# Run the bot. main.py writes and rotates $LOG itself; anything that
+# bypasses logging (e.g. a crash during interpreter shutdown) ends up in $ERR.
 echo "Starting process"
-./main.py 2>&1 >>$LOG &
+./main.py --log-file $LOG >>$ERR 2>&1 &
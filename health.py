@@ -0,0 +1,119 @@
+# health.py - /healthz and /readyz for monit
+#
+# Served next to /metrics (see metrics.py) when config.json has an "http"
+# section:
+#
+#   curl -s http://127.0.0.1:9108/healthz
+#
+# /healthz answers 200 if every check below passes and 503 if any fails,
+# with the details as JSON either way:
+#
+#   gateway       the websocket is connected, or has been down for less
+#                 than gateway_grace seconds (reconnects are normal)
+#   loop          the event loop lag stayed under max_loop_lag seconds in
+#                 the last minute (see watchdog.py)
+#   storage       no store has had unsaved changes for over max_flush_age
+#                 seconds (see utils.flush_backlog())
+#   interactions  an interaction was answered in the last max_idle seconds,
+#                 if max_idle is set; a quiet server is not a broken one
+#
+# A loop that is stuck outright can't answer at all, which monit sees as a
+# timeout. /readyz answers 200 once Bot.setup_hook() has finished.
+#
+# The thresholds come from the optional "health" section of config.json.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import math
+import time
+
+from aiohttp import web
+
+from metrics import metrics
+from utils import flush_backlog
+from watchdog import watchdog
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from bot import Bot
+    from typing import (
+        Optional,
+        Any,
+    )
+
+
+__all__ = (
+    'Health',
+)
+
+
+def _ms(seconds: float) -> Optional[float]:
+    return round(seconds * 1000, 1) if math.isfinite(seconds) else None
+
+
+class Health:
+    def __init__(
+        self,
+        bot: Bot,
+        gateway_grace: float = 120.0,
+        max_loop_lag: float = 5.0,
+        max_flush_age: float = 60.0,
+        max_idle: Optional[float] = None,
+    ) -> None:
+        self.bot = bot
+        self.gateway_grace = gateway_grace
+        self.max_loop_lag = max_loop_lag
+        self.max_flush_age = max_flush_age
+        self.max_idle = max_idle
+        self.started = time.perf_counter()
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+
+    def checks(self) -> dict[str, dict[str, Any]]:
+        bot = self.bot
+        down_for = 0.0 if bot.gateway_connected else time.monotonic() - bot.gateway_changed
+        lag, max_lag = watchdog.lag()
+        backlog, oldest = flush_backlog()
+        last = metrics.interactions.last_success
+        # Nothing answered yet counts as idle since startup
+        idle = time.perf_counter() - (self.started if last is None else last)
+        return {
+            'gateway': {
+                'ok': not bot.is_closed() and down_for < self.gateway_grace,
+                'connected': bot.gateway_connected,
+                'since_s': round(time.monotonic() - bot.gateway_changed, 1),
+                'latency_ms': _ms(bot.latency),
+            },
+            'loop': {
+                'ok': max_lag < self.max_loop_lag,
+                'lag_ms': _ms(lag),
+                'max_lag_ms': _ms(max_lag),
+            },
+            'storage': {
+                'ok': oldest < self.max_flush_age,
+                'backlog': backlog,
+                'oldest_s': round(oldest, 1),
+            },
+            'interactions': {
+                'ok': self.max_idle is None or idle < self.max_idle,
+                'last_success_s': None if last is None else round(idle, 1),
+            },
+        }
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        checks = self.checks()
+        ok = all(check['ok'] for check in checks.values())
+        return web.json_response(
+            {'status': 'ok' if ok else 'fail', 'checks': checks},
+            status=200 if ok else 503,
+        )
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        ready = self.bot.setup_done and not self.bot.is_closed()
+        return web.json_response(
+            {'status': 'ok' if ready else 'starting'},
+            status=200 if ready else 503,
+        )
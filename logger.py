@@ -1,13 +1,29 @@
 from __future__ import annotations
 import logging
 from logging import StreamHandler
+from logging.handlers import (
+    TimedRotatingFileHandler,
+    RotatingFileHandler,
+    QueueListener,
+    QueueHandler,
+)
+from contextvars import ContextVar
+import contextlib
+import datetime
+import shutil
+import queue
+import gzip
+import json
 import sys
+import os
 
 from typing import (
     TYPE_CHECKING,
 )
 if TYPE_CHECKING:
     from typing import (
+        Iterator,
+        Optional,
         Any,
     )
     from typing_extensions import (
@@ -15,6 +31,32 @@ if TYPE_CHECKING:
     )
 
 
+__all__ = (
+    'ColourFormatter',
+    'JSONFormatter',
+    'SetupLogging',
+    'log_context',
+)
+
+# Ids of whatever the current task is working on, copied onto every record
+# logged from it. See log_context().
+CONTEXT: dict[str, ContextVar[Optional[int | str]]] = {
+    'interaction_id': ContextVar('interaction_id', default=None),
+    'answer_id': ContextVar('answer_id', default=None),
+}
+
+
+@contextlib.contextmanager
+def log_context(**ids: Optional[int | str]) -> Iterator[None]:
+    """Tags everything logged inside the block (by this task) with ``ids``."""
+    tokens = [(CONTEXT[name], CONTEXT[name].set(value)) for name, value in ids.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
 class ColourFormatter(logging.Formatter):
     LEVEL_COLOURS: list[tuple[int, str]] = [
         (logging.DEBUG, '\x1b[40;1m'),
@@ -36,30 +78,133 @@ class ColourFormatter(logging.Formatter):
         if formatter is None:
             formatter = self.FORMATS[logging.DEBUG]
 
-        if record.exc_info:  # Override the traceback to always print in red
+        # Override the traceback to always print in red. Records that came
+        # through the queue only have the already formatted exc_text.
+        cached = record.exc_text
+        if record.exc_info:
             text = formatter.formatException(record.exc_info)
             record.exc_text = f'\x1b[31m{text}\x1b[0m'
+        elif cached:
+            record.exc_text = f'\x1b[31m{cached}\x1b[0m'
 
         output = formatter.format(record)
-        record.exc_text = None  # Remove the cache layer
+        record.exc_text = cached  # Remove the cache layer
         return output
 
 
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the ids from :func:`log_context`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in CONTEXT:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """Hands records to the listener thread with as little work as possible.
+
+    The ids from :func:`log_context` are read here, on the logging task,
+    since the listener thread can't see them. The message and traceback
+    are rendered to strings so the record no longer references its args or
+    frames, but the record is otherwise left for the listener's formatter.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        for name, var in CONTEXT.items():
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _compress(source: str, dest: str) -> None:
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
 class SetupLogging:
-    def __init__(self) -> None:
+    """Logs through a queue, so the event loop never formats or writes.
+
+    Records go to stdout, or to ``file`` if given, as text or, with
+    ``json_lines``, through :class:`JSONFormatter`. A log file is rotated
+    once it reaches ``max_bytes``, or at ``when`` (as for
+    :class:`~logging.handlers.TimedRotatingFileHandler`) if that is given,
+    and the old files are gzipped; ``backups`` of them are kept.
+    """
+
+    def __init__(
+        self,
+        file: Optional[str] = None,
+        json_lines: bool = False,
+        max_bytes: int = 10 << 20,
+        when: Optional[str] = None,
+        backups: int = 10,
+    ) -> None:
         self.log = logging.getLogger()
+        self.file = file
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.when = when
+        self.backups = backups
+        self.listener: Optional[QueueListener] = None
+
+    def handler(self) -> logging.Handler:
+        if self.file is None:
+            return StreamHandler(sys.stdout)
+        handler: RotatingFileHandler | TimedRotatingFileHandler
+        if self.when is not None:
+            handler = TimedRotatingFileHandler(
+                self.file, when=self.when, backupCount=self.backups,
+                encoding='utf-8', utc=True)
+        else:
+            handler = RotatingFileHandler(
+                self.file, maxBytes=self.max_bytes, backupCount=self.backups,
+                encoding='utf-8')
+        # Runs on the listener thread, so compressing doesn't hold up the bot
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = _compress
+        return handler
 
     def __enter__(self) -> Self:
         self.log.setLevel(logging.INFO)
-        handlers: list[tuple[logging.Handler, logging.Formatter]] = [
-            (
-                StreamHandler(sys.stdout),
-                ColourFormatter()
-            )
-        ]
-        for handler, formatter in handlers:
-            handler.setFormatter(formatter)
-            self.log.addHandler(handler)
+        formatter: logging.Formatter
+        if self.json_lines:
+            formatter = JSONFormatter()
+        elif self.file is None:
+            formatter = ColourFormatter()
+        else:
+            formatter = logging.Formatter(
+                '[%(asctime)s] [%(levelname)-7s] %(name)s: %(message)s',
+                '%Y-%m-%d %H:%M:%S')
+        handler = self.handler()
+        handler.setFormatter(formatter)
+
+        records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        self.listener = QueueListener(records, handler, respect_handler_level=True)
+        self.listener.start()
+        self.log.addHandler(_QueueHandler(records))
         return self
 
     def __exit__(self, *args: Any) -> None:
@@ -67,3 +212,8 @@ class SetupLogging:
         for handler in handlers:
             handler.close()
             self.log.removeHandler(handler)
+        if self.listener is not None:
+            self.listener.stop()  # drains the queue first
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
@@ -1,52 +1,123 @@
 #!/usr/bin/env python3
 
 from __future__ import annotations
+import time
+STARTED = time.perf_counter()  # before the heavy imports, see --profile-startup
+
 from bot import Bot
 
+import argparse
 import asyncio
-import json
 
 from logger import SetupLogging
 import logging
 
-from utils import PIDFile
+from health import Health
+from metrics import (
+    Exporter,
+    metrics,
+)
+from replay import Recorder
 
-from typing import (
-    TYPE_CHECKING,
+from settings import (
+    ConfigError,
+    Watcher,
+    settings,
 )
+from utils import (
+    StartupProfile,
+    PIDFile,
+)
+from watchdog import watchdog
 
+from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from typing import (
-        NotRequired,
-        TypedDict,
-        Literal,
-    )
+    from typing import Optional
 
-    class _Config(TypedDict):
-        pidfile: str
-        token: str
-        owner_ids: list[int]
-        guild_id: int
-        log_channel_id: int
-        forum_channel_id: int
+IMPORTED = time.perf_counter()
 
 log = logging.getLogger(__name__)
 
-with open('config/config.json', 'r', encoding='utf-8') as file:
-    config: _Config = json.load(file)
 
+async def start(profile: bool = False, record: Optional[str] = None) -> None:
+    startup = StartupProfile(STARTED)
+    startup.add('imports', IMPORTED - STARTED)
+    with startup.phase('config'):
+        settings.load_all()
+    for name, seconds in settings.timings.items():
+        startup.add(f'config:{name}', seconds, detail=True)
+    config = settings.config
 
-async def start() -> None:
     pidfile = PIDFile(config.get('pidfile'))
     bot = Bot(
         owner_ids=config.get('owner_ids'),
+        gateway=config.get('gateway'),
+        startup=startup if profile else None,
+        guild_ids=[config['guild_id']],
     )
-    await bot.start(config.get('token'))
+    recorder = Recorder(record) if record is not None else None
+    if recorder is not None:
+        bot.add_listener(recorder.on_interaction)
+        bot.add_listener(recorder.on_irr_submitted)
+    exporter = Exporter(metrics, **config['http']) if 'http' in config else None
+    if exporter is not None:
+        Health(bot, **config.get('health', {})).add_routes(exporter.app)
+        await exporter.start()
+    watchdog.configure(**config.get('watchdog', {}))
+    watchdog.start()
+    watcher = Watcher(settings)
+    watcher.start()
+    try:
+        await bot.start(config.get('token'))
+    finally:
+        await watcher.stop()
+        await watchdog.stop()
+        if exporter is not None:
+            await exporter.stop()
+        if recorder is not None:
+            recorder.close()
 
 
 def main() -> None:
-    with SetupLogging():
-        asyncio.run(start())
+    parser = argparse.ArgumentParser(description='Runs the RRC bot.')
+    parser.add_argument(
+        '--profile-startup', action='store_true',
+        help='print how long each startup phase took once the gateway is '
+             'READY, then exit')
+    parser.add_argument(
+        '--record-interactions', metavar='PATH',
+        help='append every button click and modal submission to PATH, with '
+             'ids scrubbed, for ./replay.py')
+    parser.add_argument(
+        '--log-file', metavar='PATH',
+        help='log to PATH instead of stdout, rotating and gzipping old logs')
+    parser.add_argument(
+        '--log-json', action='store_true',
+        help='log one JSON object per line, with interaction and answer ids')
+    parser.add_argument(
+        '--log-max-bytes', type=int, default=10 << 20, metavar='N',
+        help='rotate the log file once it reaches N bytes (default: 10 MiB)')
+    parser.add_argument(
+        '--log-rotate-when', metavar='WHEN',
+        help='rotate the log file on a schedule instead, e.g. midnight or '
+             'W0 (see logging.handlers.TimedRotatingFileHandler)')
+    parser.add_argument(
+        '--log-backups', type=int, default=10, metavar='N',
+        help='number of rotated log files to keep (default: 10)')
+    args = parser.parse_args()
+    with SetupLogging(
+        file=args.log_file,
+        json_lines=args.log_json,
+        max_bytes=args.log_max_bytes,
+        when=args.log_rotate_when,
+        backups=args.log_backups,
+    ):
+        try:
+            asyncio.run(start(profile=args.profile_startup,
+                              record=args.record_interactions))
+        except ConfigError as e:
+            log.critical(e)
+            raise SystemExit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,379 @@
+# metrics.py - Latency histograms, counters and gauges
+#
+# Everything the bot measures is registered on the shared `metrics` registry
+# at the bottom of this file, so this is the one place to look for what is
+# exported:
+#
+#   from metrics import metrics
+#   metrics.storage_flush.observe(0.004, store='answers.json', kind='save')
+#   metrics.pending_answers.set_function(lambda: len(answers))
+#
+# With "http": {"port": 9108} in config.json, main.py serves the lot in the
+# Prometheus text format at http://127.0.0.1:9108/metrics.
+#
+# Interactions are timed from the moment Cog.on_interaction sees them to the
+# end of the REST call that answers them, which is picked out of the bot's
+# HTTP trace (see trace_config()).
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import contextlib
+import logging
+import math
+import time
+import re
+
+import aiohttp
+from aiohttp import web
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from types import SimpleNamespace
+    from typing import (
+        Callable,
+        Iterator,
+        Optional,
+        Any,
+    )
+
+
+__all__ = (
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'Exporter',
+    'metrics',
+)
+
+log = logging.getLogger(__name__)
+
+# Seconds. Interactions have to be answered within 3 seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind: str = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], Any] = {}
+
+    def _key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        if labels.keys() != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, not {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _labels(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = [*zip(self.labels, key), *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{self._labels(key)} {_number(value)}'
+
+    def render(self) -> list[str]:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.kind}',
+            *self.samples(),
+        ]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down.
+
+    Either :meth:`set` it, or give it a function with :meth:`set_function`
+    that is called whenever the metrics are scraped.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels: Any) -> None:
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function: Optional[Callable[[], float]]) -> None:
+        self.function = function
+
+    def samples(self) -> Iterator[str]:
+        if self.function is not None:
+            try:
+                self.values[()] = self.function()
+            except Exception:
+                log.exception(f'Could not read {self.name}')
+                return
+        yield from super().samples()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # One count per bucket (not cumulative), then +Inf, sum and count
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                total += count
+                yield f'{self.name}_bucket{self._labels(key, le=_number(bound))} {total}'
+            yield f'{self.name}_sum{self._labels(key)} {_number(counts[-2])}'
+            yield f'{self.name}_count{self._labels(key)} {counts[-1]}'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, _Metric] = {}
+
+    def _add(self, metric: Any) -> Any:
+        if metric.name in self.metrics:
+            raise ValueError(f'{metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Discord gives up on an interaction that isn't answered (or deferred)
+# within 3 seconds. Anything still unanswered after this never will be.
+ANSWER_BY = 5.0
+
+INTERACTION_CALLBACK = re.compile(r'/interactions/(\d+)/[^/]+/callback$')
+
+
+def route(method: str, path: str) -> str:
+    """``POST /channels/{id}/messages`` for a request path.
+
+    Ids, tokens and emoji are replaced so every route is one label value.
+    """
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] == 'api' and parts[2].startswith('v'):
+        del parts[1:3]
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            parts[i] = '{id}'
+        elif i and parts[i - 1] == 'reactions':
+            parts[i] = '{emoji}'
+        elif i > 1 and parts[i - 2] in ('interactions', 'webhooks'):
+            parts[i] = '{token}'
+    return f'{method} {"/".join(parts)}'
+
+
+class _Interactions:
+    """Interactions seen by on_interaction that haven't been answered yet."""
+
+    def __init__(self, registry: Registry) -> None:
+        self.received: dict[int, tuple[float, str]] = {}
+        # perf_counter() when an interaction was last answered successfully
+        self.last_success: Optional[float] = None
+        self.total = registry.counter(
+            'rrc_interactions_total',
+            'Interactions received, by handler.', ('handler',))
+        self.response = registry.histogram(
+            'rrc_interaction_response_seconds',
+            'Time from receiving an interaction to the end of the request '
+            'that answered it.', ('handler',))
+        self.unanswered = registry.counter(
+            'rrc_interactions_unanswered_total',
+            'Interactions that were never answered.', ('handler',))
+        self.handler = registry.histogram(
+            'rrc_interaction_handler_seconds',
+            'Time spent in on_interaction routing and its handler.', ('handler',))
+
+    def receive(self, interaction_id: int, handler: str) -> None:
+        now = time.perf_counter()
+        self.total.inc(handler=handler)
+        # Oldest first, so only expired entries are ever looked at
+        while self.received:
+            id = next(iter(self.received))
+            received, name = self.received[id]
+            if now - received < ANSWER_BY:
+                break
+            del self.received[id]
+            self.unanswered.inc(handler=name)
+        self.received[interaction_id] = (now, handler)
+
+    def responded(self, interaction_id: int, end: float, ok: bool = True) -> None:
+        if ok:
+            self.last_success = end
+        entry = self.received.pop(interaction_id, None)
+        if entry is not None:
+            received, handler = entry
+            self.response.observe(end - received, handler=handler)
+
+
+class _Metrics(Registry):
+    """The bot's metrics. See the top of this file."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.interactions = _Interactions(self)
+        self.rest = self.histogram(
+            'rrc_rest_request_seconds',
+            'Discord REST request latency, by route.', ('route',))
+        self.rest_total = self.counter(
+            'rrc_rest_requests_total',
+            'Discord REST requests, by route and status.', ('route', 'status'))
+        self.storage_flush = self.histogram(
+            'rrc_storage_flush_seconds',
+            'Time to write a store to disk. kind is save, journal, compact or sqlite.',
+            ('store', 'kind'))
+        self.storage_errors = self.counter(
+            'rrc_storage_flush_errors_total',
+            'Failed writes, by store.', ('store',))
+        self.storage_backlog = self.gauge(
+            'rrc_storage_backlog', 'Stores with changes that are not on disk yet.')
+        self.pending_answers = self.gauge(
+            'rrc_pending_answers', 'IRRs waiting for a decision.')
+        self.sessions = self.gauge(
+            'rrc_questionnaire_sessions', 'Questionnaires in progress.')
+        self.gateway_latency = self.gauge(
+            'rrc_gateway_latency_seconds', 'Latency between a HEARTBEAT and its ACK.')
+        self.loop_lag = self.histogram(
+            'rrc_loop_lag_seconds',
+            'How late the watchdog woke up, i.e. how long the event loop was busy.',
+            buckets=LAG_BUCKETS)
+        self.loop_lag_max = self.gauge(
+            'rrc_loop_lag_max_seconds', 'Largest loop lag in the last minute.')
+        self.loop_stalls = self.counter(
+            'rrc_loop_stalls_total', 'Times the event loop was blocked past the stall threshold.')
+        self.slow_handlers = self.counter(
+            'rrc_slow_handlers_total',
+            'Listeners and modal submissions that ran past the slow handler threshold.',
+            ('handler',))
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Times every request made through a session that uses it."""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session: aiohttp.ClientSession, context: SimpleNamespace,
+                                   params: aiohttp.TraceRequestStartParams) -> None:
+            context.start = time.perf_counter()
+
+        async def on_request_end(session: aiohttp.ClientSession, context: SimpleNamespace,
+                                 params: aiohttp.TraceRequestEndParams) -> None:
+            end = time.perf_counter()
+            name = route(params.method, params.url.path)
+            self.rest.observe(end - context.start, route=name)
+            self.rest_total.inc(route=name, status=params.response.status)
+            match = INTERACTION_CALLBACK.search(params.url.path)
+            if match is not None:
+                self.interactions.responded(int(match[1]), end, params.response.status < 400)
+
+        async def on_request_exception(session: aiohttp.ClientSession, context: SimpleNamespace,
+                                       params: aiohttp.TraceRequestExceptionParams) -> None:
+            self.rest_total.inc(route=route(params.method, params.url.path), status='error')
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+
+class Exporter:
+    """Serves ``registry`` at ``http://host:port/metrics``.
+
+    Other routes (see health.py) can be added to :attr:`app` before
+    :meth:`start`.
+    """
+
+    def __init__(self, registry: Registry, host: str = '127.0.0.1', port: int = 9108) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get('/metrics', self.metrics)
+        self.runner: Optional[web.AppRunner] = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+
+    async def start(self) -> None:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+metrics = _Metrics()
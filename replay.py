@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#
+# replay.py - Record interactions, and replay them without Discord
+#
+# To record the component clicks and modal submissions the bot receives:
+#
+#   ./main.py --record-interactions interactions.jsonl
+#
+# Discord ids (users, messages, channels, interactions) are replaced by
+# small numbers and tokens are dropped, so a recording can be shared. The
+# custom_ids are kept, since the replay needs them, and so are the values
+# typed into modals.
+#
+# To replay a recording against cogs.questionnaire.Cog, with fake guild,
+# channels and interactions that take --latency ms per REST call:
+#
+#   ./replay.py run interactions.jsonl --latency 100
+#
+# The replay starts from empty storage in a temporary directory, so record
+# whole flows: from the start button to the approval. It prints latency
+# percentiles and allocations per handler, and the storage writes and REST
+# calls the run made. Needs the usual config/ files.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+from collections import defaultdict
+import argparse
+import asyncio
+import logging
+import shutil
+import tempfile
+import tracemalloc
+import time
+import json
+import os
+
+import discord
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import (
+        Optional,
+        IO,
+        Any,
+    )
+    from cogs.questionnaire import _Answer
+
+
+__all__ = (
+    'Recorder',
+)
+
+log = logging.getLogger(__name__)
+
+
+class Recorder:
+    """Appends scrubbed interactions to ``path``, one JSON object per line.
+
+    Add :meth:`on_interaction` and :meth:`on_irr_submitted` as listeners.
+    The submissions let the replay match answer ids in later custom_ids to
+    the answers it creates itself.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.file: IO[str] = open(path, 'a', encoding='utf-8')
+        self.started = time.perf_counter()
+        self.ids: dict[int, int] = {}
+
+    def scrub(self, id: Optional[int]) -> Optional[int]:
+        if id is None:
+            return None
+        return self.ids.setdefault(id, len(self.ids) + 1)
+
+    def write(self, entry: dict[str, Any]) -> None:
+        entry = {'t': round(time.perf_counter() - self.started, 3), **entry}
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    async def on_interaction(self, interaction: discord.Interaction[Any]) -> None:
+        if interaction.type not in (discord.InteractionType.component,
+                                    discord.InteractionType.modal_submit):
+            return
+        self.write({
+            'type': interaction.type.name,
+            'id': self.scrub(interaction.id),
+            'user': self.scrub(interaction.user.id),
+            'channel': self.scrub(interaction.channel_id),
+            'message': self.scrub(interaction.message and interaction.message.id),
+            'data': interaction.data,
+        })
+
+    async def on_irr_submitted(self, answer: _Answer) -> None:
+        self.write({
+            'event': 'irr_submitted',
+            'user': self.scrub(answer['user_id']),
+            'answer_id': answer['id'],
+        })
+
+    def close(self) -> None:
+        self.file.close()
+
+
+#
+# Stand-ins for the parts of discord.py the questionnaire cog talks to.
+# Every call that would hit the REST API goes through Rest.call().
+#
+class Rest:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+
+    async def call(self, name: str) -> None:
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+
+
+class StubMessage:
+    def __init__(self, rest: Rest, id: int, channel_id: int = 0) -> None:
+        self.rest = rest
+        self.id = id
+        self.channel = argparse.Namespace(id=channel_id)
+
+    async def edit(self, **kwargs: Any) -> StubMessage:
+        await self.rest.call('Message.edit')
+        return self
+
+
+class StubMember:
+    def __init__(self, rest: Rest, id: int) -> None:
+        self.rest = rest
+        self.id = id
+        self.display_name = f'User {id}'
+
+    def __str__(self) -> str:
+        return self.display_name
+
+    async def send(self, **kwargs: Any) -> StubMessage:
+        await self.rest.call('Member.send')
+        return StubMessage(self.rest, 0)
+
+
+class StubTextChannel:
+    kind = 'TextChannel'
+
+    def __init__(self, rest: Rest, id: int) -> None:
+        self.rest = rest
+        self.id = id
+        self.messages = 0
+
+    async def send(self, **kwargs: Any) -> StubMessage:
+        await self.rest.call(f'{self.kind}.send')
+        self.messages += 1
+        return StubMessage(self.rest, self.messages)
+
+
+class StubThread(StubTextChannel):
+    kind = 'Thread'
+
+
+class StubForumChannel:
+    def __init__(self, rest: Rest, id: int) -> None:
+        self.rest = rest
+        self.id = id
+        self.threads = 0
+
+    def get_tag(self, tag_id: int) -> None:
+        return None
+
+    async def create_thread(self, **kwargs: Any) -> argparse.Namespace:
+        await self.rest.call('ForumChannel.create_thread')
+        self.threads += 1
+        thread = StubThread(self.rest, self.threads)
+        return argparse.Namespace(thread=thread, message=StubMessage(self.rest, 0))
+
+
+class StubGuild:
+    def __init__(self, rest: Rest, config: dict[str, Any]) -> None:
+        self.rest = rest
+        self.id = config['guild_id']
+        self.channels: dict[int, Any] = {
+            config['log_channel_id']: StubTextChannel(rest, config['log_channel_id']),
+            config['forum_channel_id']: StubForumChannel(rest, config['forum_channel_id']),
+        }
+
+    def get_channel(self, id: int) -> Any:
+        return self.channels.get(id)
+
+    def get_member(self, id: int) -> None:
+        return None  # not cached, like a lean gateway profile
+
+    async def fetch_member(self, id: int) -> StubMember:
+        await self.rest.call('Guild.fetch_member')
+        return StubMember(self.rest, id)
+
+
+class StubResponse:
+    """discord.InteractionResponse. Notes when the interaction was answered."""
+
+    def __init__(self, interaction: StubInteraction) -> None:
+        self.interaction = interaction
+        self.answered: Optional[float] = None
+
+    async def _respond(self, name: str) -> None:
+        await self.interaction.rest.call(f'InteractionResponse.{name}')
+        if self.answered is None:
+            self.answered = time.perf_counter()
+
+    def is_done(self) -> bool:
+        return self.answered is not None
+
+    async def send_message(self, *args: Any, **kwargs: Any) -> None:
+        await self._respond('send_message')
+
+    async def edit_message(self, *args: Any, **kwargs: Any) -> None:
+        await self._respond('edit_message')
+
+    async def defer(self, *args: Any, **kwargs: Any) -> None:
+        await self._respond('defer')
+
+    async def send_modal(self, modal: discord.ui.Modal) -> None:
+        await self._respond('send_modal')
+        self.interaction.replay.modals[self.interaction.user.id] = modal
+
+
+class StubInteraction:
+    def __init__(self, replay: Replay, entry: dict[str, Any]) -> None:
+        self.replay = replay
+        self.rest = replay.rest
+        self.id: int = entry['id']
+        self.type = discord.InteractionType[entry['type']]
+        self.user = StubMember(self.rest, entry['user'])
+        self.channel_id: Optional[int] = entry.get('channel')
+        self.token = f'token-{self.id}'
+        self.data: dict[str, Any] = entry['data']
+        self.message = None if entry.get('message') is None else \
+            StubMessage(self.rest, entry['message'], self.channel_id or 0)
+        self.response = StubResponse(self)
+
+
+class StubBot:
+    def __init__(self, replay: Replay, guild: StubGuild) -> None:
+        from bot import Bot
+        from cache import Resolver
+        self.replay = replay
+        self.guild = guild
+        self.application_id = 1
+        self.owner_ids: set[int] = set()
+        self.resolver = Resolver()
+        self.embed = Bot.embed.__get__(self)
+
+    def get_guild(self, id: int) -> Optional[StubGuild]:
+        return self.guild if id == self.guild.id else None
+
+    def dispatch(self, event: str, *args: Any) -> None:
+        if event == 'irr_submitted':
+            self.replay.submitted(args[0])
+
+
+class Replay:
+    """One run of a recording against a fresh questionnaire cog."""
+
+    def __init__(self, entries: list[dict[str, Any]], latency: float, speed: float,
+                 allocations: bool = False) -> None:
+        from settings import settings
+        self.entries = entries
+        self.speed = speed
+        self.allocations = allocations
+        self.rest = Rest(latency)
+        self.bot = StubBot(self, StubGuild(self.rest, settings.config))  # type: ignore
+        # The last modal each user was shown, for their next modal_submit
+        self.modals: dict[int, discord.ui.Modal] = {}
+        # Recorded answer ids in the order each user submitted them, and
+        # what they turned into in this run
+        self.recorded: dict[int, list[str]] = defaultdict(list)
+        for entry in entries:
+            if entry.get('event') == 'irr_submitted':
+                self.recorded[entry['user']].append(entry['answer_id'])
+        self.answer_ids: dict[str, str] = {}
+        # handler -> [(seconds to first response, seconds in total, bytes)]
+        self.results: dict[str, list[tuple[float, float, int]]] = defaultdict(list)
+        self.skipped = 0
+
+    def submitted(self, answer: _Answer) -> None:
+        recorded = self.recorded[answer['user_id']]
+        if recorded:
+            self.answer_ids[recorded.pop(0)] = answer['id']
+
+    def custom_id(self, cog: Any, user: int, custom_id: str) -> str:
+        """The recorded custom_id, with this run's session and answer ids."""
+        from cogs.questionnaire import parse_custom_id
+        parsed = parse_custom_id(custom_id)
+        if parsed is None or not parsed[2]:
+            return custom_id
+        prefix, action, id, number = parsed
+        if prefix == 'questionnaire':
+            session = cog.sessions.get(user)
+            id = session.id if session is not None else id
+        else:
+            id = self.answer_ids.get(id, id)
+        return f'{prefix}:::{action}-{id}' + (f'-{number}' if number else '')
+
+    async def handle(self, cog: Any, interaction: StubInteraction) -> Optional[str]:
+        from cogs.questionnaire import handler_name
+        if interaction.type == discord.InteractionType.component:
+            interaction.data = {**interaction.data, 'custom_id': self.custom_id(
+                cog, interaction.user.id, interaction.data['custom_id'])}
+            await cog.on_interaction(interaction)
+            return handler_name(interaction)  # type: ignore
+
+        modal = self.modals.pop(interaction.user.id, None)
+        if modal is None:
+            return None
+        values = [component['value']
+                  for row in interaction.data.get('components', [])
+                  for component in row.get('components', [])]
+        for field, value in zip(modal.children, values):
+            field._value = value  # type: ignore
+        await modal.on_submit(interaction)  # type: ignore
+        return f'{type(modal).__name__}.on_submit'
+
+    async def run(self) -> None:
+        from cogs.questionnaire import Cog
+        cog = Cog(self.bot)  # type: ignore
+        await cog.cog_load()
+        started = time.perf_counter()
+        try:
+            for entry in self.entries:
+                if 'event' in entry:
+                    continue
+                if self.speed:
+                    delay = entry['t'] / self.speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                interaction = StubInteraction(self, entry)
+                if self.allocations:
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+                try:
+                    handler = await self.handle(cog, interaction)
+                except Exception:
+                    log.exception(f'Replaying interaction {entry["id"]} failed')
+                    handler = 'failed'
+                end = time.perf_counter()
+                allocated = tracemalloc.get_traced_memory()[1] - before if self.allocations else 0
+                if handler is None:
+                    self.skipped += 1
+                    continue
+                answered = interaction.response.answered or end
+                self.results[handler].append((answered - start, end - start, allocated))
+            # Let the forum publisher finish
+            while cog.publisher.pending:
+                await asyncio.sleep(0.01)
+        finally:
+            await cog.cog_unload()
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def storage_writes() -> dict[tuple[str, ...], tuple[int, float]]:
+    from metrics import metrics
+    return {key: (counts[-1], counts[-2]) for key, counts in metrics.storage_flush.values.items()}
+
+
+async def run(args: argparse.Namespace) -> None:
+    from settings import settings
+    settings.load_all()  # before moving to the temporary directory
+
+    with open(args.file, encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    clicks = sum(1 for entry in entries if 'event' not in entry)
+    print(f'Replaying {clicks} interactions from {args.file} '
+          f'with {args.latency:.0f}ms per REST call\n')
+
+    cwd = os.getcwd()
+
+    async def once(allocations: bool) -> Replay:
+        path = tempfile.mkdtemp()
+        os.chdir(path)
+        try:
+            replay = Replay(entries, args.latency / 1000, args.speed, allocations)
+            await replay.run()
+            return replay
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(path)
+
+    before = storage_writes()
+    replay = await once(allocations=False)
+    writes = {key: (count - before.get(key, (0, 0.0))[0], total - before.get(key, (0, 0.0))[1])
+              for key, (count, total) in storage_writes().items()}
+    # Allocations are measured in a second run, tracemalloc slows everything down
+    allocated: dict[str, list[int]] = {}
+    if not args.no_allocations:
+        tracemalloc.start()
+        traced = await once(allocations=True)
+        tracemalloc.stop()
+        allocated = {handler: [bytes for _, _, bytes in results]
+                     for handler, results in traced.results.items()}
+
+    print(f'{"handler":<34}{"n":>5}{"answered p50":>14}{"p90":>8}{"p99":>8}'
+          f'{"total p50":>11}{"p99":>8}{"KiB p50":>9}')
+    for handler, results in sorted(replay.results.items()):
+        answered = [result[0] * 1000 for result in results]
+        total = [result[1] * 1000 for result in results]
+        kib = [bytes / 1024 for bytes in allocated.get(handler, [])]
+        print(f'{handler:<34}{len(results):>5}{percentile(answered, 0.5):>14.1f}'
+              f'{percentile(answered, 0.9):>8.1f}{percentile(answered, 0.99):>8.1f}'
+              f'{percentile(total, 0.5):>11.1f}{percentile(total, 0.99):>8.1f}'
+              f'{percentile(kib, 0.5) if kib else 0.0:>9.1f}')
+    if replay.skipped:
+        print(f'\n{replay.skipped} modal submissions had no modal to go to')
+
+    print(f'\n{"store":<24}{"kind":<10}{"writes":>8}{"ms":>10}')
+    for (store, kind), (count, seconds) in sorted(writes.items()):
+        if count:
+            print(f'{store:<24}{kind:<10}{count:>8}{seconds * 1000:>10.1f}')
+
+    print(f'\n{"REST call":<36}{"count":>7}')
+    for name, count in sorted(replay.rest.calls.items()):
+        print(f'{name:<36}{count:>7}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replays recorded interactions.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('run', help='Replay a recording and report latencies.')
+    cmd.add_argument('file', help='JSONL written by main.py --record-interactions')
+    cmd.add_argument('--latency', type=float, default=100,
+                     help='simulated REST round trip in ms (default: 100)')
+    cmd.add_argument('--speed', type=float, default=0,
+                     help='replay at this multiple of the recorded pace '
+                          '(default: 0, as fast as possible)')
+    cmd.add_argument('--no-allocations', action='store_true',
+                     help='skip the second run that measures allocations')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+# settings.py - The bot's configuration files, loaded once
+#
+# Everything under config/ is read through the shared `settings` registry:
+#
+#   from settings import settings
+#   config = settings.config            # config/config.json
+#   questions = settings.questions      # config/questions.json
+#   sim_tags = settings.sim_tags        # config/sim_tags.json
+#
+# Each file is parsed and checked the first time it's asked for and cached
+# after that, so a typo fails at startup with the file and key to blame
+# instead of halfway through an interaction.
+#
+# While the bot runs, a Watcher reloads any file that changes on disk. A new
+# version that doesn't check out is logged and ignored. Cogs that compile
+# something from these files register a listener to rebuild it; if one of
+# them raises, the old version is put back.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+import ctypes.util
+import ctypes
+import asyncio
+import logging
+import struct
+import json
+import time
+import sys
+import os
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from cogs.questionnaire import (
+        _Question,
+        _SimTags,
+    )
+
+    from typing import (
+        NotRequired,
+        TypedDict,
+        Awaitable,
+        Callable,
+        Iterable,
+        Optional,
+        Literal,
+        Any,
+    )
+
+    class _Storage(TypedDict):
+        backend: Literal['json', 'journal', 'sqlite']
+        path: NotRequired[str]
+        commit_window: NotRequired[float]
+
+    class _Gateway(TypedDict):
+        profile: Literal['full', 'lean']
+        member_cache_size: NotRequired[int]
+
+    class _Http(TypedDict):
+        host: NotRequired[str]
+        port: int
+
+    class _Health(TypedDict):
+        gateway_grace: NotRequired[float]
+        max_loop_lag: NotRequired[float]
+        max_flush_age: NotRequired[float]
+        max_idle: NotRequired[Optional[float]]
+
+    class _Watchdog(TypedDict):
+        interval: NotRequired[float]
+        slow_handler: NotRequired[float]
+        stall: NotRequired[float]
+
+    class _Config(TypedDict):
+        pidfile: str
+        token: str
+        owner_ids: list[int]
+        guild_id: int
+        log_channel_id: int
+        forum_channel_id: int
+        admin_role: str
+        button_message: str
+        submit_message: str
+        protest_emoji_id: int
+        open_tag_id: Optional[int]
+        storage: NotRequired[_Storage]
+        irr_block: NotRequired[int]
+        questionnaire_mode: NotRequired[Literal['single', 'paged']]
+        draft_ttl: NotRequired[int]
+        gateway: NotRequired[_Gateway]
+        http: NotRequired[_Http]
+        watchdog: NotRequired[_Watchdog]
+        health: NotRequired[_Health]
+
+
+__all__ = (
+    'ConfigError',
+    'Settings',
+    'Watcher',
+    'settings',
+)
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(Exception):
+    """A config file is missing, isn't JSON, or doesn't look right."""
+
+
+# Specs for check(). A type (or tuple of types) is checked with isinstance,
+# a frozenset lists the allowed values, [spec] is a list of spec, and a dict
+# is an object whose keys ending in '?' are optional.
+NoneType = type(None)
+
+CONFIG_SPEC: dict[str, Any] = {
+    'pidfile': str,
+    'token': str,
+    'owner_ids': [int],
+    'guild_id': int,
+    'log_channel_id': int,
+    'forum_channel_id': int,
+    'admin_role': str,
+    'button_message': str,
+    'submit_message': str,
+    'protest_emoji_id': int,
+    'open_tag_id': (int, NoneType),
+    'storage?': {
+        'backend': frozenset({'json', 'journal', 'sqlite'}),
+        'path?': str,
+        'commit_window?': (int, float),
+    },
+    'irr_block?': int,
+    'questionnaire_mode?': frozenset({'single', 'paged'}),
+    'draft_ttl?': int,
+    'gateway?': {
+        'profile': frozenset({'full', 'lean'}),
+        'member_cache_size?': int,
+    },
+    'http?': {
+        'host?': str,
+        'port': int,
+    },
+    'watchdog?': {
+        'interval?': (int, float),
+        'slow_handler?': (int, float),
+        'stall?': (int, float),
+    },
+    'health?': {
+        'gateway_grace?': (int, float),
+        'max_loop_lag?': (int, float),
+        'max_flush_age?': (int, float),
+        'max_idle?': (int, float, NoneType),
+    },
+}
+
+# Read once at startup, so changing them needs a restart
+RESTART_KEYS = (
+    'pidfile', 'token', 'owner_ids', 'storage', 'gateway', 'irr_block', 'draft_ttl',
+    'http', 'watchdog', 'health')
+
+QUESTION_SPEC: dict[str, Any] = {
+    'title': str,
+    'type': frozenset({'multiple_choice', 'text_short', 'text_long', 'yes_no'}),
+    'short': str,
+    'inline': bool,
+    'choices?': [str],
+    'max_length?': int,
+    'placeholder?': str,
+}
+
+SIM_TAGS_SPEC: dict[str, Any] = {
+    'sim_name': str,
+    'forum_tag': (int, NoneType),
+    'role_id': (int, NoneType),
+}
+
+
+def check(where: str, value: Any, spec: Any) -> None:
+    """Raises ConfigError if value doesn't match spec, see above."""
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            raise ConfigError(f'{where} should be an object')
+        for key, item in spec.items():
+            name = key.rstrip('?')
+            if name in value:
+                check(f'{where}.{name}', value[name], item)
+            elif not key.endswith('?'):
+                raise ConfigError(f'{where}.{name} is missing')
+        for name in value.keys() - {key.rstrip('?') for key in spec}:
+            log.warning(f'{where}.{name} is not a known setting, ignoring it')
+    elif isinstance(spec, list):
+        if not isinstance(value, list):
+            raise ConfigError(f'{where} should be a list')
+        for i, item in enumerate(value):
+            check(f'{where}[{i}]', item, spec[0])
+    elif isinstance(spec, frozenset):
+        if value not in spec:
+            raise ConfigError(f'{where} should be one of {sorted(spec)}, not {value!r}')
+    else:
+        types = spec if isinstance(spec, tuple) else (spec,)
+        # JSON true/false are bools, which Python also counts as ints
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            names = ' or '.join('null' if t is NoneType else t.__name__ for t in types)
+            raise ConfigError(f'{where} should be {names}, not {value!r}')
+
+
+def check_config(where: str, config: Any) -> None:
+    check(where, config, CONFIG_SPEC)
+
+
+def check_questions(where: str, questions: Any) -> None:
+    check(where, questions, [QUESTION_SPEC])
+    if not questions:
+        raise ConfigError(f'{where} has no questions')
+    for i, question in enumerate(questions):
+        here = f'{where}[{i}]'
+        if question['type'] == 'multiple_choice':
+            if not 0 < len(question.get('choices', [])) <= 25:
+                raise ConfigError(f'{here}.choices needs between 1 and 25 choices')
+        elif question['type'] in ('text_short', 'text_long'):
+            for key in ('max_length', 'placeholder'):
+                if key not in question:
+                    raise ConfigError(f'{here}.{key} is missing')
+
+
+def check_sim_tags(where: str, sim_tags: Any) -> None:
+    check(where, sim_tags, [SIM_TAGS_SPEC])
+
+
+class Settings:
+    """Registry of the files under ``directory``, each loaded once.
+
+    ``timings`` records how long each file took to read and check, for
+    ``main.py --profile-startup``.
+    """
+    checks: dict[str, Callable[[str, Any], None]] = {
+        'config.json': check_config,
+        'questions.json': check_questions,
+        'sim_tags.json': check_sim_tags,
+    }
+
+    def __init__(self, directory: str = 'config') -> None:
+        self.directory = directory
+        self.files: dict[str, Any] = {}
+        self.timings: dict[str, float] = {}
+        # Called with the file name after a file is reloaded
+        self.listeners: list[Callable[[str], Awaitable[None]]] = []
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def read(self, name: str) -> Any:
+        """Parses and checks a file without touching the cache."""
+        start = time.perf_counter()
+        path = self.path(name)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except OSError as e:
+            raise ConfigError(f'Could not read {path}: {e.strerror}') from None
+        except ValueError as e:
+            raise ConfigError(f'{path} is not valid JSON: {e}') from None
+        self.checks[name](path, data)
+        self.timings[name] = time.perf_counter() - start
+        return data
+
+    def load(self, name: str) -> Any:
+        if name not in self.files:
+            self.files[name] = self.read(name)
+        return self.files[name]
+
+    def install(self, name: str, data: Any) -> Any:
+        """Makes ``data`` the current version of a file, returns the old one.
+
+        config.json is updated in place, so everyone holding on to
+        ``settings.config`` sees the new values. The other files are
+        replaced, so anything compiled from the old version keeps it.
+        """
+        old = self.files.get(name)
+        if data is None:
+            self.files.pop(name, None)
+        elif name == 'config.json' and old is not None:
+            previous = dict(old)
+            old.clear()
+            old.update(data)
+            return previous
+        else:
+            self.files[name] = data
+        return old
+
+    def reload(self, name: str) -> Any:
+        """Reads a file again. If it doesn't check out, the old one stays.
+
+        Returns the version it replaced, see install().
+        """
+        data = self.read(name)
+        old = self.files.get(name)
+        if name == 'config.json' and old is not None:
+            restart = [key for key in RESTART_KEYS if old.get(key) != data.get(key)]
+            if restart:
+                log.warning(f'{name}: {", ".join(restart)} will change after a restart')
+            for key in RESTART_KEYS:
+                if key in old:
+                    data[key] = old[key]
+                else:
+                    data.pop(key, None)
+        return self.install(name, data)
+
+    async def refresh(self, names: Optional[Iterable[str]] = None) -> dict[str, Optional[str]]:
+        """Reloads files (all of them by default) and tells the listeners.
+
+        A listener rejects a new version by raising. The old version is
+        then put back, and the listeners that already took the new one are
+        told again so they go back to the old one too.
+
+        Returns the problem with each file, or None if it reloaded fine.
+        """
+        results: dict[str, Optional[str]] = {}
+        for name in names or self.checks:
+            try:
+                old = self.reload(name)
+            except ConfigError as e:
+                log.error(f'Not reloading {name}: {e}')
+                results[name] = str(e)
+                continue
+            results[name] = None
+            applied: list[Callable[[str], Awaitable[None]]] = []
+            for listener in list(self.listeners):
+                try:
+                    await listener(name)
+                except ConfigError as e:
+                    log.error(f'Not reloading {name}: {e}')
+                    results[name] = str(e)
+                    break
+                except Exception as e:
+                    log.exception(f'Could not apply {name}, keeping the old version')
+                    results[name] = f'{type(e).__name__}: {e}'
+                    break
+                applied.append(listener)
+            else:
+                log.info(f'Reloaded {name} in {self.timings[name] * 1000:.1f}ms')
+                continue
+            self.install(name, old)
+            for listener in applied:
+                try:
+                    await listener(name)
+                except Exception:
+                    log.exception(f'Could not go back to the old {name}')
+        return results
+
+    def load_all(self) -> None:
+        for name in self.checks:
+            self.load(name)
+
+    @property
+    def config(self) -> _Config:
+        return self.load('config.json')
+
+    @property
+    def questions(self) -> list[_Question]:
+        return self.load('questions.json')
+
+    @property
+    def sim_tags(self) -> list[_SimTags]:
+        return self.load('sim_tags.json')
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """Refreshes settings when one of its files changes on disk.
+
+    Uses inotify on Linux, which costs nothing until a file changes, and
+    falls back to checking modification times every ``interval`` seconds
+    elsewhere. The whole directory is watched, since most editors save by
+    writing a new file and renaming it over the old one. Changes within
+    ``delay`` seconds of each other are handled together.
+    """
+
+    def __init__(self, settings: Settings, interval: float = 2.0, delay: float = 0.25) -> None:
+        self.settings = settings
+        self.interval = interval
+        self.delay = delay
+        self.changed: set[str] = set()
+        self.fd: Optional[int] = None
+        self.poller: Optional[asyncio.Task[None]] = None
+        self.flush: Optional[asyncio.TimerHandle] = None
+        self.tasks: set[asyncio.Task[Any]] = set()
+
+    def start(self) -> None:
+        self.fd = self._inotify()
+        if self.fd is not None:
+            asyncio.get_running_loop().add_reader(self.fd, self._read_events)
+            log.info(f'Watching {self.settings.directory}/ with inotify')
+        else:
+            stamps = {name: self._stamp(name) for name in self.settings.checks}
+            self.poller = asyncio.create_task(self._poll(stamps))
+            log.info(f'Checking {self.settings.directory}/ for changes '
+                     f'every {self.interval:g}s')
+
+    async def stop(self) -> None:
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.poller is not None:
+            self.poller.cancel()
+        if self.flush is not None:
+            self.flush.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def _inotify(self) -> Optional[int]:
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        path = os.fsencode(self.settings.directory)
+        if libc.inotify_add_watch(fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_events(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024)  # type: ignore
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            self._changed(name)
+
+    def _stamp(self, name: str) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.settings.path(name))
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def _poll(self, stamps: dict[str, Optional[tuple[int, int]]]) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for name in stamps:
+                stamp = self._stamp(name)
+                if stamp != stamps[name]:
+                    stamps[name] = stamp
+                    self._changed(name)
+
+    def _changed(self, name: str) -> None:
+        if name not in self.settings.checks:
+            return  # editor swap files and the like
+        self.changed.add(name)
+        if self.flush is None:
+            self.flush = asyncio.get_running_loop().call_later(self.delay, self._refresh)
+
+    def _refresh(self) -> None:
+        names, self.changed, self.flush = sorted(self.changed), set(), None
+        task = asyncio.create_task(self.settings.refresh(names))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+settings = Settings()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+#
+# storage.py - Storage backends for the bot's persistent state
+#
+# The bot keeps its state in utils.Config objects. open_store() picks the
+# backend named by the "storage" section of config.json:
+#
+#   "storage": {"backend": "journal"}                        (default)
+#   "storage": {"backend": "json", "commit_window": 0.5}
+#   "storage": {"backend": "sqlite", "path": "rrc.sqlite3"}
+#
+# To move existing JSON files into SQLite, stop the bot and run:
+#
+#   ./storage.py migrate --db rrc.sqlite3 answers.json irr.json
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import argparse
+import asyncio
+import logging
+import sqlite3
+import time
+import json
+import os
+import re
+
+from metrics import metrics
+from utils import (
+    Config,
+    stores,
+)
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import (
+        Callable,
+        Iterator,
+        Optional,
+        Generic,
+        TypeVar,
+        Any,
+    )
+
+    _T = TypeVar('_T')
+    _D = TypeVar('_D')
+
+    # Keys a write will change, with their new JSON value or None if deleted
+    Changes = dict[str, Optional[str]]
+    Columns = dict[str, Callable[[Any], Any]]
+else:
+    Generic = (object,)
+    _T = 0
+    _D = 0
+
+
+__all__ = (
+    'ANSWER_COLUMNS',
+    'SQLiteConfig',
+    'question_answer',
+    'open_store',
+)
+
+log = logging.getLogger(__name__)
+
+
+def question_answer(index: int) -> Callable[[Any], Any]:
+    """Pulls answer #index out of a stored answer, old format or new."""
+    def extract(value: Any) -> Any:
+        try:
+            if 'answers' in value:
+                return value['answers'][index]
+            return value['questions'][index]['answer']  # not upgraded yet
+        except (KeyError, IndexError, TypeError):
+            return None
+    return extract
+
+
+# Indexed columns for answers.json. Question numbers are hard-coded the same
+# way Cog.approve_answer does it: #0 is the series, #1 the track.
+ANSWER_COLUMNS: Columns = {
+    'user_id': lambda value: value.get('user_id'),
+    'epoch': lambda value: value.get('epoch'),
+    'series': question_answer(0),
+    'track': question_answer(1),
+}
+
+# Which columns each well-known file gets, used by open_store() and migrate
+COLUMNS: dict[str, Columns] = {
+    'answers.json': ANSWER_COLUMNS,
+}
+
+
+class _Database:
+    """One SQLite file, with all writes funnelled through a single thread.
+
+    Whole-table reads get a thread of their own, so they neither block the
+    event loop nor wait behind writes.
+    """
+    databases: dict[str, _Database] = {}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='sqlite')
+        self.executor.submit(self._connect).result()
+        self.scanner = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='sqlite-scan')
+        self.scanner.submit(self._connect_scanner).result()
+        # Point lookups by key happen on the event loop thread: they're a
+        # primary key probe, cheaper than a hop to another thread and back,
+        # and they keep get() and `in` synchronous like utils.Config. In WAL
+        # mode they never wait for the writer, but they also don't see
+        # writes still queued for it; see SQLiteConfig.unflushed.
+        self.reader = sqlite3.connect(path)
+
+    def _connect(self) -> None:
+        self.writer = sqlite3.connect(self.path)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+
+    def _connect_scanner(self) -> None:
+        self.scan_connection = sqlite3.connect(self.path)
+
+    @classmethod
+    def get(cls, path: str) -> _Database:
+        # By absolute path, the working directory may have changed since
+        # the last open (replay.py runs each pass in its own)
+        path = os.path.abspath(path)
+        if path not in cls.databases:
+            cls.databases[path] = cls(path)
+        return cls.databases[path]
+
+    def run(self, func: Callable[..., Any], *args: Any) -> asyncio.Future[Any]:
+        # The job is queued right away, awaiting it is optional
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def scan(self, func: Callable[[sqlite3.Connection], Any]) -> asyncio.Future[Any]:
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.scanner, func, self.scan_connection)
+
+
+class SQLiteConfig(Generic[_T]):
+    """Drop-in replacement for :class:`utils.Config` stored in SQLite.
+
+    Each store is a table in a shared database file. Values are stored as
+    JSON, and ``columns`` maps extra indexed column names to functions that
+    pull the column value out of a stored value, so :meth:`find` can answer
+    queries without loading every row.
+
+    Writes run on the database's writer thread, in order. Until one has
+    committed, its keys are kept in :attr:`unflushed`, which reads on the
+    event loop check first, so every read sees every earlier :meth:`put`
+    and :meth:`remove`, whether or not it was awaited.
+
+    :meth:`get` and ``in`` look the key up on the event loop. The row count
+    is kept up to date as writes are queued, so ``len()`` costs no query.
+    To read the whole table use :meth:`scan`, which runs on its own thread;
+    :meth:`all` does the same query on the event loop, for scripts.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        path: str = 'rrc.sqlite3',
+        columns: Optional[Columns] = None,
+        object_hook: Optional[Callable[[dict[str, Any]], Any]] = None,
+        encoder: Optional[type[json.JSONEncoder]] = None,
+    ) -> None:
+        self.name = name
+        self.table = re.sub(r'\W', '_', name.rsplit('.', 1)[0])
+        self.columns: Columns = columns or {}
+        self.object_hook = object_hook
+        self.encoder = encoder
+        self.db = _Database.get(path)
+        self.count: int = self.db.executor.submit(self._create).result()
+        # key -> (write number, JSON value or None if deleted)
+        self.unflushed: dict[str, tuple[int, Optional[str]]] = {}
+        self._writes: int = 0
+        # write number -> loop time it was queued, for utils.flush_backlog()
+        self.loop = asyncio.get_running_loop()
+        self._queued: dict[int, float] = {}
+        stores.add(self)
+
+    def __class_getitem__(cls, item: Any) -> Any:
+        return cls
+
+    def _create(self) -> int:
+        extra = ''.join(f', "{column}"' for column in self.columns)
+        with self.db.writer:
+            self.db.writer.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.table}" '
+                f'(key TEXT PRIMARY KEY, value TEXT NOT NULL{extra})'
+            )
+            for column in self.columns:
+                self.db.writer.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{self.table}_{column}" '
+                    f'ON "{self.table}" ("{column}")'
+                )
+            return self.db.writer.execute(
+                f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def _row(self, key: Any, value: _T) -> tuple[Any, ...]:
+        return (
+            str(key),
+            json.dumps(value, ensure_ascii=True, cls=self.encoder,
+                       separators=(',', ':')),
+            *(extract(value) for extract in self.columns.values()),
+        )
+
+    def _decode(self, value: str) -> _T:
+        return json.loads(value, object_hook=self.object_hook)
+
+    # These two run on the writer thread and return how long the write took,
+    # for _written() to record on the event loop
+    def _write(self, sql: str, params: tuple[Any, ...]) -> float:
+        start = time.perf_counter()
+        with self.db.writer:
+            self.db.writer.execute(sql, params)
+        return time.perf_counter() - start
+
+    def _writemany(self, sql: str, rows: list[tuple[Any, ...]]) -> float:
+        start = time.perf_counter()
+        with self.db.writer:
+            self.db.writer.executemany(sql, rows)
+        return time.perf_counter() - start
+
+    def _submit(self, changes: Changes, func: Callable[..., float], *args: Any) -> asyncio.Future[float]:
+        self._writes += 1
+        for key, value in changes.items():
+            self.count += (value is not None) - (self._stored(key) is not None)
+            self.unflushed[key] = (self._writes, value)
+        self._queued[self._writes] = self.loop.time()
+        write = self.db.run(func, *args)
+        write.add_done_callback(functools.partial(self._written, changes, self._writes))
+        return write
+
+    def _written(self, changes: Changes, number: int, write: asyncio.Future[float]) -> None:
+        del self._queued[number]
+        for key in changes:
+            # A later write to the same key is still on its way
+            if self.unflushed.get(key, (None,))[0] == number:
+                del self.unflushed[key]
+        if write.cancelled():
+            return
+        error = write.exception()
+        if error is not None:
+            metrics.storage_errors.inc(store=self.name)
+            log.error(f'Failed to write {", ".join(changes)} to {self.name}: {error}')
+        else:
+            metrics.storage_flush.observe(write.result(), store=self.name, kind='sqlite')
+
+    @property
+    def _upsert(self) -> str:
+        names = ', '.join(['key', 'value', *(f'"{c}"' for c in self.columns)])
+        marks = ', '.join('?' * (2 + len(self.columns)))
+        return f'INSERT OR REPLACE INTO "{self.table}" ({names}) VALUES ({marks})'
+
+    async def load(self) -> None:
+        """Nothing is cached, so there is nothing to reload."""
+
+    async def save(self, wait: bool = True) -> None:
+        """Every change is committed as it happens."""
+
+    async def close(self) -> None:
+        pass
+
+    def dirty_since(self) -> Optional[float]:
+        """Loop time the oldest write still on its way was queued, if any."""
+        # Writes are numbered in order, so the first one left is the oldest
+        return next(iter(self._queued.values()), None)
+
+    def _stored(self, key: str) -> Optional[str]:
+        if key in self.unflushed:
+            return self.unflushed[key][1]
+        row = self.db.reader.execute(
+            f'SELECT value FROM "{self.table}" WHERE key = ?', (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, key: Any, default: _D = None) -> _T | _D:
+        """Retrieves a config entry."""
+        value = self._stored(str(key))
+        return default if value is None else self._decode(value)
+
+    async def put(self, key: Any, value: _T, wait: bool = True) -> None:
+        """Edits a config entry."""
+        # Serialize now, the caller may keep mutating value afterwards
+        row = self._row(key, value)
+        write = self._submit({row[0]: row[1]}, self._write, self._upsert, row)
+        if wait:
+            await write
+
+    async def put_many(self, items: dict[str, _T]) -> None:
+        """Edits many entries in a single transaction."""
+        rows = [self._row(key, value) for key, value in items.items()]
+        await self._submit({row[0]: row[1] for row in rows},
+                           self._writemany, self._upsert, rows)
+
+    async def remove(self, key: Any, wait: bool = True) -> None:
+        """Removes a config entry."""
+        if str(key) not in self:
+            raise KeyError(key)
+        write = self._submit({str(key): None}, self._write,
+                             f'DELETE FROM "{self.table}" WHERE key = ?', (str(key),))
+        if wait:
+            await write
+
+    async def find(
+        self,
+        order_by: Optional[str] = None,
+        limit: Optional[int] = None,
+        **where: Any,
+    ) -> list[_T]:
+        """Returns the entries whose indexed columns equal ``where``.
+
+        ``order_by`` may be any indexed column, prefixed with ``-`` for
+        descending order.
+        """
+        for column in (*where, (order_by or '').lstrip('-')):
+            if column and column not in self.columns:
+                raise ValueError(f'{column!r} is not an indexed column')
+
+        sql = f'SELECT value FROM "{self.table}"'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(f'"{c}" = ?' for c in where)
+        if order_by:
+            desc = order_by.startswith('-')
+            sql += f' ORDER BY "{order_by.lstrip("-")}"' + (' DESC' if desc else '')
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        def query() -> list[str]:
+            return [row[0] for row in self.db.writer.execute(sql, tuple(where.values()))]
+
+        return [self._decode(value) for value in await self.db.run(query)]
+
+    def __contains__(self, item: Any) -> bool:
+        return self._stored(str(item)) is not None
+
+    def __getitem__(self, item: Any) -> _T:
+        value = self.get(item, default=KeyError)
+        if value is KeyError:
+            raise KeyError(item)
+        return value  # type: ignore
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.all())
+
+    def all(self) -> dict[str, _T]:
+        rows = dict(self.db.reader.execute(f'SELECT key, value FROM "{self.table}"'))
+        for key, (_, value) in self.unflushed.items():
+            if value is None:
+                rows.pop(key, None)
+            else:
+                rows[key] = value
+        return {key: self._decode(value) for key, value in rows.items()}
+
+    async def scan(self) -> dict[str, _T]:
+        """Every entry, like :meth:`all`, without blocking the event loop.
+
+        The table is read and decoded on the database's scan thread.
+        """
+        # Writes queued before now count even if they commit after the read
+        unflushed = dict(self.unflushed)
+
+        def read(connection: sqlite3.Connection) -> dict[str, _T]:
+            return {key: self._decode(value) for key, value in
+                    connection.execute(f'SELECT key, value FROM "{self.table}"')}
+
+        entries = await self.db.scan(read)
+        for key, (_, value) in unflushed.items():
+            if value is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = self._decode(value)
+        return entries
+
+    def __str__(self) -> str:
+        return str(self.all())
+
+
+def open_store(name: str, settings: Optional[dict[str, Any]] = None) -> Config[Any] | SQLiteConfig[Any]:
+    """Opens the store ``name`` with the backend chosen in config.json."""
+    settings = settings or {}
+    backend = settings.get('backend', 'journal')
+    if backend == 'sqlite':
+        return SQLiteConfig(
+            name,
+            path=settings.get('path', 'rrc.sqlite3'),
+            columns=COLUMNS.get(name),
+        )
+    if backend in ('json', 'journal'):
+        return Config(
+            name,
+            journal=backend == 'journal',
+            commit_window=settings.get('commit_window', 0.0),
+        )
+    raise ValueError(f'Unknown storage backend {backend!r}')
+
+
+async def migrate(db: str, names: list[str]) -> None:
+    for name in names:
+        # Config replays any journal, so this picks up every backend
+        source: Config[Any] = Config(name, journal=True)
+        target: SQLiteConfig[Any] = SQLiteConfig(name, path=db, columns=COLUMNS.get(name))
+        await target.put_many(source.all())
+        await source.close()
+        print(f'{name}: imported {len(source)} entries into {db}:{target.table}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Storage maintenance.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('migrate', help='Import JSON stores into SQLite.')
+    cmd.add_argument('--db', default='rrc.sqlite3')
+    cmd.add_argument('names', nargs='+', help='e.g. answers.json irr.json')
+    args = parser.parse_args()
+    asyncio.run(migrate(args.db, args.names))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import tempfile
+import shutil
+import sys
+import os
+
+# The bot's modules live at the top of the repository, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from settings import settings
+
+# The cogs read config/ when they're imported, so point settings at a copy
+# with the example config before any test module imports them
+CONFIG = tempfile.mkdtemp(prefix='rrc-config-')
+for source, name in (('config.json.example', 'config.json'),
+                     ('questions.json', 'questions.json'),
+                     ('sim_tags.json', 'sim_tags.json')):
+    shutil.copy(os.path.join(ROOT, 'config', source), os.path.join(CONFIG, name))
+settings.directory = CONFIG
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(CONFIG, ignore_errors=True)
+
+
+#
+# Just enough of discord.py for the cogs to run against
+#
+class FakeResponse:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, dict]] = []
+
+    def is_done(self) -> bool:
+        return bool(self.calls)
+
+    async def send_message(self, content=None, **kwargs) -> None:
+        self.calls.append(('send_message', {'content': content, **kwargs}))
+
+    async def edit_message(self, **kwargs) -> None:
+        self.calls.append(('edit_message', kwargs))
+
+    async def send_modal(self, modal) -> None:
+        self.calls.append(('send_modal', {'modal': modal}))
+
+    async def defer(self, **kwargs) -> None:
+        self.calls.append(('defer', kwargs))
+
+
+class FakeFollowup:
+    def __init__(self) -> None:
+        self.calls: list[dict] = []
+
+    async def send(self, content=None, **kwargs) -> None:
+        self.calls.append({'content': content, **kwargs})
+
+
+class FakeUser:
+    def __init__(self, id: int) -> None:
+        self.id = id
+
+
+class FakeInteraction:
+    def __init__(self, custom_id: str = '', user_id: int = 1) -> None:
+        self.id = 1
+        self.user = FakeUser(user_id)
+        self.data = {'custom_id': custom_id}
+        self.message = None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+class FakeResolver:
+    async def member(self, guild, id):
+        return None
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        from bot import Bot
+        self.embed = Bot.embed.__get__(self)
+        self.resolver = FakeResolver()
+        self.events: list[tuple] = []
+        self.cogs: dict = {}
+
+    def get_guild(self, id):
+        return None
+
+    def get_partial_messageable(self, id):
+        from types import SimpleNamespace
+        return SimpleNamespace(id=id, get_partial_message=lambda id: SimpleNamespace(id=id))
+
+    async def wait_until_ready(self) -> None:
+        pass
+
+    def get_cog(self, name: str):
+        return self.cogs.get(name)
+
+    def dispatch(self, event: str, *args) -> None:
+        self.events.append((event, *args))
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+import asyncio
+
+from discord import app_commands
+
+from conftest import FakeInteraction
+from cogs.admin import command_error
+
+
+def test_failed_check_reports_permission():
+    interaction = FakeInteraction()
+    asyncio.run(command_error(interaction, 'gateway', app_commands.CheckFailure()))
+    (kind, kwargs), = interaction.response.calls
+    assert kind == 'send_message'
+    assert 'permission' in kwargs['content'] and kwargs['ephemeral']
+
+
+def test_error_after_defer_goes_to_followup():
+    async def run() -> FakeInteraction:
+        interaction = FakeInteraction()
+        await interaction.response.defer(ephemeral=True)
+        error = app_commands.CommandInvokeError(
+            SimpleNamespace(name='sync'), RuntimeError('Discord is down'))
+        await command_error(interaction, 'sync', error)
+        return interaction
+
+    interaction = asyncio.run(run())
+    assert [kind for kind, _ in interaction.response.calls] == ['defer']
+    (sent,) = interaction.followup.calls
+    assert 'permission' not in sent['content']
+    assert 'RuntimeError: Discord is down' in sent['content']
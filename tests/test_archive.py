@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+from archive import Archive
+
+
+def record(answer_id: str, user_id: int, decided: int) -> dict:
+    return {'answer': {'id': answer_id, 'user_id': user_id},
+            'result': 'rejected', 'decided': decided, 'reason': 'No'}
+
+
+def test_rotation_syncs_the_gzip_before_removing_the_segment(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    steps = []
+    fsync, remove = os.fsync, os.remove
+
+    def record_fsync(fd: int) -> None:
+        steps.append(('fsync', os.readlink(f'/proc/self/fd/{fd}')))
+        fsync(fd)
+
+    def record_remove(path: str) -> None:
+        steps.append(('remove', os.path.abspath(path)))
+        remove(path)
+
+    async def run() -> None:
+        archive = Archive()
+        archive.start()
+        for n in range(3):
+            archive.submit(record(f'0000000{n}', 1, 1700000000 + n))
+        await archive.queue.join()
+        with monkeypatch.context() as patch:
+            patch.setattr(os, 'fsync', record_fsync)
+            patch.setattr(os, 'remove', record_remove)
+            await archive._rotate('2023-11.jsonl')
+        assert [r['answer']['id'] for r in await archive.by_user(1)] == \
+            ['00000000', '00000001', '00000002']
+        await archive.stop()
+
+    asyncio.run(run())
+    archive = str(tmp_path / 'archive')
+    removed = steps.index(('remove', os.path.join(archive, '2023-11.jsonl')))
+    synced = steps[:removed]
+    assert ('fsync', os.path.join(archive, '2023-11.jsonl.gz.tmp')) in synced
+    assert ('fsync', archive) in synced[synced.index(
+        ('fsync', os.path.join(archive, '2023-11.jsonl.gz.tmp'))):]
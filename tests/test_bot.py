@@ -0,0 +1,63 @@
+import asyncio
+
+import discord
+from discord import app_commands
+
+from bot import (
+    check_fingerprint,
+    Bot,
+)
+from utils import application_admin_only
+
+
+def test_checks_from_one_factory_hash_apart():
+    def factory(role: str):
+        def predicate(inter) -> bool:
+            return role in inter.roles
+        return predicate
+
+    def other_factory(role: str):
+        def predicate(inter) -> bool:
+            return role not in inter.roles
+        return predicate
+
+    assert factory('admin').__qualname__ == factory('steward').__qualname__
+    assert check_fingerprint(factory('admin')) == check_fingerprint(factory('admin'))
+    assert check_fingerprint(factory('admin')) != check_fingerprint(factory('steward'))
+    assert check_fingerprint(factory('admin')) != check_fingerprint(other_factory('admin'))
+    with_send, = application_admin_only(send=True)(lambda: None).__discord_app_commands_checks__
+    without, = application_admin_only(send=False)(lambda: None).__discord_app_commands_checks__
+    assert check_fingerprint(with_send) != check_fingerprint(without)
+
+
+def test_global_commands_are_synced_once_and_not_copied(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> list:
+        bot = Bot(owner_ids=[], guild_ids=[1234])
+        synced = []
+
+        async def sync(guild=None):
+            synced.append((guild and guild.id, sorted(c.name for c in bot.tree.get_commands(guild=guild))))
+            return []
+
+        @app_commands.command(name='hello', description='Says hello.')
+        async def hello(inter: discord.Interaction) -> None:
+            pass
+
+        bot.tree.add_command(hello)
+        bot.tree.sync = sync
+        try:
+            first = await bot.sync_commands()
+            again = await bot.sync_commands()
+            forced = await bot.sync_commands(force=True)
+        finally:
+            await bot.session.close()
+            await bot.command_hashes.close()
+        assert first == {'global': True, '1234': True}
+        assert again == {'global': False, '1234': False}
+        assert forced == first
+        return synced
+
+    synced = asyncio.run(run())
+    assert synced == [(None, ['hello']), (1234, [])] * 2
@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+import asyncio
+
+from cache import Resolver
+
+
+def test_missing_forum_tags_are_not_cached():
+    async def run() -> list:
+        tags: dict = {}
+        forum = SimpleNamespace(id=1, get_tag=tags.get)
+        resolver = Resolver()
+        found = [await resolver.forum_tag(forum, 10)]
+        tags[10] = 'Open'  # created after the first lookup
+        found.append(await resolver.forum_tag(forum, 10))
+        del tags[10]
+        found.append(await resolver.forum_tag(forum, 10))  # positive hits are cached
+        return found
+
+    assert asyncio.run(run()) == [None, 'Open', 'Open']
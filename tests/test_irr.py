@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import asyncio
+
+from discord import app_commands
+
+from conftest import (
+    FakeInteraction,
+    FakeBot,
+)
+from cogs.irr import (
+    Stats,
+    IRR,
+)
+from utils import Config
+
+
+def record(id: str, driver: str, result: str = 'approved') -> dict:
+    return {
+        'answer': {
+            'id': id,
+            'user_id': 2,
+            'epoch': 1700000000,
+            'answers': ['ACC Sprint', 'Monza', '1', driver],
+        },
+        'result': result,
+        'decided': 1700000600,
+    }
+
+
+def test_driver_table_is_capped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> None:
+        stats = Stats(Config('irr_stats.json'), drivers=3)
+        drivers = ['Alice'] * 5 + ['Bob'] * 3 + ['Carol', 'Dave', 'Erin', 'Alice']
+        for i, driver in enumerate(drivers):
+            await stats.add(record(f'{i:08x}', driver), sim='ACC')
+        assert len(stats.drivers) == 3
+        assert stats.top_drivers(2) == [('Alice', 6), ('Bob', 3)]
+        await stats.store.close()
+
+        # A table saved before the cap is trimmed when loaded
+        assert len(Stats(Config('irr_stats.json'), drivers=2).drivers) == 2
+
+    asyncio.run(run())
+
+
+def test_decisions_during_seeding_are_counted_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> None:
+        archived = [record('00000001', 'Alice'), record('00000002', 'Bob', 'rejected')]
+
+        async def scan() -> list:
+            await asyncio.sleep(0.01)
+            return archived
+
+        async def pending() -> dict:
+            return {}
+
+        bot = FakeBot()
+        bot.cogs['Cog'] = SimpleNamespace(
+            archive=SimpleNamespace(scan=scan),
+            answers=SimpleNamespace(scan=pending),
+            sim_index={'ACC Sprint': {'sim_name': 'ACC'}},
+        )
+        cog = IRR(bot)
+        await cog.cog_load()
+        # Decided (and archived) while seed() is still reading the archive
+        await cog.on_irr_decided(archived[1])
+        await cog.seeding
+        assert len(cog.stats) == 2
+        assert (cog.stats.approved, cog.stats.rejected) == (1, 1)
+        await cog.cog_unload()
+
+    asyncio.run(run())
+
+
+def test_search_errors_are_not_blamed_on_permissions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> FakeInteraction:
+        cog = IRR(FakeBot())
+        interaction = FakeInteraction()
+        await interaction.response.send_message('partial results')
+        error = app_commands.CommandInvokeError(
+            SimpleNamespace(name='search'), KeyError('series'))
+        await cog.search_error(interaction, error)
+        return interaction
+
+    interaction = asyncio.run(run())
+    assert len(interaction.response.calls) == 1
+    (sent,) = interaction.followup.calls
+    assert 'permission' not in sent['content']
+    assert "KeyError: 'series'" in sent['content']
@@ -0,0 +1,391 @@
+from types import SimpleNamespace
+import asyncio
+
+import discord
+import pytest
+
+from conftest import (
+    FakeInteraction,
+    FakeBot,
+)
+from cogs.questionnaire import (
+    LOG_QUESTION_LAYOUTS,
+    LOG_RESULT_LAYOUTS,
+    LOG_EDITING_LAYOUT,
+    LOG_LAYOUT,
+    RESUME_LAYOUT,
+    START_LAYOUT,
+    RejectionMessage,
+    QuestionnaireView,
+    SessionStore,
+    AnswerModal,
+    LogView,
+    Cog,
+    compile_pages,
+    parse_custom_id,
+    handler_name,
+)
+from settings import settings
+
+ID = '00c0ffee'
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Runs test(cog, answer) against a loaded cog with one pending answer."""
+    monkeypatch.chdir(tmp_path)
+
+    def run(test) -> None:
+        async def main() -> None:
+            cog = Cog(FakeBot())
+            await cog.cog_load()
+            try:
+                answer = {
+                    'id': ID,
+                    'user_id': 2,
+                    'epoch': 1700000000,
+                    'schema': cog.snapshot.version,
+                    'answers': ['ACC Sprint', 'Monza', '1', 'Driver', 'What happened',
+                                'Lap 1', 'Yes', 'No', 'Yes'],
+                }
+                await cog.answers.put(ID, answer)
+                await test(cog, answer)
+            finally:
+                await cog.cog_unload()
+        asyncio.run(main())
+    return run
+
+
+@pytest.mark.parametrize('custom_id, parts', [
+    ('questions:::start', ('questions', 'start', '', '')),
+    ('questions:::approve-1a2b3c4d', ('questions', 'approve', '1a2b3c4d', '')),
+    ('questions:::index_down-1a2b3c4d-3', ('questions', 'index_down', '1a2b3c4d', '3')),
+    ('questionnaire:::text-5e55104d', ('questionnaire', 'text', '5e55104d', '')),
+    ('questionnaire:::yes-5e55104d-6', ('questionnaire', 'yes', '5e55104d', '6')),
+])
+def test_custom_id_parts(custom_id, parts):
+    assert parse_custom_id(custom_id) == parts
+
+
+@pytest.mark.parametrize('custom_id', [
+    'multiple_choice',
+    'questions:::Approve-1a2b',
+    'questions:::approved-1a2b',
+    'questions:::',
+    'tickets:::approve-1a2b',
+])
+def test_other_custom_ids_do_not_match(custom_id):
+    assert parse_custom_id(custom_id) is None
+
+
+# What QuestionnaireView.handle() acts on
+QUESTIONNAIRE_ACTIONS = {'start', 'resume', 'restart', 'multiple_choice', 'text', 'yes', 'no'}
+
+
+def custom_ids(*layouts, **ids) -> list[str]:
+    # Components without one get a random custom_id from discord.py
+    return [item.custom_id for layout in layouts
+            for (_, kwargs), item in zip(layout.items, layout.build(**ids))
+            if 'custom_id' in kwargs]
+
+
+def test_every_component_routes_somewhere(run):
+    async def test(cog, answer):
+        log = custom_ids(LOG_LAYOUT, LOG_EDITING_LAYOUT, *LOG_QUESTION_LAYOUTS.values(),
+                         *LOG_RESULT_LAYOUTS.values(), id=ID, index=2)
+        questionnaire = custom_ids(
+            START_LAYOUT, RESUME_LAYOUT,
+            *(page.layout for paged in (False, True)
+              for page in compile_pages(settings.questions, paged=paged)),
+            sid='5e55104d')
+        assert log and questionnaire
+        for custom_id in log + questionnaire:
+            prefix, action, id, _ = parse_custom_id(custom_id)
+            if prefix == 'questions':
+                assert id == ID and action in cog.routes, custom_id
+            else:
+                assert id == '5e55104d' and action in QUESTIONNAIRE_ACTIONS, custom_id
+    run(test)
+
+
+def test_interactions_go_to_their_handler(run):
+    async def test(cog, answer):
+        calls = []
+
+        async def questionnaire_click(**kwargs):
+            calls.append(('questionnaire', kwargs['action'], kwargs['id'], kwargs['number']))
+
+        async def on_button_click(**kwargs):
+            calls.append(('questions', kwargs['action'], kwargs['id'], kwargs['number']))
+
+        cog.questionnaire_click = questionnaire_click
+        cog.on_button_click = on_button_click
+        for custom_id in ('questionnaire:::yes-5e55104d-6', 'questionnaire:::text-5e55104d',
+                          f'questions:::edit-{ID}-1', 'questions:::start', 'multiple_choice'):
+            interaction = FakeInteraction(custom_id)
+            interaction.type = discord.InteractionType.component
+            await cog.on_interaction(interaction)
+        assert calls == [
+            ('questionnaire', 'yes', '5e55104d', '6'),
+            ('questionnaire', 'text', '5e55104d', ''),
+            ('questions', 'edit', ID, '1'),
+            ('questions', 'start', '', ''),
+        ]
+        interaction.data['custom_id'] = f'questions:::approve-{ID}'
+        assert handler_name(interaction) == 'questions:approve'
+    run(test)
+
+
+def test_log_buttons_get_their_number(run):
+    async def test(cog, answer):
+        calls = []
+
+        async def record(**kwargs):
+            calls.append({k: v for k, v in kwargs.items() if k not in ('interaction', 'answer')})
+
+        cog.set_index = cog.edit_answer = cog.edited_answer = record
+        for custom_id in (f'questions:::index_down-{ID}-3', f'questions:::index_up-{ID}-0',
+                          f'questions:::edit-{ID}-1', f'questions:::edit-{ID}',
+                          f'questions:::yes-{ID}-6'):
+            interaction = FakeInteraction(custom_id)
+            interaction.type = discord.InteractionType.component
+            await cog.on_interaction(interaction)
+        assert calls == [
+            {'index': 4},
+            {'index': 8},
+            {'already_editing': True},
+            {'already_editing': False},
+            {'question_index': 6, 'new_answer': 'Yes'},
+        ]
+    run(test)
+
+
+def error(interaction: FakeInteraction) -> str:
+    (kind, kwargs), = interaction.response.calls
+    assert kind == 'send_message'
+    return kwargs['embed'].description
+
+
+def events(cog: Cog) -> list[str]:
+    return [event for event, *_ in cog.bot.events]
+
+
+def rejection(cog: Cog, answer: dict) -> RejectionMessage:
+    modal = RejectionMessage(bot=cog.bot, cog=cog, answer=answer)
+    modal.message._value = 'Racing incident'
+    return modal
+
+
+def edit(cog: Cog, answer: dict, index: int, value: str) -> AnswerModal:
+    view = LogView(bot=cog.bot, cog=cog, answer=answer, question_index=index)
+    modal = AnswerModal(bot=cog.bot, cog=cog, interaction=FakeInteraction(), view=view,
+                        questions=[view.questions[index]],
+                        defaults=[answer['answers'][index]])
+    modal.answers[0]._value = value
+    return modal
+
+
+def test_reject_goes_through_while_pending(run):
+    async def test(cog, answer):
+        interaction = FakeInteraction()
+        await rejection(cog, answer).on_submit(interaction)
+        assert ID not in cog.answers
+        assert events(cog) == ['irr_decided']
+        assert interaction.response.calls[0][0] == 'edit_message'
+    run(test)
+
+
+def test_reject_submitted_during_approval_is_refused(run):
+    async def test(cog, answer):
+        modal = rejection(cog, answer)
+        cog.publisher.pending.add(ID)  # another admin approved meanwhile
+        interaction = FakeInteraction()
+        await modal.on_submit(interaction)
+        assert ID in cog.answers
+        assert events(cog) == []
+        assert 'already being published' in error(interaction)
+    run(test)
+
+
+def test_reject_submitted_after_decision_is_refused(run):
+    async def test(cog, answer):
+        modal = rejection(cog, answer)
+        await cog.answers.remove(ID)
+        interaction = FakeInteraction()
+        await modal.on_submit(interaction)
+        assert events(cog) == []
+        assert 'could not seem to find' in error(interaction)
+    run(test)
+
+
+def test_edit_submitted_after_decision_does_not_bring_it_back(run):
+    async def test(cog, answer):
+        modal = edit(cog, answer, 2, '99')
+        await cog.answers.remove(ID)
+        interaction = FakeInteraction()
+        await modal.on_submit(interaction)
+        assert ID not in cog.answers
+        assert events(cog) == []
+        assert 'could not seem to find' in error(interaction)
+    run(test)
+
+
+def test_edit_keeps_edits_made_while_it_was_open(run):
+    async def test(cog, answer):
+        modal = edit(cog, answer, 2, '99')
+        await cog.answers.put(ID, {**answer, 'answers': ['X', *answer['answers'][1:]]})
+        await modal.on_submit(FakeInteraction())
+        assert cog.answers[ID]['answers'][:3] == ['X', 'Monza', '99']
+    run(test)
+
+
+def test_buttons_are_refused_while_publishing(run):
+    async def test(cog, answer):
+        cog.publisher.pending.add(ID)
+        for action in ('approve', 'reject', 'edit'):
+            interaction = FakeInteraction(f'questions:::{action}-{ID}')
+            await cog.on_button_click(interaction, action, ID, '')
+            assert 'already being published' in error(interaction)
+        assert ID in cog.answers
+    run(test)
+
+
+def test_approving_after_a_failed_publish_resumes_it(run):
+    async def test(cog, answer):
+        jobs = []
+
+        async def publish(job):
+            jobs.append(job)
+            if len(jobs) == 1:
+                job.irr_num = 7
+                job.thread = SimpleNamespace(id=70)
+                raise RuntimeError('Missing Permissions')
+            await cog.answers.remove(ID)
+        cog.publish_answer = publish
+
+        await cog.on_button_click(FakeInteraction(), 'approve', ID, '')
+        await cog.publisher.queue.join()
+        assert cog.publisher.failed == {ID: jobs[0]}
+        assert events(cog) == []
+
+        # The thread exists, so the answer can't be rejected any more
+        interaction = FakeInteraction()
+        await cog.on_button_click(interaction, 'reject', ID, '')
+        assert 'already in the forum' in error(interaction)
+
+        await cog.on_button_click(FakeInteraction(), 'approve', ID, '')
+        await cog.publisher.queue.join()
+        assert jobs[1] is jobs[0]
+        assert cog.publisher.failed == {}
+        (event, record), = cog.bot.events
+        assert (event, record['irr_num'], record['thread_id']) == ('irr_decided', 7, 70)
+    run(test)
+
+
+def test_publishing_resumes_after_a_reload(run):
+    async def test(cog, answer):
+        async def publish(job):
+            job.irr_num = 7
+            await cog.save_progress(job)
+            job.thread = SimpleNamespace(id=70)
+            await cog.save_progress(job)
+            await asyncio.Event().wait()  # the cog is reloaded meanwhile
+        cog.publish_answer = publish
+
+        interaction = FakeInteraction()
+        interaction.message = SimpleNamespace(id=5, channel=SimpleNamespace(id=50))
+        await cog.on_button_click(interaction, 'approve', ID, '')
+        await asyncio.sleep(0.01)
+        await cog.cog_unload()
+
+        resumed = []
+        reloaded = Cog(cog.bot)
+
+        async def republish(job):
+            resumed.append(job)
+            await reloaded.answers.remove(ID)
+        reloaded.publish_answer = republish
+        await reloaded.cog_load()
+        try:
+            assert ID in reloaded.publisher.pending
+            await reloaded.resuming
+            await reloaded.publisher.queue.join()
+        finally:
+            await reloaded.cog_unload()
+            await cog.cog_load()  # for the fixture to unload
+
+        job, = resumed
+        assert (job.irr_num, job.thread.id, job.message.id) == (7, 70, 5)
+        event, record = cog.bot.events[-1]
+        assert event == 'irr_decided' and 'publish' not in record['answer']
+    run(test)
+
+
+def test_failed_publish_is_still_failed_after_a_restart(run):
+    async def test(cog, answer):
+        async def publish(job):
+            job.irr_num = 7
+            raise RuntimeError('Missing Permissions')
+        cog.publish_answer = publish
+
+        await cog.on_button_click(FakeInteraction(), 'approve', ID, '')
+        await cog.publisher.queue.join()
+        await cog.cog_unload()
+
+        restarted = Cog(cog.bot)
+        await restarted.cog_load()
+        try:
+            await restarted.resuming
+            assert restarted.publisher.pending == set()
+            assert restarted.publisher.failed[ID].irr_num == 7
+        finally:
+            await restarted.cog_unload()
+            await cog.cog_load()
+    run(test)
+
+
+def test_sessions_expire_before_their_token_does():
+    async def main() -> list:
+        expired: list = []
+
+        async def on_expire(sessions) -> None:
+            expired.extend(sessions)
+
+        store = SessionStore(ttl=300.0, on_expire=on_expire)
+        store.start()
+        try:
+            session = store.open(1, 'token', None)  # type: ignore
+            session.deadline = session.expires - 300.0 + 0.05  # token nearly used up
+            store.touch(session)
+            await asyncio.sleep(0.2)
+        finally:
+            await store.stop()
+        return expired
+
+    assert len(asyncio.run(main())) == 1
+
+
+def test_modal_from_a_replaced_session_keeps_the_newer_draft(run):
+    async def test(cog, answer):
+        version = cog.snapshot.version
+        old = cog.sessions.open(2, 'old', cog.snapshot)
+        old.started = True
+        view = QuestionnaireView(bot=cog.bot, cog=cog, session=old)
+        questions = [q for q in cog.snapshot.questions if q['type'].startswith('text')][:1]
+        modal = AnswerModal(bot=cog.bot, cog=cog, interaction=FakeInteraction(user_id=2),
+                            view=view, questions=questions)
+        modal.answers[0]._value = 'Stale'
+
+        # The user started over in another message meanwhile
+        new = cog.sessions.open(2, 'new', cog.snapshot)
+        new.answers = ['ACC Sprint']
+        await cog.drafts.checkpoint(new, version)
+
+        interaction = FakeInteraction(user_id=2)
+        await modal.on_submit(interaction)
+        assert cog.drafts.get(2, version) == ['ACC Sprint']
+        assert old.answers == []
+        (kind, kwargs), = interaction.response.calls
+        assert kind == 'edit_message'
+        assert kwargs['view'].children[0].label == 'Message timed out'
+    run(test)
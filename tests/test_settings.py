@@ -0,0 +1,99 @@
+import asyncio
+import shutil
+import json
+import os
+
+import pytest
+
+from conftest import (
+    CONFIG,
+    FakeBot,
+)
+from settings import (
+    ConfigError,
+    Settings,
+    settings,
+)
+
+
+@pytest.fixture
+def files(tmp_path):
+    """A Settings over a copy of the test config, and a way to rewrite its files."""
+    for name in os.listdir(CONFIG):
+        shutil.copy(os.path.join(CONFIG, name), tmp_path / name)
+    registry = Settings(str(tmp_path))
+    registry.load_all()
+
+    def write(name: str, data) -> None:
+        with open(tmp_path / name, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+    return registry, write
+
+
+def test_rejected_file_is_rolled_back(files):
+    registry, write = files
+    old = registry.questions
+    seen = []
+
+    async def compile(name: str) -> None:
+        seen.append(registry.questions[0]['title'])
+
+    async def validate(name: str) -> None:
+        if registry.questions[0]['title'] == 'Rejected':
+            raise ConfigError('no thanks')
+
+    registry.listeners += [compile, validate]
+    write('questions.json', [{**old[0], 'title': 'Rejected'}, *old[1:]])
+    results = asyncio.run(registry.refresh(['questions.json']))
+
+    assert results == {'questions.json': 'no thanks'}
+    assert registry.questions is old
+    # compile() took the new version, then was told to go back
+    assert seen == ['Rejected', old[0]['title']]
+
+
+def test_rejected_config_is_restored_in_place(files):
+    registry, write = files
+    config = registry.config
+    old = dict(config)
+
+    async def validate(name: str) -> None:
+        raise RuntimeError('broken')
+
+    registry.listeners.append(validate)
+    write('config.json', {**old, 'admin_role': 'Someone Else'})
+    results = asyncio.run(registry.refresh(['config.json']))
+
+    assert results == {'config.json': 'RuntimeError: broken'}
+    assert registry.config is config and config == old
+
+
+def test_questionnaire_keeps_serving_the_old_questions(files, tmp_path, monkeypatch):
+    registry, write = files
+    monkeypatch.setattr(settings, 'directory', registry.directory)
+    monkeypatch.setattr(settings, 'files', registry.files)
+    monkeypatch.chdir(tmp_path)
+    from cogs.questionnaire import Cog
+
+    # Without a "*" fallback, every series needs its own sim
+    write('sim_tags.json', [
+        *(tag for tag in registry.sim_tags if tag['sim_name'] != '*'),
+        {'sim_name': 'Other', 'forum_tag': None, 'role_id': None},
+    ])
+    registry.files['sim_tags.json'] = registry.read('sim_tags.json')
+
+    async def run() -> None:
+        cog = Cog(FakeBot())
+        await cog.cog_load()
+        try:
+            old, snapshot = settings.questions, cog.snapshot
+            choices = old[0]['choices'] + ['rFactor 2 Endurance']
+            write('questions.json', [{**old[0], 'choices': choices}, *old[1:]])
+            results = await settings.refresh(['questions.json'])
+            assert 'no sim for series' in results['questions.json']
+            assert settings.questions is old
+            assert cog.snapshot is snapshot
+        finally:
+            await cog.cog_unload()
+
+    asyncio.run(run())
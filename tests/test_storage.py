@@ -0,0 +1,102 @@
+import threading
+import asyncio
+
+import pytest
+
+from metrics import metrics
+from storage import SQLiteConfig
+from utils import flush_backlog
+
+
+def test_sqlite_reads_see_writes_not_yet_committed(tmp_path):
+    async def run() -> None:
+        store = SQLiteConfig('answers.json', path=str(tmp_path / 'rrc.sqlite3'))
+        # Hold up the writer thread, so nothing below commits before we look
+        gate = threading.Event()
+        store.db.executor.submit(gate.wait)
+
+        await store.put('a', {'n': 1}, wait=False)
+        assert store.get('a') == {'n': 1}
+        assert 'a' in store and len(store) == 1
+        await store.put('a', {'n': 2}, wait=False)
+        assert store['a'] == {'n': 2}
+        await store.remove('a', wait=False)
+        assert 'a' not in store and store.get('a') is None
+        with pytest.raises(KeyError):
+            await store.remove('a', wait=False)
+        await store.put('b', {'n': 3}, wait=False)
+        assert store.all() == {'b': {'n': 3}} and len(store) == 1
+
+        gate.set()
+        await store.put('c', {'n': 4})
+        assert store.unflushed == {}
+        assert store.all() == {'b': {'n': 3}, 'c': {'n': 4}} and len(store) == 2
+
+    asyncio.run(run())
+
+
+def test_sqlite_write_timings_are_recorded(tmp_path):
+    def writes() -> int:
+        counts = metrics.storage_flush.values.get(
+            metrics.storage_flush._key({'store': 'irr.json', 'kind': 'sqlite'}))
+        return counts[-1] if counts else 0
+
+    async def run() -> None:
+        store = SQLiteConfig('irr.json', path=str(tmp_path / 'rrc.sqlite3'))
+        before = writes()
+        await store.put('irr_num', 10)
+        await store.put_many({'a': 1, 'b': 2})
+        assert writes() == before + 2
+
+    asyncio.run(run())
+
+
+def test_sqlite_scan_runs_off_the_loop_and_sees_queued_writes(tmp_path):
+    async def run() -> None:
+        store = SQLiteConfig('answers.json', path=str(tmp_path / 'rrc.sqlite3'))
+        await store.put_many({'a': {'n': 1}, 'b': {'n': 2}})
+        gate = threading.Event()
+        store.db.executor.submit(gate.wait)
+        await store.put('c', {'n': 3}, wait=False)
+        await store.remove('a', wait=False)
+
+        threads = []
+        decode = store._decode
+        store._decode = lambda value: threads.append(threading.current_thread().name) or decode(value)
+        assert await store.scan() == {'b': {'n': 2}, 'c': {'n': 3}}
+        assert threads[0].startswith('sqlite-scan')
+        assert len(store) == 2
+        gate.set()
+
+    asyncio.run(run())
+
+
+def test_sqlite_files_are_shared_by_absolute_path(tmp_path, monkeypatch):
+    async def run() -> None:
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'other').mkdir()
+        first = SQLiteConfig('answers.json', path='rrc.sqlite3')
+        await first.put('a', 1)
+        monkeypatch.chdir(tmp_path / 'other')
+        second = SQLiteConfig('answers.json', path='rrc.sqlite3')
+        assert second.db is not first.db
+        assert 'a' not in second and len(second) == 0
+
+    asyncio.run(run())
+
+
+def test_sqlite_writes_in_flight_count_as_backlog(tmp_path):
+    async def run() -> None:
+        store = SQLiteConfig('irr.json', path=str(tmp_path / 'rrc.sqlite3'))
+        gate = threading.Event()
+        store.db.executor.submit(gate.wait)
+        await store.put('irr_num', 10, wait=False)
+        await asyncio.sleep(0.05)
+        assert store.loop.time() - store.dirty_since() >= 0.05
+        backlog, oldest = flush_backlog()
+        assert backlog >= 1 and oldest >= 0.05
+        gate.set()
+        await store.put('irr_num', 11)
+        assert store.dirty_since() is None
+
+    asyncio.run(run())
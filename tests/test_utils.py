@@ -0,0 +1,228 @@
+import subprocess
+import asyncio
+import sys
+import os
+
+import pytest
+
+from conftest import ROOT
+from utils import ConfigArray, Config, Sequence
+
+from typing import Any
+
+
+# Fills a store, then compacts its journal and dies at the Nth step of that
+# compaction, like kill -9 would. The steps are every os.replace,
+# os.remove and os.fsync, and every file opened for writing. A file being
+# written is cut off halfway, and one about to be fsynced is cut in half, as
+# if the data never reached the disk.
+CRASH = '''
+import builtins
+import asyncio
+import stat
+import sys
+import os
+
+from utils import ConfigArray, Config, Sequence
+
+step = int(sys.argv[1])
+kind = sys.argv[2]
+calls = 0
+
+
+def crashing() -> bool:
+    global calls
+    calls += 1
+    return calls == step
+
+
+class Torn:
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, data):
+        self.file.write(data[:len(data) // 2])
+        self.file.flush()
+        os._exit(9)
+
+
+def crash_open(file, mode='r', *args, **kwargs):
+    f = real_open(file, mode, *args, **kwargs)
+    return Torn(f) if 'w' in mode and crashing() else f
+
+
+def crash_before(func):
+    def wrapper(*args, **kwargs):
+        if crashing():
+            if func is fsync and stat.S_ISREG(os.fstat(args[0]).st_mode):
+                os.ftruncate(args[0], os.fstat(args[0]).st_size // 2)
+            os._exit(9)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+async def fill(store, prefix):
+    for i in range(10):
+        if kind == 'Config':
+            await store.put(f'{prefix}{i}', i)
+        else:
+            await store.add(f'{prefix}{i}')
+
+
+async def main():
+    store = globals()[kind]('answers.json', journal=True, compact_bytes=1 << 30)
+    await fill(store, 'a')
+    await store._compact()
+    await fill(store, 'b')
+    os.replace, os.remove, os.fsync = map(crash_before, (os.replace, os.remove, fsync))
+    builtins.open = crash_open
+    await store._compact()
+
+
+fsync, real_open = os.fsync, builtins.open
+asyncio.run(main())
+'''
+
+EXPECTED = {
+    'Config': {**{f'a{i}': i for i in range(10)}, **{f'b{i}': i for i in range(10)}},
+    'ConfigArray': [*(f'a{i}' for i in range(10)), *(f'b{i}' for i in range(10))],
+}
+
+
+async def reopen(kind: type = Config) -> Any:
+    store = kind('answers.json', journal=True)
+    await store.close()
+    return store.all()
+
+
+@pytest.mark.parametrize('kind', (Config, ConfigArray))
+def test_compaction_survives_a_crash_at_every_step(tmp_path, monkeypatch, kind):
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(
+        filter(None, (ROOT, os.environ.get('PYTHONPATH'))))}
+    step = 0
+    while True:
+        step += 1
+        cwd = tmp_path / str(step)
+        cwd.mkdir()
+        crash = subprocess.run([sys.executable, '-c', CRASH, str(step), kind.__name__],
+                               cwd=cwd, env=env, capture_output=True, text=True)
+        assert crash.returncode in (0, 9), crash.stderr
+
+        monkeypatch.chdir(cwd)
+        expected = EXPECTED[kind.__name__]
+        assert asyncio.run(reopen(kind)) == expected, f'lost writes crashing at step {step}'
+        assert sorted(os.listdir(cwd)) in (['answers.json'], ['answers.json', 'answers.json.journal'])
+        assert asyncio.run(reopen(kind)) == expected
+        if crash.returncode == 0:
+            break  # ran out of steps to crash at
+    assert step > 5
+
+
+def test_failed_compaction_keeps_its_journal(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> None:
+        store = Config('answers.json', journal=True, compact_bytes=1 << 30)
+        await store.put('a', 1)
+        install = store._install
+        store._install = lambda data: (_ for _ in ()).throw(OSError('disk full'))
+        with pytest.raises(OSError):
+            await store._compact()
+        await store.put('b', 2)
+        store._install = install
+        # The second compaction must not rotate over the first one's .old
+        store._rotate()
+        await store.close()
+
+    asyncio.run(run())
+    assert asyncio.run(reopen()) == {'a': 1, 'b': 2}
+
+
+def test_compaction_does_not_journal_a_snapshotted_add_twice(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> None:
+        store = ConfigArray('answers.json', journal=True, compact_bytes=1 << 30)
+        await store.add(0)
+        # add() changes the list before it waits for the lock, so let a
+        # compaction get the lock in between and snapshot the new item
+        async with store.lock:
+            compact = asyncio.create_task(store._compact())
+            await asyncio.sleep(0)
+            add = asyncio.create_task(store.add(1))
+            await asyncio.sleep(0)
+        await asyncio.gather(compact, add)
+        await store.close()
+
+    asyncio.run(run())
+    assert asyncio.run(reopen(ConfigArray)) == [0, 1]
+
+
+def test_journal_keeps_working_after_a_torn_tail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def put(key: str) -> None:
+        store = Config('answers.json', journal=True)
+        await store.put(key, 1)
+        await store.close()
+
+    asyncio.run(put('a'))
+    with open('answers.json.journal', 'ab') as f:
+        f.write(b'["p","b",')  # cut off by a crash
+    asyncio.run(put('c'))
+    assert asyncio.run(reopen()) == {'a': 1, 'c': 1}
+
+
+def test_sequence_numbers_stay_unique_and_gapless_across_a_reload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> list[int]:
+        store: Config[int] = Config('irr.json', journal=True)
+        numbers = Sequence(store, 'irr_num', block=3)
+        # Mid-reservation when the cog is unloaded
+        calls = [asyncio.create_task(numbers.next()) for _ in range(10)]
+        await asyncio.sleep(0)
+        await numbers.close()
+        assert all(call.done() for call in calls)
+        with pytest.raises(RuntimeError):
+            await numbers.next()
+        await store.close()
+
+        store = Config('irr.json', journal=True)
+        numbers = Sequence(store, 'irr_num', block=3)
+        issued = [call.result() for call in calls]
+        issued += await asyncio.gather(*(numbers.next() for _ in range(10)))
+        await numbers.close()
+        await store.close()
+        assert Config('irr.json', journal=True).get('irr_num') == 21
+        return issued
+
+    assert sorted(asyncio.run(run())) == list(range(1, 21))
+
+
+def test_append_journals_only_the_new_item(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def run() -> list[int]:
+        store: Config[list[str]] = Config('index.json', journal=True)
+        sizes = []
+        for n in range(50):
+            await store.append('user:1', f'{n:08x}')
+            sizes.append(os.path.getsize('index.json.journal'))
+        await store.close()
+        return [b - a for a, b in zip(sizes, sizes[1:])]
+
+    async def reopen() -> dict[str, list[str]]:
+        store: Config[list[str]] = Config('index.json', journal=True)
+        await store.close()
+        return store.all()
+
+    growth = asyncio.run(run())
+    assert max(growth) == min(growth)
+    assert asyncio.run(reopen()) == {'user:1': [f'{n:08x}' for n in range(50)]}
@@ -3,10 +3,18 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 
+import contextlib
 import asyncio
+import shutil
+import abc
+import logging
+import weakref
+import time
 import json
 import os
 
+from metrics import metrics
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from bot import Bot
@@ -14,6 +22,7 @@ if TYPE_CHECKING:
         ParamSpec,
         Awaitable,
         Iterator,
+        IO,
         Callable,
         Optional,
         Generic,
@@ -34,10 +43,17 @@ else:
     _D = 0
 
 
+log = logging.getLogger(__name__)
+
 __all__ = (
     'ConfigArray',
     'Config',
+    'Sequence',
+    'StartupProfile',
     'Color',
+    'flush_backlog',
+    'fsync_dir',
+    'rss_bytes',
     'is_admin',
     'non_admin_embed',
     'hybrid_admin_only',
@@ -88,113 +104,453 @@ class PIDFile:
             file.close()
 
 
-class ConfigArray(Generic[_T]):
-    def __init__(self, name: str, object_hook: Optional[ObjectHook] = None, encoder: Optional[type[json.JSONEncoder]] = None) -> None:
+def fsync_dir(path: str) -> None:
+    # Makes renames in the directory holding path durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_file(path: str, data: bytes) -> None:
+    """Writes data to path durably. path only ever holds a complete file."""
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+    fsync_dir(path)
+
+
+class _Store(Generic[_T], metaclass=abc.ABCMeta):
+    """Shared persistence for :class:`Config` and :class:`ConfigArray`.
+
+    By default every save rewrites the whole file. With ``journal=True``
+    mutations are appended to ``<name>.journal`` instead, and the journal is
+    folded back into the main file by a background compaction once it grows
+    past ``compact_bytes``. On load the main file is read and the journal is
+    replayed on top of it. A journaled mutation has been fsynced by the time
+    its ``put``/``add``/``remove`` returns; mutations made while a write is
+    in progress share the next one.
+
+    Saves are group committed: :meth:`save` only marks the store dirty, and a
+    single flusher writes the latest state at most once per
+    ``commit_window`` seconds, so a burst of saves costs one write.
+    """
+    _db: Any
+
+    def __class_getitem__(cls, item: Any) -> Any:
+        # Generic is stubbed out at runtime, see the imports above
+        return cls
+
+    def __init__(
+        self,
+        name: str,
+        object_hook: Optional[ObjectHook] = None,
+        encoder: Optional[type[json.JSONEncoder]] = None,
+        journal: bool = False,
+        compact_bytes: int = 1 << 20,
+        commit_window: float = 0.0,
+    ) -> None:
         self.name = name
         self.path = './' + name
         self.object_hook = object_hook
         self.encoder = encoder
+        self.journal = journal
+        self.journal_path = self.path + '.journal'
+        self.compact_bytes = compact_bytes
+        self.commit_window = commit_window
         self.loop = asyncio.get_running_loop()
         self.lock = asyncio.Lock()
-        self._db: list[_T] = []
+        self._journal: Optional[IO[bytes]] = None
+        self._journal_size: int = 0
+        self._compact_task: Optional[asyncio.Task[None]] = None
+        # Journal entries waiting to be written, and resolved once they are
+        self._batch: Optional[tuple[list[bytes], asyncio.Future[None]]] = None
+        self._batch_since: float = 0.0
+        # Loop time of the oldest journal entry not yet written
+        self._journal_since: Optional[float] = None
+        # Resolved by the flush that will include the latest changes
+        self._pending: Optional[asyncio.Future[None]] = None
+        self._flush_task: Optional[asyncio.Task[None]] = None
+        self._last_flush: float = 0.0
+        # Loop time of the oldest change not yet on disk, and of the first
+        # change waiting for the next flush
+        self._dirty_since: Optional[float] = None
+        self._pending_since: float = 0.0
         self.load_from_file()
+        stores.add(self)
 
-    def load_from_file(self) -> None:
+    @abc.abstractmethod
+    def _empty(self) -> Any:
+        """A store with nothing in it."""
+
+    @abc.abstractmethod
+    def _apply(self, entry: list[Any]) -> None:
+        """Replays one journal entry on top of _db."""
+
+    def _read(self) -> None:
         try:
             with open(self.path, 'r', encoding='utf-8') as f:
                 self._db = json.load(f, object_hook=self.object_hook)
         except FileNotFoundError:
-            self._db = []
+            self._db = self._empty()
+
+    def _replay(self, path: str) -> int:
+        """Applies the journal at path, returns how many bytes of it were whole."""
+        size = 0
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        entry = json.loads(line, object_hook=self.object_hook)
+                    except ValueError:
+                        break  # torn write at the tail, drop it
+                    self._apply(entry)
+                    size += len(line)
+        except FileNotFoundError:
+            pass
+        return size
+
+    def _finish_install(self) -> None:
+        # .compact is only ever renamed into place complete, and it already
+        # has everything in .old, so .old goes first. Once .compact is the
+        # main file, .old must be gone or it would be replayed twice.
+        compact = self.path + '.compact'
+        if not os.path.exists(compact):
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.journal_path + '.old')
+            fsync_dir(self.path)
+        os.replace(compact, self.path)
+        fsync_dir(self.path)
+
+    def _recover(self) -> None:
+        # Finish a compaction that was interrupted by a crash. See _compact()
+        # for the order in which these files are touched.
+        compact, old = self.path + '.compact', self.journal_path + '.old'
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(compact + '.tmp')  # never finished, so nothing depends on it
+        if not os.path.exists(compact) and os.path.exists(old):
+            # The snapshot never made it, so fold .old in ourselves. The main
+            # file can't have any of it yet: it only changes once .old is gone.
+            self._read()
+            self._replay(old)
+            _write_file(compact, self._serialize())
+        self._finish_install()
+
+    def load_from_file(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self.journal:
+            self._recover()
+
+        self._read()
+        self._journal_size = self._replay(self.journal_path) if self.journal else 0
+        if self.journal and os.path.exists(self.journal_path):
+            # Cut off a torn tail, or the next append would be stuck behind it
+            if os.path.getsize(self.journal_path) > self._journal_size:
+                os.truncate(self.journal_path, self._journal_size)
 
     async def load(self) -> None:
         async with self.lock:
             await self.loop.run_in_executor(None, self.load_from_file)
 
-    def _dump(self) -> None:
+    def _serialize(self) -> bytes:
+        # Runs on the event loop so nobody mutates _db halfway through.
+        return json.dumps(self._db, ensure_ascii=True, cls=self.encoder,
+                          separators=(',', ':')).encode('ascii')
+
+    def _dump(self, data: bytes) -> None:
         temp = self.path + f'{os.urandom(16).hex()}.tmp'
-        with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True,
-                      cls=self.encoder, separators=(',', ':'))
+        with open(temp, 'wb') as tmp:
+            tmp.write(data)
+            # On disk before it replaces the old file, or a power cut can
+            # leave an empty one behind
+            tmp.flush()
+            os.fsync(tmp.fileno())
 
         # atomically move the file
         os.replace(temp, self.path)
-
-    async def save(self) -> None:
+        fsync_dir(self.path)
+
+    async def save(self, wait: bool = True) -> None:
+        """Schedules a write of the whole store.
+
+        With ``wait=True`` this returns once a write that includes every
+        change made so far has hit the disk.
+        """
+        if self._pending is None:
+            self._pending = self.loop.create_future()
+            self._pending_since = self.loop.time()
+            if self._dirty_since is None:
+                self._dirty_since = self._pending_since
+        pending = self._pending
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = self.loop.create_task(self._flusher())
+        if wait:
+            await asyncio.shield(pending)
+
+    async def _flusher(self) -> None:
+        while self._pending is not None:
+            delay = self._last_flush + self.commit_window - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            pending, self._pending = self._pending, None
+            try:
+                async with self.lock:
+                    with metrics.storage_flush.time(store=self.name, kind='save'):
+                        data = self._serialize()
+                        await self.loop.run_in_executor(None, self._dump, data)
+            except Exception as e:
+                metrics.storage_errors.inc(store=self.name)
+                log.exception(f'Failed to save {self.name}')
+                pending.set_exception(e)
+                pending.exception()  # don't warn if nobody was waiting
+            else:
+                pending.set_result(None)
+                self._dirty_since = None if self._pending is None else self._pending_since
+            self._last_flush = self.loop.time()
+
+    def _append(self, data: bytes, size: int) -> None:
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'ab')
+            fsync_dir(self.journal_path)
+        try:
+            self._journal.write(data)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+        except BaseException:
+            # Don't leave half an entry for the next append to follow
+            self._journal.close()
+            self._journal = None
+            with contextlib.suppress(OSError):
+                os.truncate(self.journal_path, size)
+            raise
+
+    async def _write_batch(self) -> None:
+        """Appends every entry logged so far to the journal. Needs the lock."""
+        if self._batch is None:
+            return
+        (lines, written), self._batch = self._batch, None
+        data = b''.join(lines)
+        try:
+            with metrics.storage_flush.time(store=self.name, kind='journal'):
+                await self.loop.run_in_executor(None, self._append, data, self._journal_size)
+        except Exception as e:
+            metrics.storage_errors.inc(store=self.name)
+            log.exception(f'Failed to write the journal of {self.name}')
+            written.set_exception(e)
+            written.exception()  # don't warn if nobody was waiting
+        else:
+            self._journal_size += len(data)
+            self._journal_since = None if self._batch is None else self._batch_since
+            written.set_result(None)
+
+    async def _log(self, *entry: Any, wait: bool = True) -> None:
+        """Persists a single mutation, either to the journal or by saving.
+
+        Entries are queued in the order the mutations happened, before
+        anything is awaited, and whoever gets the lock first writes (and
+        fsyncs) all of them at once. So a mutation is in the journal once
+        this returns, and a compaction that snapshots it also takes its
+        entry along to ``.old``; see _compact().
+        """
+        if not self.journal:
+            return await self.save(wait=wait)
+
+        line = json.dumps(entry, ensure_ascii=True, cls=self.encoder,
+                          separators=(',', ':')).encode('ascii') + b'\n'
+        if self._batch is None:
+            self._batch = ([], self.loop.create_future())
+            self._batch_since = self.loop.time()
+            if self._journal_since is None:
+                self._journal_since = self._batch_since
+        lines, written = self._batch
+        lines.append(line)
+        async with self.lock:
+            if self._batch is not None and self._batch[1] is written:
+                await self._write_batch()
+        await written
+
+        if (self._journal_size >= self.compact_bytes
+                and (self._compact_task is None or self._compact_task.done())):
+            self._compact_task = self.loop.create_task(self._compact())
+
+    def _rotate(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        # An earlier compaction may have got as far as a complete .compact
+        self._finish_install()
+        old = self.journal_path + '.old'
+        try:
+            if os.path.exists(old):
+                # An earlier compaction failed; keep what it didn't fold in
+                with open(self.journal_path, 'rb') as src, open(old, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, old)
+            fsync_dir(old)
+        except FileNotFoundError:
+            pass
+
+    def _install(self, data: bytes) -> None:
+        _write_file(self.path + '.compact', data)
+        self._finish_install()
+
+    async def _compact(self) -> None:
+        """Folds the journal into a fresh snapshot of the main file.
+
+        The snapshot is taken and the entries logged so far are written
+        together under the lock, so the journal then holds exactly what the
+        snapshot does. It is moved aside to ``.old`` before the lock is
+        released, and new mutations land in a fresh journal while the
+        snapshot is written. The snapshot goes to ``.compact`` by way of a
+        synced temp file, so it exists only once complete; then ``.old`` is
+        deleted and ``.compact`` becomes the main file. A crash at any point
+        leaves either a complete ``.compact``, or the main file and ``.old``
+        to replay, never both; see _recover().
+        """
+        start = time.perf_counter()
+        async with self.lock:
+            data = self._serialize()
+            batch = self._batch
+            await self._write_batch()
+            if batch is not None and batch[1].exception() is not None:
+                raise batch[1].exception()  # type: ignore
+            await self.loop.run_in_executor(None, self._rotate)
+            self._journal_size = 0
+        await self.loop.run_in_executor(None, self._install, data)
+        metrics.storage_flush.observe(
+            time.perf_counter() - start, store=self.name, kind='compact')
+
+    async def close(self) -> None:
+        """Waits for pending writes and closes the journal."""
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._compact_task is not None:
+            await self._compact_task
         async with self.lock:
-            await self.loop.run_in_executor(None, self._dump)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def dirty_since(self) -> Optional[float]:
+        """Loop time of the oldest change not yet on disk, if there is one."""
+        times = [t for t in (self._dirty_since, self._journal_since) if t is not None]
+        return min(times) if times else None
+
+    def all(self) -> Any:
+        return self._db
+
+    async def scan(self) -> Any:
+        """A copy of the whole store, for walking through it across awaits."""
+        return self._db.copy()
+
+    def __len__(self) -> int:
+        return len(self._db)
+
+    def __str__(self) -> str:
+        return str(self.all())
+
+
+# Every store, for flush_backlog(). Anything with a loop and a dirty_since()
+# can be added, see storage.SQLiteConfig.
+stores: weakref.WeakSet[Any] = weakref.WeakSet()
+
+
+def flush_backlog() -> tuple[int, float]:
+    """Stores with changes not yet on disk, and how long the oldest has waited.
+
+    A failed save leaves its store in the backlog until a later one works.
+    """
+    waiting = []
+    for store in list(stores):
+        since = store.dirty_since()
+        if since is not None:
+            waiting.append(store.loop.time() - since)
+    return len(waiting), max(waiting, default=0.0)
+
+
+metrics.storage_backlog.set_function(lambda: flush_backlog()[0])
+
+
+class ConfigArray(_Store[_T]):
+    _db: list[_T]
+
+    def _empty(self) -> list[_T]:
+        return []
+
+    def _apply(self, entry: list[Any]) -> None:
+        op, item = entry
+        if op == 'a':
+            self._db.append(item)
+        elif item in self._db:
+            self._db.remove(item)
 
-    async def add(self, item: _T) -> None:
+    async def add(self, item: _T, wait: bool = True) -> None:
         self._db.append(item)
-        await self.save()
+        await self._log('a', item, wait=wait)
 
-    async def remove(self, item: _T) -> None:
+    async def remove(self, item: _T, wait: bool = True) -> None:
         self._db.remove(item)
-        await self.save()
+        await self._log('r', item, wait=wait)
 
     def __contains__(self, item: Any) -> bool:
         return item in self._db
 
-    def __len__(self) -> int:
-        return len(self._db)
-
     def __iter__(self) -> Iterator[_T]:
         return iter(self._db)
 
     def all(self) -> list[_T]:
         return self._db
 
-    def __str__(self) -> str:
-        return str(self.all())
 
+class Config(_Store[_T]):
+    _db: dict[str, _T]
 
-class Config(Generic[_T]):
-    def __init__(self, name: str, object_hook: Optional[ObjectHook] = None, encoder: Optional[type[json.JSONEncoder]] = None) -> None:
-        self.name = name
-        self.path = './' + name
-        self.object_hook = object_hook
-        self.encoder = encoder
-        self.loop = asyncio.get_running_loop()
-        self.lock = asyncio.Lock()
-        self._db: dict[str, _T] = {}
-        self.load_from_file()
-
-    def load_from_file(self) -> None:
-        try:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                self._db = json.load(f, object_hook=self.object_hook)
-        except FileNotFoundError:
-            self._db = {}
+    def _empty(self) -> dict[str, _T]:
+        return {}
 
-    async def load(self) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self.load_from_file)
-
-    def _dump(self) -> None:
-        temp = self.path + f'{os.urandom(16).hex()}.tmp'
-        with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True,
-                      cls=self.encoder, separators=(',', ':'))
-
-        # atomically move the file
-        os.replace(temp, self.path)
-
-    async def save(self) -> None:
-        async with self.lock:
-            await self.loop.run_in_executor(None, self._dump)
+    def _apply(self, entry: list[Any]) -> None:
+        if entry[0] == 'p':
+            self._db[entry[1]] = entry[2]
+        elif entry[0] == 'a':
+            self._db.setdefault(entry[1], []).append(entry[2])  # type: ignore
+        else:
+            self._db.pop(entry[1], None)
 
     def get(self, key: Any, default: _D = None) -> _T | _D:
         """Retrieves a config entry."""
         return self._db.get(str(key), default)
 
-    async def put(self, key: Any, value: _T) -> None:
+    async def put(self, key: Any, value: _T, wait: bool = True) -> None:
         """Edits a config entry."""
         self._db[str(key)] = value
-        await self.save()
+        await self._log('p', str(key), value, wait=wait)
+
+    async def append(self, key: Any, item: Any, wait: bool = True) -> None:
+        """Appends item to the list at key, creating it if need be.
 
-    async def remove(self, key: Any) -> None:
+        Only the item goes in the journal, not the whole list.
+        """
+        self._db.setdefault(str(key), []).append(item)  # type: ignore
+        await self._log('a', str(key), item, wait=wait)
+
+    async def remove(self, key: Any, wait: bool = True) -> None:
         """Removes a config entry."""
         del self._db[str(key)]
-        await self.save()
+        await self._log('d', str(key), wait=wait)
 
     def __contains__(self, item: Any) -> bool:
         return str(item) in self._db
@@ -202,14 +558,109 @@ class Config(Generic[_T]):
     def __getitem__(self, item: Any) -> _T:
         return self._db[str(item)]
 
-    def __len__(self) -> int:
-        return len(self._db)
-
     def all(self) -> dict[str, _T]:
         return self._db
 
-    def __str__(self) -> str:
-        return str(self.all())
+
+class Sequence:
+    """Hands out unique, increasing numbers backed by a :class:`Config` key.
+
+    Numbers are reserved on disk ``block`` at a time, so one write covers
+    many calls to :meth:`next`. The stored value is on disk, past every
+    number handed out, before any number of its block is, so after a crash
+    numbers are skipped but never reused. :meth:`close` gives the unused
+    part of the block back, so a reload carries on without a gap.
+    """
+
+    def __init__(self, store: Config[int], key: str, block: int = 10, start: int = 1) -> None:
+        self.store = store
+        self.key = key
+        self.block = block
+        self._next: int = store.get(key, start)
+        self._limit: int = self._next
+        self._reserving: Optional[asyncio.Task[None]] = None
+        self._closed: bool = False
+
+    async def _reserve(self) -> None:
+        try:
+            limit = self._limit + self.block
+            await self.store.put(self.key, limit)
+            self._limit = limit
+        finally:
+            self._reserving = None
+
+    async def next(self) -> int:
+        """Allocates the next number."""
+        if self._closed:
+            raise RuntimeError(f'Sequence {self.key!r} is closed')
+        while self._next >= self._limit:
+            if self._reserving is None:
+                self._reserving = asyncio.get_running_loop().create_task(self._reserve())
+            # Everyone who runs dry shares the same reservation
+            await asyncio.shield(self._reserving)
+
+        # No await between the check and the increment, so this is atomic
+        # as far as the event loop is concerned
+        number = self._next
+        self._next += 1
+        return number
+
+    async def close(self) -> None:
+        """Stores the next number unused. Calls already waiting still get theirs."""
+        self._closed = True
+        # Waiters wake up (and take their numbers) before we do
+        while self._reserving is not None:
+            await asyncio.shield(self._reserving)
+        if self._next < self._limit:
+            await self.store.put(self.key, self._next)
+            self._limit = self._next
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process, 0 if it can't be determined."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class StartupProfile:
+    """How long each phase of startup took, for ``main.py --profile-startup``."""
+    # In the order they happen. Phases that never ran show up as such.
+    expected = ('imports', 'config', 'login', 'cogs', 'command sync', 'gateway READY')
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.phases: dict[str, float] = {}
+        self.details: list[tuple[str, float]] = []
+
+    def add(self, name: str, seconds: float, detail: bool = False) -> None:
+        if detail:
+            self.details.append((name, seconds))
+        else:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str, detail: bool = False) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, detail=detail)
+
+    def report(self) -> str:
+        lines = [f'{"phase":<24}{"ms":>10}']
+        for name in (*self.expected, *(n for n in self.phases if n not in self.expected)):
+            seconds = self.phases.get(name)
+            lines.append(f'{name:<24}' + (f'{seconds * 1000:>10.1f}'
+                                          if seconds is not None else f'{"not run":>10}'))
+            if name in ('config', 'cogs'):
+                lines.extend(f'  {detail.partition(":")[2]:<22}{seconds * 1000:>10.1f}'
+                             for detail, seconds in self.details
+                             if detail.startswith(name + ':'))
+        lines.append(f'{"total":<24}{(time.perf_counter() - self.started) * 1000:>10.1f}')
+        return '\n'.join(lines)
 
 
 class Color:
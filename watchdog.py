@@ -0,0 +1,213 @@
+# watchdog.py - Event loop lag and slow handler detection
+#
+# Everything the bot does runs on one asyncio loop, so a handler that holds
+# it (a big JSON dump, a slow embed build) delays every other click. The
+# shared `watchdog` keeps an eye on that in two ways:
+#
+# * A task on the loop wakes up every `interval` seconds and records how
+#   late it woke up. That's the loop lag, exported as rrc_loop_lag_seconds
+#   and kept for the health report (see lag()).
+#
+# * Listeners, events and modal submissions run inside watchdog.track().
+#   One still running after `slow_handler` seconds is logged with its name,
+#   custom_id and the stack it's waiting in. If the loop itself stops for
+#   `stall` seconds, a thread samples the loop thread's stack instead,
+#   since nothing on the loop can.
+#
+# Both thresholds come from the optional "watchdog" section of config.json.
+#
+# 2023 Ryan Thompson <i@ry.ca>
+
+from __future__ import annotations
+from collections import deque
+import contextlib
+import traceback
+import threading
+import functools
+import asyncio
+import logging
+import time
+import sys
+
+from metrics import metrics
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from typing import (
+        AsyncIterator,
+        Awaitable,
+        Callable,
+        Optional,
+        TypeVar,
+        Any,
+    )
+    import discord
+
+    _F = TypeVar('_F', bound=Callable[..., Awaitable[Any]])
+
+
+__all__ = (
+    'Watchdog',
+    'watched',
+    'watchdog',
+)
+
+log = logging.getLogger(__name__)
+
+# How long lag() looks back for its maximum
+WINDOW = 60.0
+
+
+def coroutine_stack(task: asyncio.Task[Any]) -> str:
+    """Where a task is waiting, following the whole chain of awaits.
+
+    Task.get_stack() stops at the outermost coroutine, which for a listener
+    is always discord.py's _run_event().
+    """
+    frames = []
+    coro: Any = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is not None:
+            frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return ''.join(traceback.format_list(traceback.StackSummary.extract(frames)))
+
+
+class _Running:
+    __slots__ = ('name', 'custom_id', 'task', 'start', 'flagged')
+
+    def __init__(self, name: str, custom_id: Optional[str], task: Optional[asyncio.Task[Any]]) -> None:
+        self.name = name
+        self.custom_id = custom_id
+        self.task = task
+        self.start = time.perf_counter()
+        self.flagged = False
+
+    def __str__(self) -> str:
+        return self.name if self.custom_id is None else f'{self.name} ({self.custom_id})'
+
+
+class Watchdog:
+    def __init__(self, interval: float = 0.1, slow_handler: float = 0.5, stall: float = 1.0) -> None:
+        self.interval = interval
+        self.slow_handler = slow_handler
+        self.stall = stall
+        self.running: dict[int, _Running] = {}
+        self.samples: deque[tuple[float, float]] = deque()  # (when, lag)
+        self.last_lag: float = 0.0
+        # Written by the loop, read by the sampler thread
+        self.heartbeat: float = time.perf_counter()
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task[None]] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    def configure(self, interval: Optional[float] = None, slow_handler: Optional[float] = None,
+                  stall: Optional[float] = None) -> None:
+        if interval is not None:
+            self.interval = interval
+        if slow_handler is not None:
+            self.slow_handler = slow_handler
+        if stall is not None:
+            self.stall = stall
+
+    def start(self) -> None:
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.perf_counter()
+        self.task = asyncio.create_task(self._measure())
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._sample, name='watchdog', daemon=True)
+        self.thread.start()
+        metrics.loop_lag_max.set_function(lambda: self.lag()[1])
+
+    async def stop(self) -> None:
+        metrics.loop_lag_max.set_function(None)
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.thread is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+            self.thread = None
+
+    def lag(self) -> tuple[float, float]:
+        """The latest loop lag, and the largest in the last minute, in seconds."""
+        return self.last_lag, max((lag for _, lag in self.samples), default=0.0)
+
+    async def _measure(self) -> None:
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - before - self.interval)
+            self.heartbeat = now
+            self.last_lag = lag
+            self.samples.append((now, lag))
+            while self.samples[0][0] < now - WINDOW:
+                self.samples.popleft()
+            metrics.loop_lag.observe(lag)
+            self._check_running(now)
+
+    def _check_running(self, now: float) -> None:
+        for running in self.running.values():
+            if running.flagged or now - running.start < self.slow_handler:
+                continue
+            running.flagged = True
+            metrics.slow_handlers.inc(handler=running.name)
+            stack = coroutine_stack(running.task) if running.task is not None else ''
+            log.warning(f'{running} has been running for '
+                        f'{(now - running.start) * 1000:.0f}ms, waiting in:\n{stack}')
+
+    def _sample(self) -> None:
+        # Runs on its own thread; the loop can't report on itself while stuck
+        reported = False
+        while not self.stopping.wait(self.interval):
+            blocked = time.perf_counter() - self.heartbeat
+            if blocked < self.stall:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            metrics.loop_stalls.inc()
+            frame = sys._current_frames().get(self.loop_thread or 0)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            handlers = ', '.join(str(running) for running in list(self.running.values()))
+            log.warning(f'Event loop blocked for {blocked * 1000:.0f}ms while running '
+                        f'{handlers or "no tracked handler"}:\n{stack}')
+
+    @contextlib.asynccontextmanager
+    async def track(self, name: str, custom_id: Optional[str] = None) -> AsyncIterator[None]:
+        """Flags the block if it runs for longer than ``slow_handler``."""
+        running = _Running(name, custom_id, asyncio.current_task())
+        self.running[id(running)] = running
+        try:
+            yield
+        finally:
+            del self.running[id(running)]
+            elapsed = time.perf_counter() - running.start
+            if running.flagged:
+                log.info(f'{running} finished after {elapsed * 1000:.0f}ms')
+            elif elapsed >= self.slow_handler:
+                # It held the loop, so _check_running() never got to see it
+                metrics.slow_handlers.inc(handler=running.name)
+                log.warning(f'{running} blocked the event loop for {elapsed * 1000:.0f}ms')
+
+
+def custom_id(interaction: discord.Interaction[Any]) -> Optional[str]:
+    data: Any = interaction.data or {}
+    return data.get('custom_id')
+
+
+def watched(func: _F) -> _F:
+    """Runs ``func(self, interaction, ...)``, e.g. a Modal.on_submit, inside watchdog.track()."""
+    @functools.wraps(func)
+    async def wrapper(self: Any, interaction: discord.Interaction[Any], *args: Any, **kwargs: Any) -> Any:
+        async with watchdog.track(func.__qualname__, custom_id(interaction)):
+            return await func(self, interaction, *args, **kwargs)
+    return wrapper  # type: ignore
+
+
+watchdog = Watchdog()